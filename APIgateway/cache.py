@@ -0,0 +1,132 @@
+import hashlib
+import math
+import re
+import time
+from collections import OrderedDict
+
+
+def normalize_query(query: str) -> str:
+    query = re.sub(r"\s+", " ", query.lower()).strip()
+    return query.strip(" ?!.,;:")
+
+
+def cosine_similarity(a: list[float], b: list[float]) -> float:
+    dot = sum(x * y for x, y in zip(a, b))
+    norm = math.sqrt(sum(x * x for x in a)) * math.sqrt(sum(y * y for y in b))
+    return dot / norm if norm else 0.0
+
+
+class CacheEntry():
+    def __init__(self, context_hash: str, value: dict, embedding: list[float] = None):
+        self.context_hash = context_hash
+        self.value = value
+        self.embedding = embedding
+        self.created_at = time.monotonic()
+
+
+class AnswerCache():
+    def __init__(self, max_size: int = 1000, ttl: float = 3600.0, similarity_threshold: float = 0.0):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.similarity_threshold = similarity_threshold
+        self.index_version = None
+        self._entries: OrderedDict[str, CacheEntry] = OrderedDict()
+        # ключи, сгруппированные по контексту: похожие формулировки ищем только среди них
+        self._by_context: dict[str, set[str]] = {}
+        self.hits = 0
+        self.semantic_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    @property
+    def semantic_enabled(self) -> bool:
+        return self.similarity_threshold > 0
+
+    def _context_hash(self, context: str) -> str:
+        return hashlib.sha256(context.encode()).hexdigest()
+
+    def _key(self, query: str, context_hash: str) -> str:
+        return hashlib.sha256(f"{normalize_query(query)}\0{context_hash}".encode()).hexdigest()
+
+    def _remove(self, key: str):
+        entry = self._entries.pop(key)
+        keys = self._by_context.get(entry.context_hash)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._by_context[entry.context_hash]
+
+    def _is_expired(self, entry: CacheEntry) -> bool:
+        return time.monotonic() - entry.created_at > self.ttl
+
+    def check_version(self, index_version: str):
+        # база знаний переиндексирована: старые ответы могут быть неактуальны
+        if index_version == self.index_version:
+            return
+        if self.index_version is not None and self._entries:
+            self.clear()
+            self.invalidations += 1
+        self.index_version = index_version
+
+    def clear(self):
+        self._entries.clear()
+        self._by_context.clear()
+
+    def get(self, query: str, context: str, embedding: list[float] = None) -> dict | None:
+        context_hash = self._context_hash(context)
+        key = self._key(query, context_hash)
+        entry = self._entries.get(key)
+        if entry is not None and self._is_expired(entry):
+            self._remove(key)
+            entry = None
+        if entry is not None:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry.value
+
+        if self.semantic_enabled and embedding is not None:
+            best_key, best_score = None, self.similarity_threshold
+            for candidate_key in list(self._by_context.get(context_hash, ())):
+                candidate = self._entries[candidate_key]
+                if self._is_expired(candidate):
+                    self._remove(candidate_key)
+                    continue
+                if candidate.embedding is None:
+                    continue
+                score = cosine_similarity(embedding, candidate.embedding)
+                if score >= best_score:
+                    best_key, best_score = candidate_key, score
+            if best_key is not None:
+                self._entries.move_to_end(best_key)
+                self.hits += 1
+                self.semantic_hits += 1
+                return self._entries[best_key].value
+
+        self.misses += 1
+        return None
+
+    def put(self, query: str, context: str, value: dict, embedding: list[float] = None):
+        context_hash = self._context_hash(context)
+        key = self._key(query, context_hash)
+        if key in self._entries:
+            self._remove(key)
+        self._entries[key] = CacheEntry(context_hash, value, embedding if self.semantic_enabled else None)
+        self._by_context.setdefault(context_hash, set()).add(key)
+        while len(self._entries) > self.max_size:
+            self._remove(next(iter(self._entries)))
+            self.evictions += 1
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "semantic_hits": self.semantic_hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+            "index_version": self.index_version,
+        }
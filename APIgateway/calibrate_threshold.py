@@ -0,0 +1,115 @@
+"""Калибровка OPERATOR_SCORE_THRESHOLD по логу исходов шлюза.
+
+Шлюз пишет в лог (логгер score_outcomes) наибольшую оценку релевантности контекста и исход каждого вызова LLM:
+requires_operator=true означает, что LLM не смог ответить по найденному контексту. Для каждого порога скрипт
+считает, какая доля вопросов ушла бы оператору без вызова LLM, какую долю вопросов без ответа порог отсекает
+и сколько вопросов, на которые LLM ответил, были бы переданы оператору напрасно. Рекомендуется наибольший
+порог, при котором доля напрасных передач не превышает --max-false-handoff.
+
+Вопросы ниже действовавшего порога попадают в лог только с вероятностью OPERATOR_SCORE_EXPLORATION,
+поэтому учитываются с весом 1 / exploration_rate. Запуск из папки APIgateway:
+    python calibrate_threshold.py logs/telegram_bot.log* --max-false-handoff 0.02
+"""
+import argparse
+import glob
+import json
+import os
+
+
+def parse_outcome(line: str) -> dict | None:
+    try:
+        entry = json.loads(line)
+        if isinstance(entry, dict) and entry.get("logger") == "score_outcomes":
+            return json.loads(entry["message"])
+    except json.JSONDecodeError:
+        # текстовый формат логов: "<время> - score_outcomes - INFO - [<request_id>] {...}"
+        marker = " - score_outcomes - INFO - "
+        if marker in line:
+            message = line.split(marker, 1)[1]
+            try:
+                return json.loads(message[message.find("{"):])
+            except json.JSONDecodeError:
+                return None
+    return None
+
+
+def load_outcomes(paths: list[str]) -> list[dict]:
+    outcomes = []
+    for path in paths:
+        with open(path, encoding="utf-8", errors="replace") as file:
+            for line in file:
+                outcome = parse_outcome(line)
+                if outcome is not None:
+                    outcomes.append(outcome)
+    return outcomes
+
+
+def weight(outcome: dict) -> float:
+    if outcome.get("explored") and outcome.get("exploration_rate"):
+        return 1 / outcome["exploration_rate"]
+    return 1.0
+
+
+def evaluate(outcomes: list[dict], threshold: float) -> dict:
+    handed_off = answered_handed_off = unanswerable_caught = 0.0
+    total = answerable = unanswerable = 0.0
+    for outcome in outcomes:
+        w = weight(outcome)
+        total += w
+        below = outcome["max_score"] < threshold
+        if outcome["requires_operator"]:
+            unanswerable += w
+            unanswerable_caught += w * below
+        else:
+            answerable += w
+            answered_handed_off += w * below
+        handed_off += w * below
+    return {
+        "threshold": threshold,
+        "handoff_rate": handed_off / total if total else 0.0,
+        "unanswerable_caught": unanswerable_caught / unanswerable if unanswerable else 0.0,
+        "false_handoff": answered_handed_off / answerable if answerable else 0.0,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('logs', nargs='*', help="файлы лога шлюза, по умолчанию logs/telegram_bot.log*")
+    parser.add_argument('--max-false-handoff', type=float, default=0.02,
+                        help="допустимая доля вопросов с ответом LLM, переданных оператору")
+    parser.add_argument('--step', type=float, default=0.05, help="шаг порогов в таблице")
+    args = parser.parse_args()
+
+    paths = args.logs or sorted(glob.glob(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'logs', 'telegram_bot.log*')))
+    outcomes = load_outcomes(paths)
+    if not outcomes:
+        print("В логах нет исходов score_outcomes: шлюз должен получать оценки релевантности от RAG")
+        return
+    unanswerable = sum(outcome["requires_operator"] for outcome in outcomes)
+    print(f"Исходов: {len(outcomes)}, из них LLM не ответил: {unanswerable}")
+
+    print(f"{'порог':>6} {'к оператору':>12} {'отсечено без ответа':>20} {'напрасно':>9}")
+    steps = int(1 / args.step)
+    for i in range(steps + 1):
+        result = evaluate(outcomes, round(i * args.step, 4))
+        print(f"{result['threshold']:>6.2f} {result['handoff_rate']:>12.3f} {result['unanswerable_caught']:>20.3f} "
+              f"{result['false_handoff']:>9.3f}")
+
+    # кандидаты — сами наблюдённые оценки: между ними доли не меняются
+    candidates = sorted({outcome["max_score"] for outcome in outcomes})
+    best = None
+    for threshold in candidates:
+        result = evaluate(outcomes, threshold)
+        if result["false_handoff"] <= args.max_false_handoff:
+            best = result
+    if best is None or best["handoff_rate"] == 0:
+        print(f"Нет порога, при котором вопросы передаются оператору и напрасных передач не больше "
+              f"{args.max_false_handoff:.3f}: оставьте OPERATOR_SCORE_THRESHOLD=0")
+        return
+    print(f"Рекомендуемый порог: OPERATOR_SCORE_THRESHOLD={best['threshold']} — к оператору без LLM "
+          f"{best['handoff_rate']:.1%} вопросов, отсекается {best['unanswerable_caught']:.1%} вопросов без ответа, "
+          f"напрасно {best['false_handoff']:.1%}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,51 @@
+import json
+import logging
+import random
+from prometheus_client import Counter, Histogram
+
+# отдельный логгер: calibrate_threshold.py находит исходы по его имени в логе шлюза
+outcome_logger = logging.getLogger("score_outcomes")
+
+HANDOFFS = Counter("chatbot_operator_handoffs_total", "Передачи вопроса оператору", ["reason"])
+GATE_DECISIONS = Counter("chatbot_score_gate_decisions_total", "Решения порога релевантности перед вызовом LLM",
+                         ["decision"])
+MAX_SCORE = Histogram("chatbot_retrieval_max_score", "Наибольшая оценка релевантности найденных чанков",
+                      buckets=tuple(i / 20 for i in range(1, 21)))
+
+ANSWER = "answer"
+HANDOFF = "handoff"
+EXPLORE = "explore"
+
+
+class ScoreGate():
+    # Передаёт вопрос оператору до вызова LLM, если ни один найденный чанк не набрал порога релевантности.
+    # Доля exploration_rate таких вопросов всё равно отправляется в LLM: без них в логе исходов нет примеров
+    # ниже порога, и откалибровать его заново нельзя
+    def __init__(self, threshold: float, exploration_rate: float = 0.0):
+        self.threshold = threshold
+        self.exploration_rate = exploration_rate
+
+    def decide(self, max_score: float | None) -> str:
+        if max_score is None:
+            # RAG не вернул оценки (например, реплика старой версии)
+            return ANSWER
+        MAX_SCORE.observe(max_score)
+        if self.threshold <= 0 or max_score >= self.threshold:
+            decision = ANSWER
+        elif random.random() < self.exploration_rate:
+            decision = EXPLORE
+        else:
+            decision = HANDOFF
+            HANDOFFS.labels("low_score").inc()
+        GATE_DECISIONS.labels(decision).inc()
+        return decision
+
+    def record(self, max_score: float | None, requires_operator: bool, decision: str):
+        # исход вызова LLM для калибровки порога: ответил ли LLM по найденному контексту
+        if requires_operator:
+            HANDOFFS.labels("llm_answer").inc()
+        if max_score is None:
+            return
+        outcome_logger.info(json.dumps({"max_score": max_score, "requires_operator": requires_operator,
+                                        "explored": decision == EXPLORE, "threshold": self.threshold,
+                                        "exploration_rate": self.exploration_rate}))
@@ -0,0 +1,66 @@
+import hashlib
+import json
+import logging
+from functools import lru_cache
+
+logger = logging.getLogger(__name__)
+
+
+# тот же подсчёт токенов, что в RAG/context.py: шлюз и RAG разворачиваются отдельными образами и общих модулей
+# не имеют. Оценки должны совпадать, потому что RAG сокращает бюджет контекста на историю, посчитанную здесь
+@lru_cache(maxsize=1)
+def get_encoding():
+    try:
+        import tiktoken
+
+        return tiktoken.get_encoding("cl100k_base")
+    except Exception as e:
+        logger.error(f"Ошибка при загрузке токенизатора tiktoken: {e}")
+        return None
+
+
+@lru_cache(maxsize=4096)
+def count_tokens(text: str) -> int:
+    encoding = get_encoding()
+    if encoding is None:
+        return len(text) // 4
+    return len(encoding.encode(text))
+
+
+def message_tokens(message: dict) -> int:
+    # служебные токены разметки сообщения в чате
+    return count_tokens(message["content"]) + 4
+
+
+def history_tokens(history: list[dict]) -> int:
+    return sum(message_tokens(message) for message in history)
+
+
+def fit_history(history: list[dict], max_tokens: int) -> list[dict]:
+    # берём реплики с конца, пока они помещаются в бюджет; история всегда начинается с вопроса пользователя,
+    # чтобы модель не получила ответ без вопроса
+    used = 0
+    fitted = []
+    for message in reversed(history):
+        tokens = message_tokens(message)
+        if used + tokens > max_tokens:
+            break
+        used += tokens
+        fitted.append(message)
+    fitted.reverse()
+    while fitted and fitted[0]["role"] != "user":
+        used -= message_tokens(fitted.pop(0))
+    if len(fitted) < len(history):
+        logger.info(f"История сокращена до {len(fitted)} из {len(history)} реплик, {used} токенов")
+    return fitted
+
+
+def history_fingerprint(history: list[dict]) -> str:
+    return hashlib.sha256(json.dumps(history, ensure_ascii=False, sort_keys=True).encode()).hexdigest()
+
+
+def search_query(query: str, history: list[dict]) -> str:
+    # уточняющий вопрос («а где оно живёт?») часто не называет существо: ищем контекст
+    # вместе с предыдущими вопросами пользователя
+    questions = [message["content"] for message in history if message["role"] == "user"]
+    return "\n".join(questions + [query])
@@ -0,0 +1,177 @@
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+import zlib
+from contextvars import ContextVar
+from datetime import datetime, timezone
+
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+# уровни отдельных логгеров: "httpx=WARNING,rag=DEBUG"
+LOG_LEVELS = os.getenv('LOG_LEVELS', 'httpx=WARNING,httpcore=WARNING,uvicorn.access=WARNING')
+# json — одна JSON-строка на запись, text — прежний текстовый формат
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'json').lower()
+LOG_TO_FILE = os.getenv('LOG_TO_FILE', 'true').lower() == 'true'
+LOG_FILE_MAX_BYTES = int(os.getenv('LOG_FILE_MAX_BYTES', str(50 * 1024 * 1024)))
+LOG_FILE_BACKUPS = int(os.getenv('LOG_FILE_BACKUPS', '3'))
+# сообщения длиннее обрезаются до записи в очередь
+LOG_MAX_MESSAGE_LENGTH = int(os.getenv('LOG_MAX_MESSAGE_LENGTH', '2000'))
+# доля записей с полными текстами (контекст, промпт, ответ модели), которые попадают в лог. Такие записи
+# пишутся с уровнем INFO, поэтому выборка работает и при уровне логов по умолчанию; 1 — писать все
+LOG_PAYLOAD_SAMPLE_RATE = float(os.getenv('LOG_PAYLOAD_SAMPLE_RATE', '0.01'))
+LOG_QUEUE_SIZE = int(os.getenv('LOG_QUEUE_SIZE', '10000'))
+
+TEXT_FORMAT = "%(asctime)s - %(name)s - %(levelname)s - [%(request_id)s] %(message)s"
+# отметка для записей с полными текстами: logger.info("Контекст: %s", context, extra=PAYLOAD)
+PAYLOAD = {"payload": True}
+
+_listener: logging.handlers.QueueListener | None = None
+
+
+class JsonFormatter(logging.Formatter):
+    def __init__(self, service: str):
+        super().__init__()
+        self.service = service
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "service": self.service,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        request_id = getattr(record, "request_id", None)
+        if request_id and request_id != "-":
+            entry["request_id"] = request_id
+        if record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False)
+
+
+class PayloadSampler(logging.Filter):
+    # Решение принимается по идентификатору запроса, а не для каждой записи: у выбранного вопроса в лог
+    # попадают все полные тексты во всех сервисах, и путь вопроса можно восстановить целиком
+    def __init__(self, rate: float):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if not getattr(record, "payload", False) or self.rate >= 1:
+            return True
+        request_id = getattr(record, "request_id", "-")
+        if request_id == "-":
+            return random.random() < self.rate
+        return zlib.crc32(request_id.encode()) / 2**32 < self.rate
+
+
+class RequestIdFilter(logging.Filter):
+    def __init__(self, request_id: ContextVar | None):
+        super().__init__()
+        self.request_id = request_id
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        # идентификатор берётся в потоке, создавшем запись: в потоке записи контекста запроса уже нет
+        record.request_id = self.request_id.get() if self.request_id is not None else "-"
+        return True
+
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    # Запись в очередь вместо файла и stdout: вызывающий поток и цикл событий не ждут диска.
+    # При переполненной очереди записи отбрасываются, а не блокируют обработку запросов
+    def __init__(self, log_queue: queue.Queue, max_length: int):
+        super().__init__(log_queue)
+        self.max_length = max_length
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        message = record.getMessage()
+        if len(message) > self.max_length:
+            message = message[:self.max_length] + f"... [обрезано {len(message) - self.max_length} символов]"
+        record = logging.makeLogRecord(record.__dict__)
+        record.msg = message
+        record.args = None
+        # трассировка форматируется здесь: объекты исключения и кадры стека не передаются в поток записи
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            if self.dropped:
+                self.queue.put_nowait(logging.makeLogRecord({
+                    "name": __name__, "levelno": logging.WARNING, "levelname": "WARNING",
+                    "msg": f"Очередь логов была переполнена, отброшено записей: {self.dropped}",
+                }))
+                self.dropped = 0
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+def parse_levels(value: str) -> dict[str, str]:
+    levels = {}
+    for item in value.split(','):
+        if '=' in item:
+            name, level = item.split('=', 1)
+            levels[name.strip()] = level.strip().upper()
+    return levels
+
+
+def stop_logging():
+    # дописывает записи из очереди и закрывает файлы; повторный вызов ничего не делает
+    global _listener
+    if _listener is None:
+        return
+    _listener.stop()
+    for handler in _listener.handlers:
+        handler.close()
+    _listener = None
+
+
+def setup_logging(service: str, log_file: str | None = None, request_id: ContextVar | None = None,
+                  force: bool = False):
+    # вызывается один раз при запуске сервиса; повторные вызовы (например, из импортированного модуля) ничего не меняют.
+    # force=True заменяет уже сделанную настройку, например в дочернем процессе, повторно импортировавшем модуль сервиса
+    global _listener
+    if _listener is not None:
+        if not force:
+            return
+        stop_logging()
+    # служебные записи обработчика очереди не проходят фильтры и идентификатора запроса не имеют
+    formatter = JsonFormatter(service) if LOG_FORMAT == 'json' else logging.Formatter(TEXT_FORMAT, defaults={"request_id": "-"})
+    handlers = [logging.StreamHandler(sys.stdout)]
+    if LOG_TO_FILE and log_file:
+        os.makedirs(os.path.dirname(log_file), exist_ok=True)
+        # размер файла ограничен: старые записи уходят в LOG_FILE_BACKUPS архивных файлов
+        handlers.append(logging.handlers.RotatingFileHandler(
+            log_file, maxBytes=LOG_FILE_MAX_BYTES, backupCount=LOG_FILE_BACKUPS, encoding='utf-8'))
+    for handler in handlers:
+        handler.setFormatter(formatter)
+
+    log_queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+    queue_handler = NonBlockingQueueHandler(log_queue, LOG_MAX_MESSAGE_LENGTH)
+    # идентификатор запроса нужен выборке полных текстов, поэтому его фильтр идёт первым
+    queue_handler.addFilter(RequestIdFilter(request_id))
+    queue_handler.addFilter(PayloadSampler(LOG_PAYLOAD_SAMPLE_RATE))
+
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(queue_handler)
+    root.setLevel(LOG_LEVEL)
+    for name, level in parse_levels(LOG_LEVELS).items():
+        logging.getLogger(name).setLevel(level)
+
+    _listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    _listener.start()
+
+
+# при остановке процесса записи из очереди дописываются до конца
+atexit.register(stop_logging)
+
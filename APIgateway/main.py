@@ -1,40 +1,123 @@
 from fastapi import FastAPI, HTTPException , Request, status
 import os 
 import logging
-import sys
 import uvicorn
 import httpx
 from pydantic import BaseModel
+from typing import Literal
 from prompts import SYSTEM_PROMPT
 from fastapi.encoders import jsonable_encoder
 from fastapi.exceptions import RequestValidationError
-from fastapi.responses import JSONResponse
-
-app = FastAPI(title = 'API Gateway')
+from fastapi.responses import JSONResponse, StreamingResponse
+import json
+import asyncio
+from contextlib import asynccontextmanager
+from upstream import UpstreamService, parse_urls
+from cache import AnswerCache
+from pipeline import EmbeddedPipeline, PipelineOverloaded, ServicePipeline
+from history import fit_history, history_fingerprint, history_tokens, search_query
+from metrics import request_id, setup_metrics, stage
+from handoff import HANDOFF, ScoreGate
+from logging_setup import PAYLOAD, setup_logging
 
 log_dir = os.path.join(os.path.dirname(__file__), 'logs')
-os.makedirs(log_dir, exist_ok=True)
-
-console_handler = logging.StreamHandler(sys.stdout)
-file_handler = logging.FileHandler(os.path.join(log_dir, 'telegram_bot.log'))
-
-logging.basicConfig(
-    level = logging.INFO,
-    handlers=[console_handler, file_handler],
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
-)
+# запись в stdout и файл выполняется в отдельном потоке, а не в цикле событий
+setup_logging('gateway', os.path.join(log_dir, 'telegram_bot.log'), request_id)
 
 logger = logging.getLogger(__name__)
 
+# services — RAG и LLM вызываются по HTTP; embedded — выполняются в процессе шлюза
+GATEWAY_MODE = os.getenv('GATEWAY_MODE', 'services').lower()
 RAG_SERVICE_URL = os.getenv('RAG_SERVICE_URL')
 LLM_SERVICE_URL = os.getenv('LLM_SERVICE_URL')
 
-if not RAG_SERVICE_URL or not LLM_SERVICE_URL :
+if GATEWAY_MODE not in ('services', 'embedded'):
+    logger.error(f"Неизвестный режим шлюза GATEWAY_MODE={GATEWAY_MODE}")
+    raise ValueError(f"Неизвестный режим шлюза GATEWAY_MODE={GATEWAY_MODE}, допустимо services или embedded")
+
+if GATEWAY_MODE == 'services' and (not RAG_SERVICE_URL or not LLM_SERVICE_URL):
     logger.error("RAG_SERVICE_URL или LLM_SERVICE_URL не найден в переменных окружения. Проверьте файл .env")
     raise ValueError("RAG_SERVICE_URL или LLM_SERVICE_URL не найден в переменных окружения. Проверьте файл .env")
 
+UPSTREAM_MAX_CONNECTIONS = int(os.getenv('UPSTREAM_MAX_CONNECTIONS', '100'))
+UPSTREAM_MAX_KEEPALIVE = int(os.getenv('UPSTREAM_MAX_KEEPALIVE', '20'))
+UPSTREAM_HTTP2 = os.getenv('UPSTREAM_HTTP2', 'false').lower() == 'true'
+CIRCUIT_FAILURE_THRESHOLD = int(os.getenv('CIRCUIT_FAILURE_THRESHOLD', '3'))
+CIRCUIT_COOLDOWN = float(os.getenv('CIRCUIT_COOLDOWN', '30'))
+RAG_SLOW_THRESHOLD = float(os.getenv('RAG_SLOW_THRESHOLD', '10'))
+LLM_SLOW_THRESHOLD = float(os.getenv('LLM_SLOW_THRESHOLD', '50'))
+ANSWER_CACHE_SIZE = int(os.getenv('ANSWER_CACHE_SIZE', '1000'))
+ANSWER_CACHE_TTL = float(os.getenv('ANSWER_CACHE_TTL', '3600'))
+# 0 отключает поиск похожих формулировок по эмбеддингам
+ANSWER_CACHE_SIMILARITY = float(os.getenv('ANSWER_CACHE_SIMILARITY', '0'))
+# путь проверки готовности реплик RAG и LLM, пустое значение отключает проверку
+UPSTREAM_READINESS_PATH = os.getenv('UPSTREAM_READINESS_PATH', '/readyz')
+READINESS_PROBE_INTERVAL = float(os.getenv('READINESS_PROBE_INTERVAL', '5'))
+# сколько токенов предыдущих реплик диалога добавляется в запрос к LLM
+HISTORY_MAX_TOKENS = int(os.getenv('HISTORY_MAX_TOKENS', '800'))
+# вопрос передаётся оператору без вызова LLM, если наибольшая оценка релевантности контекста ниже порога;
+# 0 отключает проверку. Порог подбирается по логу исходов скриптом calibrate_threshold.py
+OPERATOR_SCORE_THRESHOLD = float(os.getenv('OPERATOR_SCORE_THRESHOLD', '0'))
+# доля вопросов ниже порога, которые всё равно отправляются в LLM для повторной калибровки
+OPERATOR_SCORE_EXPLORATION = float(os.getenv('OPERATOR_SCORE_EXPLORATION', '0.05'))
+GATEWAY_BATCH_MAX_ITEMS = int(os.getenv('GATEWAY_BATCH_MAX_ITEMS', '1000'))
+# сколько вопросов пакетного запроса одновременно ждут ответа LLM
+GATEWAY_BATCH_CONCURRENCY = int(os.getenv('GATEWAY_BATCH_CONCURRENCY', '4'))
+# сколько раз повторяется вопрос, отклонённый LLM из-за перегрузки (после паузы Retry-After)
+GATEWAY_BATCH_RETRIES = int(os.getenv('GATEWAY_BATCH_RETRIES', '3'))
+
+answer_cache = AnswerCache(max_size=ANSWER_CACHE_SIZE, ttl=ANSWER_CACHE_TTL, similarity_threshold=ANSWER_CACHE_SIMILARITY)
+score_gate = ScoreGate(OPERATOR_SCORE_THRESHOLD, OPERATOR_SCORE_EXPLORATION)
+HANDOFF_RESPONSE = "Вопрос передан оператору"
+
+def create_upstream(name: str, urls: str, slow_threshold: float) -> UpstreamService:
+    return UpstreamService(
+        name,
+        parse_urls(urls),
+        slow_threshold=slow_threshold,
+        failure_threshold=CIRCUIT_FAILURE_THRESHOLD,
+        cooldown=CIRCUIT_COOLDOWN,
+        max_connections=UPSTREAM_MAX_CONNECTIONS,
+        max_keepalive=UPSTREAM_MAX_KEEPALIVE,
+        http2=UPSTREAM_HTTP2,
+        readiness_path=UPSTREAM_READINESS_PATH or None,
+    )
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    probes = []
+    if GATEWAY_MODE == 'embedded':
+        # загрузка модели эмбеддингов и индекса блокирует, поэтому выполняется в отдельном потоке
+        logger.info("Шлюз запущен во встроенном режиме: RAG и LLM работают в этом процессе")
+        app.state.pipeline = await asyncio.to_thread(EmbeddedPipeline)
+    else:
+        # долгоживущие клиенты с пулом соединений на каждый сервис
+        rag = create_upstream('rag', RAG_SERVICE_URL, RAG_SLOW_THRESHOLD)
+        llm = create_upstream('llm', LLM_SERVICE_URL, LLM_SLOW_THRESHOLD)
+        logger.info(f"Реплики RAG: {[r.url for r in rag.replicas]}, реплики LLM: {[r.url for r in llm.replicas]}")
+        app.state.pipeline = ServicePipeline(rag, llm)
+        # первая проверка до приёма запросов, дальше — в фоне: запросы идут только на прогретые реплики
+        await asyncio.gather(rag.probe_readiness(), llm.probe_readiness())
+        probes = [asyncio.create_task(upstream.run_readiness_probes(READINESS_PROBE_INTERVAL)) for upstream in (rag, llm)]
+    yield
+    for probe in probes:
+        probe.cancel()
+    await app.state.pipeline.aclose()
+
+app = FastAPI(title = 'API Gateway', lifespan=lifespan)
+setup_metrics(app, 'gateway')
+
+class HistoryMessage(BaseModel):
+    role: Literal['user', 'assistant']
+    content: str
+
 class QueryRequest(BaseModel):
     query: str
+    # последние реплики диалога в хронологическом порядке
+    history: list[HistoryMessage] = []
+
+    def fitted_history(self) -> list[dict]:
+        return fit_history([message.model_dump() for message in self.history], HISTORY_MAX_TOKENS)
 
 @app.exception_handler(RequestValidationError)
 async def validation_exception_handler(request: Request, exc: RequestValidationError):
@@ -43,59 +126,287 @@ async def validation_exception_handler(request: Request, exc: RequestValidationE
         content=jsonable_encoder({"detail": exc.errors(), "body": exc.body}),
     )
 
+class BatchRequest(BaseModel):
+    queries: list[QueryRequest]
+
 class QueryResponse(BaseModel):
     response: str
 
+@app.get('/livez')
+async def livez():
+    return {"status": "alive"}
+
+@app.get('/readyz')
+async def readyz():
+    # готов, если есть хотя бы одна готовая реплика RAG и LLM
+    ready = app.state.pipeline.is_ready()
+    return JSONResponse(status_code=200 if ready else 503, content={"status": "ready" if ready else "not_ready"})
+
+@app.get('/upstreams')
+async def upstream_stats():
+    return app.state.pipeline.stats()
+
+@app.get('/cache/stats')
+async def cache_stats():
+    return answer_cache.stats()
+
+def sse_event(payload: dict) -> str:
+    return f"data: {json.dumps(payload, ensure_ascii=False)}\n\n"
+
+def needs_operator(response: str) -> bool:
+    no_answer = "не могу ответить"
+    if no_answer in response.lower():
+        logger.info(f"Ответ содержит фразу, указывающую на неполный ответ: {response}")
+        return True
+    return False
+
+def overloaded_exception(e: PipelineOverloaded) -> HTTPException:
+    # LLM отклоняет запросы сверх лимитов сразу; пробрасываем 429/503 и Retry-After клиенту,
+    # чтобы он повторил запрос позже, а не получил ошибку сервера
+    logger.warning(f"LLM отклонил запрос: {e.detail}")
+    headers = {"Retry-After": e.retry_after} if e.retry_after else None
+    return HTTPException(status_code=e.status_code, detail=e.detail, headers=headers)
+
+def cache_context(context: str, history: list[dict]) -> str:
+    # один и тот же вопрос в разных диалогах может требовать разных ответов
+    return f"{context}\0{history_fingerprint(history)}" if history else context
+
+async def fetch_context(query: str, history: list[dict] = None) -> dict:
+    logger.info(f"Отправлен запрос к RAG: {query}")
+    lookup = search_query(query, history) if history else None
+    with stage("rag"):
+        rag_result = await app.state.pipeline.retrieve(query, answer_cache.semantic_enabled, lookup,
+                                                       history_tokens(history) if history else 0)
+    query_with_context = rag_result.get("query_with_context")
+    if not query_with_context:
+            logger.error("RAG не вернул query_with_context")
+            raise HTTPException(status_code=500, detail="RAG вернул некорректный ответ")
+    logger.info("Получен ответ от RAG: %s", query_with_context, extra=PAYLOAD)
+    rag_result.setdefault("context", query_with_context)
+    if rag_result.get("index_version"):
+        answer_cache.check_version(rag_result["index_version"])
+    return rag_result
+
+async def answer_query(query: str, rag_result: dict, history: list[dict]) -> dict:
+    context = cache_context(rag_result["context"], history)
+    query_embedding = rag_result.get("query_embedding")
+    cached = answer_cache.get(query, context, query_embedding)
+    if cached is not None:
+        logger.info("Ответ найден в кэше, запрос к LLM пропущен")
+        return cached
+    decision = score_gate.decide(rag_result.get("max_score"))
+    if decision == HANDOFF:
+        logger.info(f"Релевантность контекста {rag_result['max_score']} ниже порога, вопрос передан оператору без LLM")
+        return {"response": HANDOFF_RESPONSE, "requires_operator": True}
+
+    logger.info("Отправлен запрос к LLM")
+    with stage("llm"):
+        result = await app.state.pipeline.generate(rag_result["query_with_context"], SYSTEM_PROMPT, history)
+    response = result.get("response")
+    requires_operator = result.get("requires_operator", False)
+
+    if not response:
+        logger.error("LLM не вернул response")
+        raise HTTPException(status_code=500, detail="LLM вернул некорректный ответ")
+
+    if requires_operator is False:
+        requires_operator = needs_operator(response)
+    score_gate.record(rag_result.get("max_score"), requires_operator, decision)
+    logger.info("Получен ответ от LLM: %s", response, extra=PAYLOAD)
+    result = {"response": response, "requires_operator": requires_operator}
+    answer_cache.put(query, context, result, query_embedding)
+    return result
+
 @app.post('/query')
 async def send_query(request:QueryRequest):
     try:
-        logger.info(f"Отправлен запрос к RAG: {request}")
-        async with httpx.AsyncClient() as client:
-            response = await client.post(
-                f"{RAG_SERVICE_URL}/query",
-                json={"query": request.query},
-                timeout=15.0
-            )
-            response.raise_for_status()
-            query_with_context = response.json().get("query_with_context")
-            if not query_with_context:
-                    logger.error("RAG не вернул query_with_context")
-                    raise HTTPException(status_code=500, detail="RAG вернул некорректный ответ")
-            logger.info(f"Получен ответ от RAG: {query_with_context}")
-
-            logger.info("Отправлен запрос к LLM")
-            llm_response = await client.post(
-                f"{LLM_SERVICE_URL}/generate_answer",
-                json={"query_with_context": query_with_context,
-                    "system_prompt": SYSTEM_PROMPT},
-                timeout=60.0
-            )
-            llm_response.raise_for_status()
-            result = llm_response.json()
-            response = llm_response.json().get("response")
-            requires_operator = result.get("requires_operator", False)
-            
-            if not response:
-                logger.error("LLM не вернул response")
-                raise HTTPException(status_code=500, detail="LLM вернул некорректный ответ")
-            
-            if requires_operator is False:  
-                no_answer = "не могу ответить"
-                if no_answer in response.lower():
-                    requires_operator = True
-                    logger.info(f"Ответ содержит фразу, указывающую на неполный ответ: {response}")
-                logger.info(f"Получен ответ от LLM: {response}")
-                return {"response": response, "requires_operator": requires_operator}
+        history = request.fitted_history()
+        rag_result = await fetch_context(request.query, history)
+        return await answer_query(request.query, rag_result, history)
+    except PipelineOverloaded as e:
+        raise overloaded_exception(e)
+    except HTTPException:
+        raise
     except ValueError as e:
         logger.error(f"Ошибка валидации запроса: {e}")
         raise HTTPException(status_code=400, detail=str(e))  
-    except TimeoutError as e:
+    except (TimeoutError, httpx.TimeoutException) as e:
+        logger.error(f"Ошибка таймаута: {e}")
+        raise HTTPException(status_code=504, detail="Время ожидания запроса истекло")
+    except Exception as e:
+        logger.error(f"Ошибка: {e}")
+        raise HTTPException(status_code=500, detail='Ошибка сервера')
+
+@app.post('/query/stream')
+async def send_query_stream(request:QueryRequest):
+    # ответ LLM передаётся клиенту по мере генерации в виде server-sent events:
+    # {"delta": ...} для фрагментов текста, затем {"done": true, "requires_operator": ...} или {"error": ...}
+    history = request.fitted_history()
+    try:
+        rag_result = await fetch_context(request.query, history)
+    except ValueError as e:
+        logger.error(f"Ошибка валидации запроса: {e}")
+        raise HTTPException(status_code=400, detail=str(e))
+    except (TimeoutError, httpx.TimeoutException) as e:
         logger.error(f"Ошибка таймаута: {e}")
         raise HTTPException(status_code=504, detail="Время ожидания запроса истекло")
     except Exception as e:
         logger.error(f"Ошибка: {e}")
         raise HTTPException(status_code=500, detail='Ошибка сервера')
-    
+
+    context = cache_context(rag_result["context"], history)
+    query_embedding = rag_result.get("query_embedding")
+    cached = answer_cache.get(request.query, context, query_embedding)
+    decision = score_gate.decide(rag_result.get("max_score")) if cached is None else None
+
+    async def events():
+        if cached is not None:
+            logger.info("Ответ найден в кэше, запрос к LLM пропущен")
+            yield sse_event({"delta": cached["response"]})
+            yield sse_event({"done": True, "requires_operator": cached["requires_operator"]})
+            return
+        if decision == HANDOFF:
+            logger.info(f"Релевантность контекста {rag_result['max_score']} ниже порога, вопрос передан оператору без LLM")
+            yield sse_event({"done": True, "requires_operator": True})
+            return
+
+        answer_parts = []
+        try:
+            logger.info("Отправлен потоковый запрос к LLM")
+            with stage("llm"):
+                async for delta in app.state.pipeline.stream(rag_result["query_with_context"], SYSTEM_PROMPT, history):
+                    answer_parts.append(delta)
+                    yield sse_event({"delta": delta})
+        except PipelineOverloaded as e:
+            logger.warning(f"LLM отклонил потоковый запрос: {e.detail}, Retry-After {e.retry_after}")
+            yield sse_event({"error": "Сервис перегружен, повторите запрос позже", "retry_after": e.retry_after})
+            return
+        except Exception as e:
+            logger.error(f"Ошибка стриминга ответа LLM: {e}")
+            yield sse_event({"error": "Ошибка сервера"})
+            return
+
+        response = "".join(answer_parts)
+        if not response:
+            logger.error("LLM не вернул response")
+            yield sse_event({"error": "LLM вернул некорректный ответ"})
+            return
+        requires_operator = needs_operator(response)
+        score_gate.record(rag_result.get("max_score"), requires_operator, decision)
+        logger.info("Получен ответ от LLM: %s", response, extra=PAYLOAD)
+        answer_cache.put(request.query, context, {"response": response, "requires_operator": requires_operator}, query_embedding)
+        yield sse_event({"done": True, "requires_operator": requires_operator})
+
+    return StreamingResponse(events(), media_type="text/event-stream")
+
+def batch_error(index: int, e: Exception) -> dict:
+    if isinstance(e, PipelineOverloaded):
+        return {"index": index, "error": e.detail, "status": e.status_code, "retry_after": e.retry_after}
+    if isinstance(e, HTTPException):
+        return {"index": index, "error": e.detail, "status": e.status_code}
+    if isinstance(e, ValueError):
+        return {"index": index, "error": str(e), "status": 400}
+    if isinstance(e, (TimeoutError, httpx.TimeoutException)):
+        return {"index": index, "error": "Время ожидания запроса истекло", "status": 504}
+    if isinstance(e, httpx.HTTPStatusError):
+        return {"index": index, "error": str(e), "status": e.response.status_code}
+    return {"index": index, "error": "Ошибка сервера", "status": 500}
+
+async def answer_batch_item(request: QueryRequest, history: list[dict], rag_result: dict,
+                            limit: asyncio.Semaphore) -> dict:
+    index = rag_result["index"]
+    if "error" in rag_result:
+        logger.warning(f"RAG не нашёл контекст для элемента {index}: {rag_result['error']}")
+        return {"index": index, "error": rag_result["error"], "status": 400 if not request.query.strip() else 500}
+    query_with_context = rag_result.get("query_with_context")
+    if not query_with_context:
+        logger.error("RAG не вернул query_with_context")
+        return {"index": index, "error": "RAG вернул некорректный ответ", "status": 500}
+    rag_result.setdefault("context", query_with_context)
+    if rag_result.get("index_version"):
+        answer_cache.check_version(rag_result["index_version"])
+    for attempt in range(GATEWAY_BATCH_RETRIES + 1):
+        try:
+            # число одновременных запросов к LLM ограничено, чтобы пакет не занял все его слоты
+            async with limit:
+                result = await answer_query(request.query, rag_result, history)
+            return {"index": index, **result}
+        except PipelineOverloaded as e:
+            if attempt == GATEWAY_BATCH_RETRIES:
+                logger.warning(f"LLM отклонил элемент {index} пакета после {attempt + 1} попыток: {e.detail}")
+                return batch_error(index, e)
+            await asyncio.sleep(float(e.retry_after or 1))
+        except Exception as e:
+            logger.error(f"Ошибка элемента {index} пакета: {e}")
+            return batch_error(index, e)
+
+@app.post('/query/batch')
+async def send_query_batch(request: BatchRequest):
+    # контексты всех вопросов ищутся одним пакетным запросом к RAG, запросы к LLM выполняются параллельно
+    # (не больше GATEWAY_BATCH_CONCURRENCY). Ответы отдаются построчно в формате NDJSON по мере готовности:
+    # {"index": ..., "response": ..., "requires_operator": ...} или {"index": ..., "error": ..., "status": ...},
+    # где index — номер вопроса в запросе. Ошибка отдельного вопроса не прерывает пакет
+    if len(request.queries) > GATEWAY_BATCH_MAX_ITEMS:
+        raise HTTPException(status_code=413, detail=f"В пакете больше {GATEWAY_BATCH_MAX_ITEMS} вопросов")
+    histories = [item.fitted_history() for item in request.queries]
+    items = [{"query": item.query, "search_query": search_query(item.query, history) if history else None,
+              "history_tokens": history_tokens(history)}
+             for item, history in zip(request.queries, histories)]
+    logger.info(f"Пакетный запрос: {len(items)} вопросов")
+    results: asyncio.Queue = asyncio.Queue()
+    limit = asyncio.Semaphore(GATEWAY_BATCH_CONCURRENCY)
+
+    async def answer(index: int, rag_result: dict):
+        results.put_nowait(await answer_batch_item(request.queries[index], histories[index], rag_result, limit))
+
+    async def produce():
+        tasks = []
+        seen = set()
+        try:
+            try:
+                with stage("rag"):
+                    async for rag_result in app.state.pipeline.retrieve_batch(items):
+                        index = rag_result["index"]
+                        if index in seen or not 0 <= index < len(items):
+                            logger.warning(f"RAG вернул лишний элемент пакета: {index}")
+                            continue
+                        seen.add(index)
+                        tasks.append(asyncio.create_task(answer(index, rag_result)))
+            except Exception as e:
+                # RAG недоступен или оборвал ответ: вопросы без контекста завершаются ошибкой, остальные дорабатывают
+                logger.error(f"Ошибка пакетного запроса к RAG: {e}")
+                for index in range(len(items)):
+                    if index not in seen:
+                        seen.add(index)
+                        results.put_nowait(batch_error(index, e))
+            await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+            # признак завершения: вопросы, по которым ответа так и не было, lines() отдаст с ошибкой
+            results.put_nowait(None)
+
+    async def lines():
+        producer = asyncio.create_task(produce())
+        emitted = set()
+        try:
+            while len(emitted) < len(items):
+                result = await results.get()
+                if result is None:
+                    missing = [index for index in range(len(items)) if index not in emitted]
+                    logger.error(f"Пакет завершился без ответов на {len(missing)} вопросов")
+                    for index in missing:
+                        error = HTTPException(status_code=502, detail="Не получен ответ на вопрос")
+                        yield json.dumps(batch_error(index, error), ensure_ascii=False) + "\n"
+                    break
+                emitted.add(result["index"])
+                yield json.dumps(result, ensure_ascii=False) + "\n"
+        finally:
+            # клиент отключился: незавершённые запросы к RAG и LLM отменяются
+            producer.cancel()
+
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
+
 if __name__=='__main__':
-    uvicorn.run("main:app", host="0.0.0.0", port=8002)
+    uvicorn.run("main:app", host="0.0.0.0", port=8002, log_config=None)
 
@@ -0,0 +1,190 @@
+import json
+import logging
+import os
+import sys
+from typing import AsyncIterator
+from upstream import UpstreamService
+
+logger = logging.getLogger(__name__)
+
+GATEWAY_DIR = os.path.dirname(os.path.abspath(__file__))
+RAG_DIR = os.getenv('EMBEDDED_RAG_DIR', os.path.join(GATEWAY_DIR, '..', 'RAG'))
+LLM_DIR = os.getenv('EMBEDDED_LLM_DIR', os.path.join(GATEWAY_DIR, '..', 'LLM'))
+
+
+class PipelineOverloaded(Exception):
+    # LLM отклонил запрос сверх лимитов: 429 или 503 с рекомендуемой паузой перед повтором
+    def __init__(self, status_code: int, retry_after: str | None, detail: str):
+        super().__init__(detail)
+        self.status_code = status_code
+        self.retry_after = retry_after
+        self.detail = detail
+
+
+class ServicePipeline():
+    # режим по умолчанию: RAG и LLM — отдельные сервисы, запросы к ним идут по HTTP
+    mode = "services"
+
+    def __init__(self, rag: UpstreamService, llm: UpstreamService):
+        self.rag = rag
+        self.llm = llm
+
+    async def retrieve(self, query: str, return_embedding: bool, search_query: str = None, history_tokens: int = 0) -> dict:
+        response = await self.rag.post(
+            "/query",
+            json={"query": query, "return_embedding": return_embedding, "search_query": search_query,
+                  "history_tokens": history_tokens},
+            timeout=15.0
+        )
+        response.raise_for_status()
+        return response.json()
+
+    async def retrieve_batch(self, items: list[dict]) -> AsyncIterator[dict]:
+        # RAG отдаёт результаты построчно (NDJSON) в порядке готовности, элемент определяется полем index
+        async with self.rag.stream("/query/batch", json={"items": items}, timeout=60.0) as rag_response:
+            if rag_response.status_code != 200:
+                await rag_response.aread()
+            rag_response.raise_for_status()
+            async for line in rag_response.aiter_lines():
+                if line:
+                    yield json.loads(line)
+
+    async def generate(self, query_with_context: str, system_prompt: str, history: list[dict] = None) -> dict:
+        response = await self.llm.post(
+            "/generate_answer",
+            json={"query_with_context": query_with_context,
+                "system_prompt": system_prompt,
+                "history": history or []},
+            timeout=60.0
+        )
+        if response.status_code in (429, 503):
+            raise PipelineOverloaded(response.status_code, response.headers.get("Retry-After"),
+                                     response.json().get("detail", "Сервис перегружен"))
+        response.raise_for_status()
+        return response.json()
+
+    async def stream(self, query_with_context: str, system_prompt: str, history: list[dict] = None) -> AsyncIterator[str]:
+        async with self.llm.stream(
+            "/generate_answer/stream",
+            json={"query_with_context": query_with_context,
+                "system_prompt": system_prompt,
+                "history": history or []},
+            timeout=60.0
+        ) as llm_response:
+            if llm_response.status_code in (429, 503):
+                await llm_response.aread()
+                raise PipelineOverloaded(llm_response.status_code, llm_response.headers.get("Retry-After"),
+                                         llm_response.json().get("detail", "Сервис перегружен"))
+            llm_response.raise_for_status()
+            async for line in llm_response.aiter_lines():
+                if not line.startswith("data:"):
+                    continue
+                event = json.loads(line[len("data:"):])
+                if "error" in event and "retry_after" in event:
+                    # очередь LLM заполнилась, пока запрос ждал слота: ответ уже начат, поэтому отказ приходит событием
+                    raise PipelineOverloaded(event.get("status", 503), str(event["retry_after"]), event["error"])
+                if "error" in event:
+                    raise RuntimeError(event["error"])
+                if event.get("delta"):
+                    yield event["delta"]
+
+    def is_ready(self) -> bool:
+        return self.rag.is_ready() and self.llm.is_ready()
+
+    def stats(self) -> dict:
+        return {"mode": self.mode, "rag": self.rag.stats(), "llm": self.llm.stats()}
+
+    async def aclose(self):
+        await self.rag.aclose()
+        await self.llm.aclose()
+
+
+class EmbeddedPipeline():
+    # поиск контекста и генерация выполняются в процессе шлюза, без HTTP-запросов к RAG и LLM.
+    # Модули сервисов импортируются из соседних папок репозитория, поэтому нужны зависимости всех трёх сервисов.
+    # Папки добавляются в конец sys.path: модуль prompts берётся из шлюза, и RAG считает бюджет токенов
+    # по тому же системному промпту, который уходит в LLM
+    mode = "embedded"
+
+    def __init__(self):
+        for path in (RAG_DIR, LLM_DIR):
+            if path not in sys.path:
+                sys.path.append(path)
+        from dotenv import load_dotenv
+        from rag import RAG
+        from limiter import ConcurrencyLimiter, SingleFlight
+        from router import create_router
+
+        load_dotenv(os.path.join(LLM_DIR, '.env'))
+        queue_timeout = float(os.getenv('LLM_QUEUE_TIMEOUT', '30'))
+        self.rag = RAG(knowledge_base=os.path.join(RAG_DIR, 'knowledge_base'))
+        self.rag.warm_up()
+        self.router = create_router(max_wait=queue_timeout)
+        self.single_flight = SingleFlight()
+        self.limiter = ConcurrencyLimiter(int(os.getenv('LLM_MAX_CONCURRENT', '4')),
+                                          int(os.getenv('LLM_MAX_QUEUE', '32')), queue_timeout)
+
+    async def retrieve(self, query: str, return_embedding: bool, search_query: str = None, history_tokens: int = 0) -> dict:
+        if not query.strip():
+            raise ValueError("Некорректный запрос. Пользователь отправил пустой запрос")
+        embedding = await self.rag.embed_query(query) if return_embedding else None
+        search_text = self.rag.search_text(query, search_query)
+        context, scores = await self.rag.retrieve_context(search_text, embedding=embedding if search_text == query else None,
+                                                          history_tokens=history_tokens)
+        result = {
+            "query_with_context": self.rag.build_query_with_context(query, context, history_tokens),
+            "context": context,
+            "index_version": self.rag.index_version,
+            **self.rag.relevance(scores),
+        }
+        if return_embedding:
+            result["query_embedding"] = embedding
+        return result
+
+    async def retrieve_batch(self, items: list[dict]) -> AsyncIterator[dict]:
+        async for result in self.rag.query_batch([(item["query"], item.get("search_query"), item.get("history_tokens", 0))
+                                                  for item in items]):
+            yield result
+
+    async def _complete(self, system_prompt: str, user_content: str, history: list[dict]) -> str:
+        slot = await self.limiter.acquire()
+        try:
+            return await self.router.complete(system_prompt, user_content, history)
+        finally:
+            self.limiter.release(slot)
+
+    async def generate(self, query_with_context: str, system_prompt: str, history: list[dict] = None) -> dict:
+        from limiter import Overloaded
+        from router import prompt_key
+
+        history = history or []
+        key = prompt_key(system_prompt, query_with_context, history)
+        try:
+            response = await self.single_flight.do(key, lambda: self._complete(system_prompt, query_with_context, history))
+        except Overloaded as e:
+            raise PipelineOverloaded(e.status_code, str(e.retry_after), e.detail)
+        return {"response": response}
+
+    async def stream(self, query_with_context: str, system_prompt: str, history: list[dict] = None) -> AsyncIterator[str]:
+        from limiter import Overloaded
+
+        try:
+            self.router.ensure_capacity()
+            slot = await self.limiter.acquire()
+        except Overloaded as e:
+            raise PipelineOverloaded(e.status_code, str(e.retry_after), e.detail)
+        try:
+            async for text in self.router.stream_text(system_prompt, query_with_context, history or []):
+                yield text
+        finally:
+            self.limiter.release(slot)
+
+    def is_ready(self) -> bool:
+        # RAG создаётся и прогревается до того, как шлюз начинает принимать запросы
+        return True
+
+    def stats(self) -> dict:
+        return {"mode": self.mode, "llm": self.router.stats(), "limits": self.limiter.stats()}
+
+    async def aclose(self):
+        pass
@@ -0,0 +1,183 @@
+import asyncio
+import logging
+import random
+import time
+from contextlib import asynccontextmanager
+from typing import AsyncIterator
+import httpx
+from metrics import REQUEST_ID_HEADER, request_id
+
+logger = logging.getLogger(__name__)
+
+
+class NoReplicaAvailableError(Exception):
+    pass
+
+
+def parse_urls(value: str) -> list[str]:
+    # RAG_SERVICE_URL / LLM_SERVICE_URL могут содержать несколько реплик через запятую
+    return [url.strip().rstrip('/') for url in value.split(',') if url.strip()]
+
+
+class Replica():
+    def __init__(self, url: str):
+        self.url = url
+        self.outstanding = 0
+        self.failures = 0
+        self.opened_at = None
+        self.trial_in_flight = False
+        # результат последней проверки готовности; реплика, которая ещё загружает модель, запросов не получает
+        self.ready = True
+
+    def is_available(self, now: float, cooldown: float) -> bool:
+        if self.opened_at is None:
+            return True
+        # полуоткрытое состояние: после паузы пропускаем один пробный запрос
+        return now - self.opened_at >= cooldown and not self.trial_in_flight
+
+    def stats(self) -> dict:
+        return {
+            "url": self.url,
+            "outstanding": self.outstanding,
+            "failures": self.failures,
+            "ejected": self.opened_at is not None,
+            "ready": self.ready,
+        }
+
+
+class UpstreamService():
+    def __init__(self, name: str, urls: list[str], slow_threshold: float,
+                 failure_threshold: int = 3, cooldown: float = 30.0,
+                 max_connections: int = 100, max_keepalive: int = 20, http2: bool = False,
+                 readiness_path: str | None = None):
+        if not urls:
+            raise ValueError(f"Не заданы адреса реплик для сервиса {name}")
+        self.name = name
+        self.replicas = [Replica(url) for url in urls]
+        self.slow_threshold = slow_threshold
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.readiness_path = readiness_path
+        self.client = httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_keepalive),
+            http2=http2,
+            event_hooks={"request": [self._add_request_id]},
+        )
+
+    async def _add_request_id(self, request: httpx.Request):
+        # идентификатор запроса пользователя передаётся дальше, чтобы связать этапы в логах всех сервисов
+        request.headers[REQUEST_ID_HEADER] = request_id.get()
+
+    def _pick(self, exclude: set) -> Replica:
+        now = time.monotonic()
+        candidates = [r for r in self.replicas if r not in exclude and r.ready and r.is_available(now, self.cooldown)]
+        if not candidates:
+            # все реплики выключены предохранителем: пробуем ту, что выключена дольше всех,
+            # чтобы не отказывать полностью
+            candidates = sorted((r for r in self.replicas if r not in exclude), key=lambda r: r.opened_at or 0)[:1]
+        if not candidates:
+            raise NoReplicaAvailableError(f"Нет доступных реплик сервиса {self.name}")
+        least = min(r.outstanding for r in candidates)
+        replica = random.choice([r for r in candidates if r.outstanding == least])
+        if replica.opened_at is not None:
+            replica.trial_in_flight = True
+        return replica
+
+    def _record_success(self, replica: Replica, elapsed: float):
+        if elapsed > self.slow_threshold:
+            logger.warning(f"{self.name}: медленный ответ реплики {replica.url} ({elapsed:.2f} c)")
+            self._record_failure(replica)
+            return
+        if replica.opened_at is not None:
+            logger.info(f"{self.name}: реплика {replica.url} возвращена в работу")
+        replica.failures = 0
+        replica.opened_at = None
+        replica.trial_in_flight = False
+
+    def _record_failure(self, replica: Replica):
+        replica.failures += 1
+        replica.trial_in_flight = False
+        if replica.opened_at is not None or replica.failures >= self.failure_threshold:
+            if replica.opened_at is None:
+                logger.warning(f"{self.name}: реплика {replica.url} исключена после {replica.failures} ошибок")
+            replica.opened_at = time.monotonic()
+
+    async def post(self, path: str, **kwargs) -> httpx.Response:
+        tried = set()
+        while True:
+            replica = self._pick(tried)
+            tried.add(replica)
+            replica.outstanding += 1
+            start = time.monotonic()
+            try:
+                response = await self.client.post(f"{replica.url}{path}", **kwargs)
+            except httpx.ConnectError as e:
+                # запрос не был отправлен, поэтому его безопасно повторить на другой реплике
+                self._record_failure(replica)
+                if len(tried) >= len(self.replicas):
+                    raise
+                logger.warning(f"{self.name}: реплика {replica.url} недоступна ({e}), пробуем другую")
+                continue
+            except httpx.TransportError:
+                self._record_failure(replica)
+                raise
+            finally:
+                replica.outstanding -= 1
+                # пробный запрос к исключённой реплике мог быть отменён (клиент отключился) или завершиться
+                # ошибкой, которая не учитывается предохранителем: следующий запрос снова может стать пробным
+                replica.trial_in_flight = False
+
+            if response.status_code >= 500:
+                self._record_failure(replica)
+            else:
+                self._record_success(replica, time.monotonic() - start)
+            return response
+
+    @asynccontextmanager
+    async def stream(self, path: str, **kwargs) -> AsyncIterator[httpx.Response]:
+        # для потоковых ответов медленность реплики оценивается по времени до получения заголовков
+        replica = self._pick(set())
+        replica.outstanding += 1
+        start = time.monotonic()
+        try:
+            async with self.client.stream("POST", f"{replica.url}{path}", **kwargs) as response:
+                if response.status_code >= 500:
+                    self._record_failure(replica)
+                else:
+                    self._record_success(replica, time.monotonic() - start)
+                yield response
+        except httpx.TransportError:
+            self._record_failure(replica)
+            raise
+        finally:
+            replica.outstanding -= 1
+            replica.trial_in_flight = False
+
+    def is_ready(self) -> bool:
+        return any(replica.ready for replica in self.replicas)
+
+    async def _probe_replica(self, replica: Replica):
+        try:
+            response = await self.client.get(f"{replica.url}{self.readiness_path}", timeout=2.0)
+            ready = response.status_code == 200
+        except httpx.HTTPError:
+            ready = False
+        if ready != replica.ready:
+            logger.info(f"{self.name}: реплика {replica.url} {'готова' if ready else 'не готова'} к запросам")
+        replica.ready = ready
+
+    async def probe_readiness(self):
+        if not self.readiness_path:
+            return
+        await asyncio.gather(*(self._probe_replica(replica) for replica in self.replicas))
+
+    async def run_readiness_probes(self, interval: float):
+        while True:
+            await self.probe_readiness()
+            await asyncio.sleep(interval)
+
+    def stats(self) -> list[dict]:
+        return [replica.stats() for replica in self.replicas]
+
+    async def aclose(self):
+        await self.client.aclose()
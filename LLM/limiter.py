@@ -0,0 +1,130 @@
+import asyncio
+import itertools
+import logging
+import math
+import time
+from typing import Any, Awaitable, Callable
+
+logger = logging.getLogger(__name__)
+
+
+class Overloaded(Exception):
+    # Запрос отклонён без обращения к провайдеру: 429 — исчерпан лимит частоты, 503 — переполнена очередь
+    def __init__(self, status_code: int, retry_after: float, detail: str):
+        super().__init__(detail)
+        self.status_code = status_code
+        self.retry_after = max(1, math.ceil(retry_after))
+        self.detail = detail
+
+
+class SingleFlight():
+    # Одинаковые одновременные запросы разделяют один вызов провайдера. Вызов выполняется отдельной
+    # задачей, поэтому отключение клиента, который его начал, не отменяет ответ для остальных
+    def __init__(self):
+        self._calls: dict[str, asyncio.Task] = {}
+        self.coalesced = 0
+
+    async def do(self, key: str, fn: Callable[[], Awaitable[Any]]) -> Any:
+        task = self._calls.get(key)
+        if task is None:
+            task = asyncio.create_task(fn())
+            self._calls[key] = task
+            task.add_done_callback(lambda done: self._finish(key, done))
+        else:
+            self.coalesced += 1
+            logger.info(f"Запрос присоединён к уже выполняющемуся вызову LLM ({self.coalesced} всего)")
+        return await asyncio.shield(task)
+
+    def _finish(self, key: str, task: asyncio.Task):
+        if self._calls.get(key) is task:
+            del self._calls[key]
+        if not task.cancelled():
+            task.exception()
+
+    def in_flight(self) -> int:
+        return len(self._calls)
+
+
+class TokenBucket():
+    # Ограничение частоты запросов к провайдеру. Токены резервируются в порядке обращения,
+    # так что ожидающие обслуживаются честно, по очереди
+    def __init__(self, rate_per_minute: float, burst: int, max_wait: float):
+        self.rate = rate_per_minute / 60
+        self.capacity = burst
+        self.max_wait = max_wait
+        self.tokens = float(burst)
+        self.updated_at = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def wait_time(self) -> float:
+        self._refill()
+        return max(0.0, (1 - self.tokens) / self.rate)
+
+    async def acquire(self):
+        wait = self.wait_time()
+        if wait > self.max_wait:
+            raise Overloaded(429, wait, "Превышен лимит запросов к модели")
+        self.tokens -= 1
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+
+class ConcurrencyLimiter():
+    # Не больше max_concurrent одновременных вызовов провайдера и не больше max_queue ожидающих.
+    # Очередь asyncio.Semaphore обслуживается в порядке поступления
+    def __init__(self, max_concurrent: int, max_queue: int, queue_timeout: float):
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self._semaphore = asyncio.Semaphore(max_concurrent)
+        self.waiting = 0
+        self.active = 0
+        self.rejected = 0
+        # скользящее среднее длительности вызова, по нему оценивается Retry-After
+        self.avg_duration = 10.0
+        self._started: dict[int, float] = {}
+        self._tokens = itertools.count()
+
+    def retry_after(self) -> float:
+        return self.avg_duration * (self.waiting + 1) / self.max_concurrent
+
+    def check(self):
+        # отказ без ожидания, если очередь уже заполнена: так его можно вернуть кодом 503 до начала потокового ответа
+        if self._semaphore.locked() and self.waiting >= self.max_queue:
+            self.rejected += 1
+            raise Overloaded(503, self.retry_after(), "Очередь запросов к модели переполнена")
+
+    async def acquire(self) -> int:
+        self.check()
+        self.waiting += 1
+        try:
+            await asyncio.wait_for(self._semaphore.acquire(), self.queue_timeout)
+        except asyncio.TimeoutError:
+            self.rejected += 1
+            raise Overloaded(503, self.retry_after(), "Истекло время ожидания в очереди запросов к модели")
+        finally:
+            self.waiting -= 1
+        self.active += 1
+        token = next(self._tokens)
+        self._started[token] = time.monotonic()
+        return token
+
+    def release(self, token: int):
+        duration = time.monotonic() - self._started.pop(token)
+        self.avg_duration = 0.8 * self.avg_duration + 0.2 * duration
+        self.active -= 1
+        self._semaphore.release()
+
+    def stats(self) -> dict:
+        return {
+            "active": self.active,
+            "waiting": self.waiting,
+            "max_concurrent": self.max_concurrent,
+            "max_queue": self.max_queue,
+            "rejected": self.rejected,
+            "avg_duration": round(self.avg_duration, 3),
+        }
@@ -1,20 +1,33 @@
 from dotenv import load_dotenv
 import os
-import sys
 import logging
+import time
 from fastapi import FastAPI, HTTPException, Request, status
 import uvicorn
 from pydantic import BaseModel
-from openai import AsyncOpenAI, Timeout
+from typing import Literal
+from openai import Timeout
 from fastapi.encoders import jsonable_encoder
 from fastapi.exceptions import RequestValidationError
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, StreamingResponse
+import json
+from limiter import ConcurrencyLimiter, Overloaded, SingleFlight
+from router import create_router, prompt_key
+from metrics import request_id, setup_metrics, stage
+from logging_setup import setup_logging
 
 app = FastAPI(title = "LLM Service")
+setup_metrics(app, 'llm')
+
+class HistoryMessage(BaseModel):
+    role: Literal['user', 'assistant']
+    content: str
 
 class LLMRequest(BaseModel):
     query_with_context: str
     system_prompt: str
+    # предыдущие реплики диалога, уже уложенные шлюзом в бюджет токенов
+    history: list[HistoryMessage] = []
 
 @app.exception_handler(RequestValidationError)
 async def validation_exception_handler(request: Request, exc: RequestValidationError):
@@ -24,29 +37,60 @@ async def validation_exception_handler(request: Request, exc: RequestValidationE
     )
 
 log_dir = os.path.join(os.path.dirname(__file__), 'logs')
-os.makedirs(log_dir, exist_ok=True)
-
-console_handler = logging.StreamHandler(sys.stdout)
-file_handler = logging.FileHandler(os.path.join(log_dir, 'llm.log'))
-
-logging.basicConfig(
-    level = logging.INFO,
-    handlers=[console_handler, file_handler],
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
-)
+# запись в stdout и файл выполняется в отдельном потоке, а не в цикле событий
+setup_logging('llm', os.path.join(log_dir, 'llm.log'), request_id)
 logger = logging.getLogger(__name__)
 load_dotenv()
 
-OPENAI_TOKEN = os.getenv('OPENAI_API_KEY')
+LLM_MAX_CONCURRENT = int(os.getenv('LLM_MAX_CONCURRENT', '4'))
+LLM_MAX_QUEUE = int(os.getenv('LLM_MAX_QUEUE', '32'))
+LLM_QUEUE_TIMEOUT = float(os.getenv('LLM_QUEUE_TIMEOUT', '30'))
+
+# маршруты (эндпоинт и модель) задаются в LLM_ROUTES, у каждого свой лимит частоты
+router = create_router(max_wait=LLM_QUEUE_TIMEOUT)
+single_flight = SingleFlight()
+concurrency_limiter = ConcurrencyLimiter(LLM_MAX_CONCURRENT, LLM_MAX_QUEUE, LLM_QUEUE_TIMEOUT)
+
+@app.exception_handler(Overloaded)
+async def overloaded_exception_handler(request: Request, exc: Overloaded):
+    logger.warning(f"Запрос отклонён: {exc.detail}, Retry-After {exc.retry_after} c")
+    return JSONResponse(
+        status_code=exc.status_code,
+        content={"detail": exc.detail},
+        headers={"Retry-After": str(exc.retry_after)},
+    )
+
+@app.get("/livez")
+async def livez():
+    return {"status": "alive"}
+
+@app.get("/readyz")
+async def readyz():
+    # реплика не готова, если все маршруты к провайдерам исключены после ошибок: шлюз выберет другую
+    now = time.monotonic()
+    available = [route.name for route in router.routes if route.is_available(now, router.cooldown)]
+    return JSONResponse(status_code=200 if available else 503,
+                        content={"status": "ready" if available else "degraded", "available_routes": available})
 
-client = AsyncOpenAI(
-    api_key=OPENAI_TOKEN,
-    base_url="https://openrouter.ai/api/v1",
-)
+async def complete(system_prompt: str, user_content: str, history: list[dict]) -> str:
+    with stage("queue_wait"):
+        slot = await concurrency_limiter.acquire()
+    try:
+        return await router.complete(system_prompt, user_content, history)
+    finally:
+        concurrency_limiter.release(slot)
+
+@app.get('/limits')
+async def limits_stats():
+    return {
+        "concurrency": concurrency_limiter.stats(),
+        "coalesced": single_flight.coalesced,
+        "in_flight_prompts": single_flight.in_flight(),
+    }
 
-if  not OPENAI_TOKEN:
-    logger.error("OPENAI_TOKEN не найден в переменных окружения. Проверьте файл .env")
-    raise ValueError("OPENAI_TOKEN не найден в переменных окружения. Проверьте файл .env")
+@app.get('/routes/stats')
+async def routes_stats():
+    return router.stats()
 
 @app.post('/generate_answer')
 async def generate_response(request:LLMRequest):
@@ -54,26 +98,12 @@ async def generate_response(request:LLMRequest):
         logger.warning(f"Пользователь отправил пустой запрос")
         raise HTTPException(status_code = 400,detail= "Некорректный запрос. Пользователь отправил пустой запрос")
     try:
-        completion = await client.chat.completions.create(
-        model="deepseek/deepseek-r1:free",
-        messages=[
-                {"role": "system", "content":  request.system_prompt},
-                {"role": "user", "content": request.query_with_context}
-            ])
-        logger.info(f"Ответ от API: {completion}")
-
-        try:
-            response = completion.choices[0].message.content
-            if not response:
-                reasoning = getattr(completion.choices[0].message, 'reasoning', None)
-                if reasoning:
-                    response = reasoning
-                    logger.info("Использовано поле reasoning вместо content")
-                else:
-                    raise ValueError("Модель вернула пустой ответ в content и reasoning")
-        except (IndexError, AttributeError) as e:
-            logger.error(f"Ошибка обработки ответа модели: {e}")
-            raise ValueError("Модель не вернула корректный ответ")
+        # одинаковые одновременные промпты разделяют один вызов модели
+        history = [message.model_dump() for message in request.history]
+        key = prompt_key(request.system_prompt, request.query_with_context, history)
+        response = await single_flight.do(key, lambda: complete(request.system_prompt, request.query_with_context, history))
+    except Overloaded:
+        raise
     except Exception as e:
         logger.error(f"Ошибка LLM: {e}")
         raise HTTPException(status_code=500, detail=str(e))
@@ -85,6 +115,47 @@ async def generate_response(request:LLMRequest):
         raise HTTPException(status_code=500, detail=str(e))
     return {"response": response}
 
+def sse_event(payload: dict) -> str:
+    return f"data: {json.dumps(payload, ensure_ascii=False)}\n\n"
+
+@app.post('/generate_answer/stream')
+async def generate_response_stream(request:LLMRequest):
+    if not request.query_with_context.strip():
+        logger.warning(f"Пользователь отправил пустой запрос")
+        raise HTTPException(status_code = 400,detail= "Некорректный запрос. Пользователь отправил пустой запрос")
+
+    # лимит частоты и заполненность очереди проверяются до начала ответа, чтобы вернуть 429/503 с Retry-After
+    router.ensure_capacity()
+    concurrency_limiter.check()
+
+    async def events():
+        # слот занимается внутри генератора: если клиент отключится до начала ответа, генератор не запустится
+        # и слот не будет занят, а освобождение в finally выполняется всегда, когда слот получен
+        try:
+            with stage("queue_wait"):
+                slot = await concurrency_limiter.acquire()
+        except Overloaded as e:
+            logger.warning(f"Потоковый запрос отклонён: {e.detail}")
+            yield sse_event({"error": e.detail, "status": e.status_code, "retry_after": e.retry_after})
+            return
+        try:
+            history = [message.model_dump() for message in request.history]
+            async for text in router.stream_text(request.system_prompt, request.query_with_context, history):
+                yield sse_event({"delta": text})
+            yield sse_event({"done": True})
+        except Overloaded as e:
+            # лимит частоты всех маршрутов исчерпан уже после начала ответа: отказ передаётся, как и при полной очереди,
+            # чтобы шлюз вернул 429/503 с Retry-After и пакетный запрос мог повторить вопрос
+            logger.warning(f"Потоковый запрос отклонён: {e.detail}")
+            yield sse_event({"error": e.detail, "status": e.status_code, "retry_after": e.retry_after})
+        except Exception as e:
+            logger.error(f"Ошибка LLM при стриминге: {e}")
+            yield sse_event({"error": str(e)})
+        finally:
+            concurrency_limiter.release(slot)
+
+    return StreamingResponse(events(), media_type="text/event-stream")
+
          
 if __name__=='__main__':
-    uvicorn.run("llm:app", host="0.0.0.0", port=8001)
+    uvicorn.run("llm:app", host="0.0.0.0", port=8001, log_config=None)
@@ -0,0 +1,343 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import time
+from collections import deque
+from typing import AsyncIterator
+from openai import AsyncOpenAI
+from limiter import Overloaded, TokenBucket
+from metrics import observe, stage
+from logging_setup import PAYLOAD
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BASE_URL = "https://openrouter.ai/api/v1"
+DEFAULT_MODEL = "deepseek/deepseek-r1:free"
+# число последних запросов, по которым считаются задержки и доля ошибок маршрута
+STATS_WINDOW = 100
+
+
+class NoRouteAvailableError(Exception):
+    pass
+
+
+def percentile(values, q: float) -> float | None:
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def prompt_key(system_prompt: str, user_content: str, history: list[dict] = ()) -> str:
+    payload = json.dumps([system_prompt, list(history), user_content], ensure_ascii=False)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+def build_messages(system_prompt: str, user_content: str, history: list[dict] = ()) -> list[dict]:
+    # предыдущие реплики диалога идут между системным промптом и текущим вопросом с контекстом
+    return [
+        {"role": "system", "content": system_prompt},
+        *({"role": message["role"], "content": message["content"]} for message in history),
+        {"role": "user", "content": user_content},
+    ]
+
+
+def rounded(value: float | None) -> float | None:
+    return None if value is None else round(value, 3)
+
+
+def extract_response(completion) -> str:
+    try:
+        response = completion.choices[0].message.content
+        if not response:
+            reasoning = getattr(completion.choices[0].message, 'reasoning', None)
+            if reasoning:
+                logger.info("Использовано поле reasoning вместо content")
+                return reasoning
+            raise ValueError("Модель вернула пустой ответ в content и reasoning")
+    except (IndexError, AttributeError) as e:
+        logger.error(f"Ошибка обработки ответа модели: {e}")
+        raise ValueError("Модель не вернула корректный ответ")
+    return response
+
+
+class Route():
+    # OpenAI-совместимый эндпоинт и модель со своим лимитом частоты и статистикой
+    def __init__(self, name: str, base_url: str, model: str, api_key: str,
+                 rate_per_minute: float, burst: int, max_wait: float):
+        self.name = name
+        self.base_url = base_url
+        self.model = model
+        self.client = AsyncOpenAI(api_key=api_key, base_url=base_url)
+        self.bucket = TokenBucket(rate_per_minute, burst, max_wait=max_wait)
+        self.latencies = deque(maxlen=STATS_WINDOW)
+        self.first_token_latencies = deque(maxlen=STATS_WINDOW)
+        self.outcomes = deque(maxlen=STATS_WINDOW)
+        self.requests = 0
+        self.failures = 0
+        self.ejected_at = None
+
+    def latency(self, streaming: bool = False) -> float | None:
+        return percentile(self.first_token_latencies if streaming else self.latencies, 0.5)
+
+    def error_rate(self) -> float:
+        return self.outcomes.count(False) / len(self.outcomes) if self.outcomes else 0.0
+
+    def is_available(self, now: float, cooldown: float) -> bool:
+        # после паузы маршрут снова получает запросы; при новой ошибке он исключается повторно
+        return self.ejected_at is None or now - self.ejected_at >= cooldown
+
+    def record_success(self, latency: float = None, first_token_latency: float = None):
+        if self.ejected_at is not None:
+            logger.info(f"Маршрут {self.name} возвращён в работу")
+        self.failures = 0
+        self.ejected_at = None
+        self.outcomes.append(True)
+        if latency is not None:
+            self.latencies.append(latency)
+        if first_token_latency is not None:
+            self.first_token_latencies.append(first_token_latency)
+
+    def record_failure(self, failure_threshold: int):
+        self.failures += 1
+        self.outcomes.append(False)
+        if self.ejected_at is not None or self.failures >= failure_threshold:
+            if self.ejected_at is None:
+                logger.warning(f"Маршрут {self.name} исключён после {self.failures} ошибок подряд")
+            self.ejected_at = time.monotonic()
+
+    def stats(self) -> dict:
+        return {
+            "name": self.name,
+            "model": self.model,
+            "base_url": self.base_url,
+            "requests": self.requests,
+            "error_rate": round(self.error_rate(), 3),
+            "p50": rounded(percentile(self.latencies, 0.5)),
+            "p95": rounded(percentile(self.latencies, 0.95)),
+            "first_token_p50": rounded(percentile(self.first_token_latencies, 0.5)),
+            "first_token_p95": rounded(percentile(self.first_token_latencies, 0.95)),
+            "ejected": self.ejected_at is not None,
+            "rate_tokens": round(self.bucket.tokens, 2),
+        }
+
+
+class LLMRouter():
+    def __init__(self, routes: list[Route], hedge_after: float = 20.0, failure_threshold: int = 3,
+                 cooldown: float = 60.0, max_error_rate: float = 0.5):
+        if not routes:
+            raise ValueError("Не задано ни одного маршрута LLM")
+        self.routes = routes
+        self.hedge_after = hedge_after
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.max_error_rate = max_error_rate
+        self.hedged = 0
+        self.failovers = 0
+
+    def ranked(self, streaming: bool = False) -> list[Route]:
+        # сначала исправные маршруты с известной задержкой, от быстрых к медленным, затем ещё не измеренные
+        # в порядке конфигурации; маршруты с частыми ошибками и исключённые — в конце, как запасные
+        now = time.monotonic()
+        available = [r for r in self.routes if r.is_available(now, self.cooldown)]
+        ejected = sorted((r for r in self.routes if r not in available), key=lambda r: r.ejected_at)
+
+        def key(route: Route):
+            latency = route.latency(streaming)
+            return (route.error_rate() > self.max_error_rate, latency is None, latency or 0.0)
+
+        return sorted(available, key=key) + ejected
+
+    def ensure_capacity(self):
+        # быстрый отказ до начала ответа, если ни у одного маршрута не осталось лимита частоты
+        waits = [route.bucket.wait_time() for route in self.routes]
+        if all(wait > route.bucket.max_wait for wait, route in zip(waits, self.routes)):
+            raise Overloaded(429, min(waits), "Превышен лимит запросов к модели")
+
+    async def _call(self, route: Route, messages: list[dict]) -> str:
+        with stage("rate_limit_wait"):
+            await route.bucket.acquire()
+        route.requests += 1
+        started = time.monotonic()
+        try:
+            with stage("llm_upstream"):
+                completion = await route.client.chat.completions.create(model=route.model, messages=messages)
+            logger.info("Ответ от API (%s): %s", route.name, completion, extra=PAYLOAD)
+            response = extract_response(completion)
+        except asyncio.CancelledError:
+            # запрос отменён, потому что раньше ответил дублирующий маршрут. Если маршрут не ответил за hedge_after,
+            # время до отмены — нижняя оценка его задержки: без неё замедлившийся маршрут сохранял бы прежнюю p50,
+            # оставался первым в ranked() и каждый запрос ждал бы дублирования
+            elapsed = time.monotonic() - started
+            if self.hedge_after > 0 and elapsed >= self.hedge_after:
+                route.latencies.append(elapsed)
+            raise
+        except Exception:
+            route.record_failure(self.failure_threshold)
+            raise
+        route.record_success(latency=time.monotonic() - started)
+        return response
+
+    async def complete(self, system_prompt: str, user_content: str, history: list[dict] = ()) -> str:
+        # запрос уходит на самый быстрый маршрут; если он не ответил за hedge_after секунд,
+        # параллельно запускается следующий и берётся первый успешный ответ. При ошибке — переход на следующий
+        messages = build_messages(system_prompt, user_content, history)
+        candidates = self.ranked()
+        pending: dict[asyncio.Task, Route] = {}
+        hedged = False
+        last_error = None
+
+        def launch() -> bool:
+            if not candidates:
+                return False
+            route = candidates.pop(0)
+            pending[asyncio.create_task(self._call(route, messages))] = route
+            return True
+
+        try:
+            launch()
+            while pending:
+                timeout = self.hedge_after if self.hedge_after > 0 and not hedged and candidates else None
+                done, _ = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    hedged = True
+                    self.hedged += 1
+                    logger.warning(f"Маршрут {next(iter(pending.values())).name} не ответил за {self.hedge_after} c, "
+                                   f"запрос продублирован на {candidates[0].name}")
+                    launch()
+                    continue
+                for task in done:
+                    route = pending.pop(task)
+                    if task.exception() is None:
+                        return task.result()
+                    last_error = task.exception()
+                    logger.warning(f"Ошибка маршрута {route.name}: {last_error}")
+                if not pending and launch():
+                    self.failovers += 1
+        finally:
+            for task in pending:
+                task.cancel()
+        raise last_error or NoRouteAvailableError("Нет доступных маршрутов LLM")
+
+    async def stream(self, system_prompt: str, user_content: str, history: list[dict] = ()) -> AsyncIterator:
+        # переход на следующий маршрут возможен только до первого фрагмента ответа
+        messages = build_messages(system_prompt, user_content, history)
+        last_error = None
+        for attempt, route in enumerate(self.ranked(streaming=True)):
+            if attempt:
+                self.failovers += 1
+            try:
+                with stage("rate_limit_wait"):
+                    await route.bucket.acquire()
+            except Overloaded as e:
+                last_error = e
+                continue
+            route.requests += 1
+            started = time.monotonic()
+            first_token_latency = None
+            # в llm_upstream входит только ожидание провайдера: время, пока шлюз читает уже отданный фрагмент,
+            # не учитывается. Время до первого фрагмента пишется отдельно в llm_first_token
+            upstream_seconds = 0.0
+            try:
+                stream = await route.client.chat.completions.create(model=route.model, messages=messages, stream=True)
+                upstream_seconds += time.monotonic() - started
+                chunks = stream.__aiter__()
+                while True:
+                    waited = time.monotonic()
+                    try:
+                        chunk = await chunks.__anext__()
+                    except StopAsyncIteration:
+                        break
+                    finally:
+                        upstream_seconds += time.monotonic() - waited
+                    if not chunk.choices:
+                        continue
+                    if first_token_latency is None:
+                        first_token_latency = time.monotonic() - started
+                        observe("llm_first_token", first_token_latency)
+                    yield chunk.choices[0].delta
+            except Exception as e:
+                route.record_failure(self.failure_threshold)
+                if first_token_latency is not None:
+                    raise
+                last_error = e
+                logger.warning(f"Ошибка маршрута {route.name} при стриминге: {e}")
+                continue
+            finally:
+                observe("llm_upstream", upstream_seconds)
+            route.record_success(first_token_latency=first_token_latency)
+            return
+        raise last_error or NoRouteAvailableError("Нет доступных маршрутов LLM")
+
+    async def stream_text(self, system_prompt: str, user_content: str, history: list[dict] = ()) -> AsyncIterator[str]:
+        # фрагменты текста ответа; как и без стриминга, при пустом content используется поле reasoning
+        has_content = False
+        reasoning_parts = []
+        async for delta in self.stream(system_prompt, user_content, history):
+            if delta.content:
+                has_content = True
+                yield delta.content
+            else:
+                reasoning = getattr(delta, 'reasoning', None)
+                if reasoning:
+                    reasoning_parts.append(reasoning)
+        if not has_content:
+            if not reasoning_parts:
+                raise ValueError("Модель вернула пустой ответ в content и reasoning")
+            logger.info("Использовано поле reasoning вместо content")
+            yield "".join(reasoning_parts)
+
+    def stats(self) -> dict:
+        return {
+            "hedge_after": self.hedge_after,
+            "hedged": self.hedged,
+            "failovers": self.failovers,
+            "routes": [route.stats() for route in self.routes],
+        }
+
+
+def load_routes(max_wait: float) -> list[Route]:
+    # LLM_ROUTES — JSON-список маршрутов: [{"name", "base_url", "model", "api_key_env", "rpm", "burst"}].
+    # По умолчанию один маршрут OpenRouter с ключом из OPENAI_API_KEY
+    default_rpm = float(os.getenv('LLM_RATE_LIMIT_RPM', '20'))
+    default_burst = int(os.getenv('LLM_RATE_BURST', '5'))
+    config = os.getenv('LLM_ROUTES')
+    if config:
+        try:
+            entries = json.loads(config)
+        except json.JSONDecodeError as e:
+            raise ValueError(f"LLM_ROUTES содержит некорректный JSON: {e}")
+    else:
+        entries = [{"name": "openrouter", "base_url": DEFAULT_BASE_URL,
+                    "model": os.getenv('LLM_MODEL', DEFAULT_MODEL), "api_key_env": "OPENAI_API_KEY"}]
+
+    routes = []
+    for i, entry in enumerate(entries):
+        # для локальных заглушек ключ можно указать прямо в конфигурации через api_key
+        api_key_env = entry.get("api_key_env", "OPENAI_API_KEY")
+        api_key = entry.get("api_key") or os.getenv(api_key_env)
+        if not api_key:
+            logger.error(f"{api_key_env} не найден в переменных окружения. Проверьте файл .env")
+            raise ValueError(f"{api_key_env} не найден в переменных окружения. Проверьте файл .env")
+        routes.append(Route(
+            name=entry.get("name", f"route{i}"),
+            base_url=entry.get("base_url", DEFAULT_BASE_URL),
+            model=entry.get("model", DEFAULT_MODEL),
+            api_key=api_key,
+            rate_per_minute=float(entry.get("rpm", default_rpm)),
+            burst=int(entry.get("burst", default_burst)),
+            max_wait=max_wait,
+        ))
+    return routes
+
+
+def create_router(max_wait: float) -> LLMRouter:
+    return LLMRouter(
+        load_routes(max_wait),
+        hedge_after=float(os.getenv('LLM_HEDGE_AFTER', '20')),
+        failure_threshold=int(os.getenv('LLM_ROUTE_FAILURE_THRESHOLD', '3')),
+        cooldown=float(os.getenv('LLM_ROUTE_COOLDOWN', '60')),
+        max_error_rate=float(os.getenv('LLM_ROUTE_MAX_ERROR_RATE', '0.5')),
+    )
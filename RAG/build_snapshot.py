@@ -0,0 +1,16 @@
+"""Сборка снимка индекса при сборке образа: загружает модель эмбеддингов в HF_HOME и строит индекс
+по базе знаний в CHROMA_DB_PATH. При запуске сервиса с RAG_INDEX_SNAPSHOT снимок копируется в пустое
+хранилище вместо построения индекса заново.
+    CHROMA_DB_PATH=/app/index_snapshot python build_snapshot.py
+"""
+import logging
+import os
+import sys
+
+if __name__ == '__main__':
+    # снимок собирается из базы знаний, а не из другого снимка
+    os.environ.pop('RAG_INDEX_SNAPSHOT', None)
+    from rag import RAG
+
+    rag = RAG(knowledge_base=sys.argv[1] if len(sys.argv) > 1 else "knowledge_base", force_reload=True)
+    logging.getLogger(__name__).info(f"Снимок индекса собран: {rag.last_sync_report}, этапы {rag.startup_phases}")
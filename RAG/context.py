@@ -0,0 +1,88 @@
+import logging
+from functools import lru_cache
+from typing import List
+from langchain_core.documents import Document
+
+logger = logging.getLogger(__name__)
+
+QUERY_TEMPLATE = "Контекст: {context}\n\nВопрос: {query}"
+NO_CONTEXT = "Контекст отсутствует."
+# перекрытия короче этого считаются случайным совпадением, а не повтором из сплиттера
+MIN_OVERLAP = 20
+
+
+@lru_cache(maxsize=1)
+def get_encoding():
+    try:
+        import tiktoken
+
+        return tiktoken.get_encoding("cl100k_base")
+    except Exception as e:
+        logger.error(f"Ошибка при загрузке токенизатора tiktoken: {e}")
+        return None
+
+
+@lru_cache(maxsize=4096)
+def count_tokens(text: str) -> int:
+    encoding = get_encoding()
+    if encoding is None:
+        return len(text) // 4
+    return len(encoding.encode(text))
+
+
+def chunk_token_count(doc: Document) -> int:
+    # число токенов чанка считается при индексации; для старых индексов — при первом обращении
+    token_count = doc.metadata.get("token_count")
+    return int(token_count) if token_count not in (None, "") else count_tokens(doc.page_content)
+
+
+def strip_overlap(text: str, selected: List[str]) -> str:
+    # соседние чанки одного существа перекрываются на chunk_overlap символов: убираем повтор
+    for previous in selected:
+        if text in previous:
+            return ""
+        for length in range(min(len(previous), len(text)) - 1, MIN_OVERLAP - 1, -1):
+            if previous.endswith(text[:length]):
+                text = text[length:].lstrip(" ,.;:\n")
+                break
+            if previous.startswith(text[-length:]):
+                text = text[:-length].rstrip(" ,;:\n")
+                break
+    return text
+
+
+class ContextAssembler():
+    def __init__(self, system_prompt: str, max_tokens: int = 3500):
+        self.max_tokens = max_tokens
+        self.system_tokens = count_tokens(system_prompt)
+
+    def budget(self, query: str, history_tokens: int = 0) -> int:
+        # history_tokens — история диалога, которую шлюз передаст в LLM вместе с промптом
+        return (self.max_tokens - self.system_tokens - history_tokens
+                - count_tokens(QUERY_TEMPLATE.format(context="", query=query)))
+
+    def assemble(self, query: str, hits: List[tuple[Document, float]], history_tokens: int = 0) -> str:
+        # жадно берём чанки в порядке релевантности, пока они помещаются в бюджет;
+        # чанк, который не помещается, пропускается, но следующие, более короткие, ещё могут войти
+        budget = self.budget(query, history_tokens)
+        used = 0
+        lines = []
+        selected: dict[str, List[str]] = {}
+        for doc, _ in hits:
+            scientific_name = doc.metadata["scientific_name"]
+            creature_chunks = selected.setdefault(scientific_name, [])
+            text = strip_overlap(doc.page_content, creature_chunks)
+            if not text:
+                continue
+            prefix = f"{doc.metadata['common_name']} ({scientific_name}): "
+            tokens = count_tokens(prefix) + (chunk_token_count(doc) if text == doc.page_content else count_tokens(text)) + 1
+            if used + tokens > budget:
+                continue
+            used += tokens
+            creature_chunks.append(doc.page_content)
+            lines.append(prefix + text)
+
+        if not lines:
+            return NO_CONTEXT
+        logger.info(f"Контекст собран из {len(lines)} чанков, {used} из {budget} токенов")
+        return "\n".join(lines)
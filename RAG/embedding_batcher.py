@@ -0,0 +1,82 @@
+import asyncio
+import logging
+from typing import List
+from langchain_core.embeddings import Embeddings
+
+logger = logging.getLogger(__name__)
+
+
+class EmbeddingBatcher():
+    # Собирает одновременные запросы на эмбеддинг в один батч: батч отправляется в модель,
+    # когда набирается max_batch_size запросов или истекает max_wait_ms с момента первого из них.
+    # Запрос, не получивший эмбеддинг за deadline_ms, завершается TimeoutError и не попадает в следующие батчи
+    def __init__(self, embeddings: Embeddings, max_batch_size: int = 32, max_wait_ms: float = 10.0,
+                 deadline_ms: float = 0.0):
+        self.embeddings = embeddings
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max_wait_ms / 1000
+        # 0 — без ограничения
+        self.deadline = deadline_ms / 1000 if deadline_ms > 0 else None
+        self.expired = 0
+        self._pending: list[tuple[str, asyncio.Future]] = []
+        self._timer: asyncio.TimerHandle | None = None
+        self._busy = False
+        self._task: asyncio.Task | None = None
+
+    async def embed(self, text: str) -> List[float]:
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((text, future))
+        if len(self._pending) >= self.max_batch_size:
+            self._flush()
+        elif self._timer is None and not self._busy:
+            self._timer = loop.call_later(self.max_wait, self._flush)
+        if self.deadline is None:
+            return await future
+        try:
+            # по таймауту future отменяется, и _take_batch пропускает его, если он ещё в очереди
+            return await asyncio.wait_for(future, self.deadline)
+        except TimeoutError:
+            self.expired += 1
+            logger.warning(f"Эмбеддинг не получен за {self.deadline * 1000:.0f} мс, в очереди {len(self._pending)} запросов")
+            raise TimeoutError("Истекло время ожидания эмбеддинга запроса")
+
+    def _take_batch(self) -> list[tuple[str, asyncio.Future]]:
+        batch = self._pending[:self.max_batch_size]
+        self._pending = self._pending[self.max_batch_size:]
+        return [(text, future) for text, future in batch if not future.done()]
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        # пока модель занята, запросы копятся и уйдут следующим батчем сразу после текущего
+        if self._busy or not self._pending:
+            return
+        self._busy = True
+        self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        try:
+            while self._pending:
+                batch = self._take_batch()
+                if batch:
+                    await self._embed_batch(batch)
+        finally:
+            self._busy = False
+
+    async def _embed_batch(self, batch: list[tuple[str, asyncio.Future]]):
+        texts = [text for text, _ in batch]
+        try:
+            # модель на CPU и так использует все ядра, поэтому батчи выполняются строго по одному
+            vectors = await asyncio.to_thread(self.embeddings.embed_documents, texts)
+        except Exception as e:
+            logger.error(f"Ошибка при вычислении эмбеддингов для батча из {len(texts)} запросов: {e}")
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        logger.debug(f"Вычислены эмбеддинги для батча из {len(texts)} запросов")
+        for (_, future), vector in zip(batch, vectors):
+            if not future.done():
+                future.set_result(vector)
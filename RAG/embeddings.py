@@ -0,0 +1,102 @@
+import logging
+import os
+from typing import List
+from langchain_core.embeddings import Embeddings
+
+logger = logging.getLogger(__name__)
+
+EMBEDDING_MODEL = "intfloat/multilingual-e5-base"
+# текст, по эмбеддингу которого проверяется совместимость бэкенда с уже построенным индексом
+EMBEDDING_PROBE_TEXT = "Где обитает Эфирный Скакун и чем он питается?"
+
+
+class OnnxEmbeddings(Embeddings):
+    # Та же модель, экспортированная в ONNX и выполняемая через ONNX Runtime на CPU.
+    # Эмбеддинги получаются усреднением по токенам без нормализации, как у sentence-transformers
+    # для multilingual-e5-base, поэтому векторы совместимы с индексом, построенным через torch
+    def __init__(self, model_name: str = EMBEDDING_MODEL, model_dir: str | None = None, quantize: bool = True,
+                 intra_op_threads: int = 0, inter_op_threads: int = 1, batch_size: int = 32, max_length: int = 512):
+        import onnxruntime
+        from transformers import AutoTokenizer
+
+        self.model_name = model_name
+        self.model_dir = model_dir or os.path.join(
+            os.getenv('HF_HOME', os.path.join(os.path.dirname(__file__), '.cache')), 'onnx', model_name.replace('/', '--'))
+        self.quantize = quantize
+        self.batch_size = batch_size
+        self.max_length = max_length
+
+        model_path = self._ensure_model()
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        options.intra_op_num_threads = intra_op_threads
+        options.inter_op_num_threads = inter_op_threads
+        self.session = onnxruntime.InferenceSession(model_path, options, providers=["CPUExecutionProvider"])
+        self.input_names = {model_input.name for model_input in self.session.get_inputs()}
+        self.tokenizer = AutoTokenizer.from_pretrained(self.model_dir)
+        logger.info(f"ONNX-модель загружена из {model_path} (квантизация: {quantize})")
+
+    def _ensure_model(self) -> str:
+        model_path = os.path.join(self.model_dir, "model.onnx")
+        quantized_path = os.path.join(self.model_dir, "model_quantized.onnx")
+        if not os.path.exists(model_path):
+            from optimum.onnxruntime import ORTModelForFeatureExtraction
+            from transformers import AutoTokenizer
+
+            logger.info(f"Экспорт модели {self.model_name} в ONNX в {self.model_dir}...")
+            ORTModelForFeatureExtraction.from_pretrained(self.model_name, export=True).save_pretrained(self.model_dir)
+            AutoTokenizer.from_pretrained(self.model_name).save_pretrained(self.model_dir)
+        if not self.quantize:
+            return model_path
+        if not os.path.exists(quantized_path):
+            from optimum.onnxruntime import ORTQuantizer
+            from optimum.onnxruntime.configuration import AutoQuantizationConfig
+
+            logger.info("Динамическая int8-квантизация ONNX-модели...")
+            quantizer = ORTQuantizer.from_pretrained(self.model_dir, file_name="model.onnx")
+            config = AutoQuantizationConfig.avx2(is_static=False, per_channel=False)
+            quantizer.quantize(save_dir=self.model_dir, quantization_config=config)
+        return quantized_path
+
+    def _embed_batch(self, texts: List[str]) -> List[List[float]]:
+        import numpy as np
+
+        encoded = self.tokenizer(texts, padding=True, truncation=True, max_length=self.max_length, return_tensors="np")
+        inputs = {name: value.astype(np.int64) for name, value in encoded.items() if name in self.input_names}
+        hidden_state = self.session.run(None, inputs)[0]
+        mask = encoded["attention_mask"][..., None].astype(hidden_state.dtype)
+        pooled = (hidden_state * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+        return pooled.tolist()
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        vectors = []
+        for start in range(0, len(texts), self.batch_size):
+            vectors.extend(self._embed_batch(texts[start:start + self.batch_size]))
+        return vectors
+
+    def embed_query(self, text: str) -> List[float]:
+        return self._embed_batch([text])[0]
+
+
+def create_embeddings(backend: str | None = None) -> Embeddings:
+    backend = backend or os.getenv('EMBEDDING_BACKEND', 'torch')
+    if backend == "torch":
+        import torch
+        from langchain_huggingface import HuggingFaceEmbeddings
+
+        return HuggingFaceEmbeddings(model_name=EMBEDDING_MODEL,
+                                     model_kwargs={"device": "cuda" if torch.cuda.is_available() else "cpu"})
+    if backend == "onnx":
+        return OnnxEmbeddings(
+            model_dir=os.getenv('ONNX_MODEL_DIR') or None,
+            quantize=os.getenv('ONNX_QUANTIZE', 'true').lower() == 'true',
+            intra_op_threads=int(os.getenv('ONNX_INTRA_OP_THREADS', '0')),
+            inter_op_threads=int(os.getenv('ONNX_INTER_OP_THREADS', '1')),
+        )
+    if backend == "fake":
+        # детерминированные псевдослучайные векторы по хешу текста: для замеров и тестов без загрузки модели,
+        # качество поиска с ними не имеет смысла
+        from langchain_core.embeddings import DeterministicFakeEmbedding
+
+        return DeterministicFakeEmbedding(size=int(os.getenv('FAKE_EMBEDDING_SIZE', '768')))
+    raise ValueError(f"Неизвестный бэкенд эмбеддингов: {backend}")
@@ -0,0 +1,71 @@
+import hashlib
+import json
+import logging
+import math
+import os
+
+logger = logging.getLogger(__name__)
+
+
+class ManifestEntry():
+    def __init__(self, content_hash: str, ids: list[str]):
+        self.content_hash = content_hash
+        self.ids = ids
+
+
+class IndexManifest():
+    # Хранит хеш содержимого каждого существа и id его векторов в хранилище,
+    # чтобы при синхронизации пересчитывать эмбеддинги только для изменившихся существ
+    FILE_NAME = "manifest.json"
+
+    def __init__(self, persist_dir: str, entries: dict[str, ManifestEntry] | None = None,
+                 embedding_probe: list[float] | None = None, chunking: dict | None = None):
+        self.path = os.path.join(persist_dir, self.FILE_NAME)
+        self.entries = entries or {}
+        # эмбеддинг контрольного текста, которым был построен индекс
+        self.embedding_probe = embedding_probe
+        # параметры разбиения на чанки; в манифестах старых версий отсутствуют
+        self.chunking = chunking
+
+    @classmethod
+    def load(cls, persist_dir: str) -> "IndexManifest | None":
+        path = os.path.join(persist_dir, cls.FILE_NAME)
+        if not os.path.exists(path):
+            return None
+        try:
+            with open(path, 'r', encoding='utf-8') as file:
+                data = json.load(file)
+        except (json.JSONDecodeError, OSError) as e:
+            logger.error(f"Не удалось прочитать манифест индекса {path}: {e}")
+            return None
+        entries = {key: ManifestEntry(value["hash"], value["ids"]) for key, value in data.get("creatures", {}).items()}
+        return cls(persist_dir, entries, data.get("embedding_probe"), data.get("chunking"))
+
+    def save(self):
+        data = {
+            "embedding_probe": self.embedding_probe,
+            "chunking": self.chunking,
+            "creatures": {key: {"hash": entry.content_hash, "ids": entry.ids} for key, entry in self.entries.items()},
+        }
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as file:
+            json.dump(data, file, ensure_ascii=False)
+        os.replace(tmp_path, self.path)
+
+    def is_compatible(self, probe: list[float], threshold: float) -> bool:
+        if self.embedding_probe is None or len(self.embedding_probe) != len(probe):
+            return False
+        dot = sum(a * b for a, b in zip(self.embedding_probe, probe))
+        norm = math.sqrt(sum(a * a for a in self.embedding_probe)) * math.sqrt(sum(b * b for b in probe))
+        return norm > 0 and dot / norm >= threshold
+
+    def version(self) -> str:
+        digest = hashlib.sha256()
+        for key in sorted(self.entries):
+            digest.update(f"{key}:{self.entries[key].content_hash}\n".encode())
+        return digest.hexdigest()[:16]
+
+
+def content_hash(content: str, metadata: dict) -> str:
+    payload = json.dumps({"content": content, "metadata": metadata}, ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(payload.encode()).hexdigest()
@@ -0,0 +1,151 @@
+import logging
+import os
+import time
+from collections import deque
+from concurrent.futures import Executor, ProcessPoolExecutor
+from functools import lru_cache
+from glob import glob
+from multiprocessing import get_context
+from typing import Callable, Iterable, Iterator
+import ijson
+from index_manifest import content_hash
+from context import count_tokens
+from logging_setup import setup_logging
+
+logger = logging.getLogger(__name__)
+
+# параметры разбиения текста существа на чанки, подбираются по замерам benchmarks/retrieval_tuning.py
+CHUNK_SIZE = int(os.getenv('CHUNK_SIZE', '200'))
+CHUNK_OVERLAP = int(os.getenv('CHUNK_OVERLAP', '50'))
+# текст не длиннее порога индексируется одним чанком
+SPLIT_THRESHOLD = int(os.getenv('SPLIT_THRESHOLD', '500'))
+# поля существа разделены одним переводом строки: с разделителем по умолчанию "\n\n" текст существа
+# остаётся одним чанком независимо от CHUNK_SIZE, "\n" разбивает его по границам полей
+CHUNK_SEPARATOR = os.getenv('CHUNK_SEPARATOR', '\n\n').encode().decode('unicode_escape')
+CHUNKING = {"chunk_size": CHUNK_SIZE, "chunk_overlap": CHUNK_OVERLAP, "split_threshold": SPLIT_THRESHOLD,
+            "separator": CHUNK_SEPARATOR}
+
+
+def extract_text_from_json(creature: dict) -> str:
+
+    text_parts = []
+
+    for key in ["scientific_name", "common_name", "mythology", "science", "threats"]:
+        if key in creature and creature[key]:
+            text_parts.append(f"{key}: {creature[key]}")
+    if "habitat" in creature:
+        habitat = creature["habitat"]
+        if "location" in habitat and habitat["location"]:
+            text_parts.append(f"habitat location: {habitat['location']}")
+        if "description" in habitat and habitat["description"]:
+            text_parts.append(f"habitat description: {habitat['description']}")
+
+    if "appearance" in creature:
+        appearance = creature["appearance"]
+        for key, value in appearance.items():
+            if value:
+                text_parts.append(f"appearance {key}: {value}")
+
+    if "behavior" in creature:
+        behavior = creature["behavior"]
+        for key, value in behavior.items():
+            if value:
+                text_parts.append(f"behavior {key}: {value}")
+
+    return "\n".join(text_parts)
+
+
+def iter_creatures(knowledge_base_path: str) -> Iterator[tuple[str, dict]]:
+    # файлы разбираются потоково, в памяти одновременно находится только одно существо
+    json_files = sorted(glob(os.path.join(knowledge_base_path, "*.json")))
+    if not json_files:
+        logger.error(f"Не найдено JSON-файлов в папке {knowledge_base_path}")
+        raise FileNotFoundError(f"Не найдено JSON-файлов в папке {knowledge_base_path}")
+
+    for json_file in json_files:
+        logger.info(f"Обработка файла: {json_file}")
+        found = 0
+        try:
+            with open(json_file, 'rb') as file:
+                for creature in ijson.items(file, "creatures.item", use_float=True):
+                    found += 1
+                    if not creature.get("scientific_name") or not creature.get("common_name"):
+                        logger.warning(f"Пропущен элемент без scientific_name или common_name в файле {json_file}: {creature}")
+                        continue
+                    yield json_file, creature
+        except ijson.JSONError as e:
+            logger.error(f"Ошибка при разборе JSON в файле {json_file}: {e}")
+            continue
+        if not found:
+            logger.warning(f"Файл {json_file} не содержит существ в ключе 'creatures'. Пропускаем.")
+
+
+@lru_cache(maxsize=None)
+def _get_text_splitter(chunk_size: int, chunk_overlap: int, separator: str):
+    # импорт откладывается до первой индексации: при запуске с готовым индексом разбиение не нужно
+    from langchain_text_splitters import CharacterTextSplitter
+
+    return CharacterTextSplitter(separator=separator, chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+
+
+def prepare_creature(item: tuple[str, dict], chunk_size: int = CHUNK_SIZE, chunk_overlap: int = CHUNK_OVERLAP,
+                     split_threshold: int = SPLIT_THRESHOLD,
+                     chunk_separator: str = CHUNK_SEPARATOR) -> tuple[str, list[str], dict, str, list[int]]:
+    # выполняется в пуле процессов, поэтому принимает и возвращает только простые данные
+    json_file, creature = item
+    content = extract_text_from_json(creature)
+    metadata = {
+        "scientific_name": creature.get("scientific_name", ""),
+        "common_name": creature.get("common_name", ""),
+        "habitat_location": creature.get("habitat", {}).get("location", ""),
+        "source": json_file
+    }
+    if len(content) > split_threshold:
+        chunks = _get_text_splitter(chunk_size, chunk_overlap, chunk_separator).split_text(content)
+    else:
+        chunks = [content]
+    # число токенов каждого чанка считается один раз при индексации и хранится в метаданных
+    token_counts = [count_tokens(chunk) for chunk in chunks]
+    return creature["scientific_name"], chunks, metadata, content_hash(content, metadata), token_counts
+
+
+def bounded_map(executor: Executor | None, fn: Callable, items: Iterable, max_in_flight: int) -> Iterator:
+    # в отличие от Executor.map не вычитывает весь входной итератор сразу
+    if executor is None:
+        yield from map(fn, items)
+        return
+    in_flight = deque()
+    for item in items:
+        in_flight.append(executor.submit(fn, item))
+        if len(in_flight) >= max_in_flight:
+            yield in_flight.popleft().result()
+    while in_flight:
+        yield in_flight.popleft().result()
+
+
+def init_worker_logging():
+    # spawn повторно импортирует модуль запуска (например, RAG/main.py), и тот уже настроил запись в rag.log.
+    # Настройка заменяется записью только в stdout: ротацию одного файла из нескольких процессов
+    # RotatingFileHandler не поддерживает
+    setup_logging('rag', force=True)
+
+
+def create_executor(workers: int) -> ProcessPoolExecutor | None:
+    if workers <= 1:
+        return None
+    # spawn, а не fork: к моменту индексации в процессе уже работают потоки torch
+    return ProcessPoolExecutor(max_workers=workers, mp_context=get_context("spawn"),
+                               initializer=init_worker_logging)
+
+
+class IngestionProgress():
+    def __init__(self):
+        self.started_at = time.monotonic()
+        self.creatures = 0
+        self.vectors = 0
+
+    def log(self, stage: str):
+        elapsed = time.monotonic() - self.started_at
+        rate = self.vectors / elapsed if elapsed > 0 else 0.0
+        logger.info(f"{stage}: обработано существ {self.creatures}, записано векторов {self.vectors}, "
+                    f"{rate:.1f} векторов/с за {elapsed:.1f} с")
@@ -0,0 +1,109 @@
+import math
+import re
+from collections import Counter, defaultdict
+from typing import List
+from langchain_core.documents import Document
+
+TOKEN_RE = re.compile(r"\w+")
+# грубый стемминг: общий префикс покрывает большинство падежных форм ("скакун", "скакуна", "скакуну")
+STEM_LENGTH = 5
+
+
+def tokenize(text: str) -> List[str]:
+    return [token[:STEM_LENGTH] for token in TOKEN_RE.findall(text.lower().replace('ё', 'е'))]
+
+
+class NameIndex():
+    # Словарь имён существ: common_name и scientific_name -> scientific_name
+    def __init__(self):
+        self._by_first_token: dict[str, list[tuple[tuple[str, ...], str]]] = defaultdict(list)
+
+    def add(self, name: str, scientific_name: str):
+        tokens = tuple(tokenize(name))
+        if tokens and (tokens, scientific_name) not in self._by_first_token[tokens[0]]:
+            self._by_first_token[tokens[0]].append((tokens, scientific_name))
+
+    def match(self, query: str) -> str | None:
+        tokens = tokenize(query)
+        best, best_length = None, 0
+        for i, token in enumerate(tokens):
+            for name_tokens, scientific_name in self._by_first_token.get(token, ()):
+                if len(name_tokens) > best_length and tuple(tokens[i:i + len(name_tokens)]) == name_tokens:
+                    best, best_length = scientific_name, len(name_tokens)
+        return best
+
+
+class BM25Index():
+    def __init__(self, k1: float = 1.5, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self.postings: dict[str, list[tuple[int, int]]] = defaultdict(list)
+        self.doc_lengths: List[int] = []
+        self.idf: dict[str, float] = {}
+        self.avg_length = 0.0
+
+    def build(self, texts: List[str]):
+        for doc_id, text in enumerate(texts):
+            counts = Counter(tokenize(text))
+            self.doc_lengths.append(sum(counts.values()))
+            for term, tf in counts.items():
+                self.postings[term].append((doc_id, tf))
+        total = len(self.doc_lengths)
+        self.avg_length = sum(self.doc_lengths) / total if total else 0.0
+        self.idf = {term: math.log(1 + (total - len(docs) + 0.5) / (len(docs) + 0.5)) for term, docs in self.postings.items()}
+
+    def scores(self, query: str) -> dict[int, float]:
+        scores: dict[int, float] = defaultdict(float)
+        for term in set(tokenize(query)):
+            idf = self.idf.get(term)
+            if idf is None:
+                continue
+            for doc_id, tf in self.postings[term]:
+                norm = self.k1 * (1 - self.b + self.b * self.doc_lengths[doc_id] / self.avg_length)
+                scores[doc_id] += idf * tf * (self.k1 + 1) / (tf + norm)
+        return scores
+
+    def search(self, query: str, k: int) -> List[tuple[int, float]]:
+        return sorted(self.scores(query).items(), key=lambda item: item[1], reverse=True)[:k]
+
+
+class LexicalIndex():
+    # Строится по содержимому векторного индекса: BM25 по чанкам и словарь имён существ
+    def __init__(self, documents: List[Document]):
+        self.documents = documents
+        self.bm25 = BM25Index()
+        self.bm25.build([doc.page_content for doc in documents])
+        self.names = NameIndex()
+        self.by_creature: dict[str, List[int]] = defaultdict(list)
+        for doc_id, doc in enumerate(documents):
+            scientific_name = doc.metadata.get("scientific_name", "")
+            self.by_creature[scientific_name].append(doc_id)
+            self.names.add(scientific_name, scientific_name)
+            self.names.add(doc.metadata.get("common_name", ""), scientific_name)
+
+    def match_name(self, query: str) -> str | None:
+        return self.names.match(query)
+
+    def creature_documents(self, scientific_name: str, query: str, k: int) -> List[Document]:
+        # чанки названного существа, упорядоченные по BM25 относительно вопроса
+        scores = self.bm25.scores(query)
+        doc_ids = sorted(self.by_creature.get(scientific_name, ()), key=lambda doc_id: scores.get(doc_id, 0.0), reverse=True)
+        return [self.documents[doc_id] for doc_id in doc_ids[:k]]
+
+    def search(self, query: str, k: int) -> List[Document]:
+        return [self.documents[doc_id] for doc_id, _ in self.bm25.search(query, k)]
+
+
+def document_key(doc: Document) -> tuple[str, str]:
+    return doc.metadata.get("scientific_name", ""), doc.page_content
+
+
+def reciprocal_rank_fusion(rankings: List[List[Document]], k: int = 60) -> List[Document]:
+    scores: dict[tuple[str, str], float] = defaultdict(float)
+    documents: dict[tuple[str, str], Document] = {}
+    for ranking in rankings:
+        for rank, doc in enumerate(ranking):
+            key = document_key(doc)
+            scores[key] += 1 / (k + rank + 1)
+            documents.setdefault(key, doc)
+    return [documents[key] for key in sorted(scores, key=scores.get, reverse=True)]
@@ -1,16 +1,78 @@
 from fastapi import FastAPI, HTTPException, Request, status
 from fastapi.encoders import jsonable_encoder
 from fastapi.exceptions import RequestValidationError
-from fastapi.responses import JSONResponse
-from pydantic import BaseModel
+from fastapi.responses import JSONResponse, StreamingResponse
+from pydantic import BaseModel, Field
+import asyncio
+import json
 import logging
-from rag import RAG
+import os
+import time
+from metrics import request_id, setup_metrics
+from logging_setup import setup_logging
 import uvicorn
+from contextlib import asynccontextmanager
 
-app = FastAPI(title= "RAG")
+setup_logging('rag', os.path.join(os.path.dirname(__file__), 'logs', 'rag.log'), request_id)
+logger = logging.getLogger(__name__)
+
+rag = None
+startup = {"status": "starting", "error": None, "phases": {}, "seconds": None}
+startup_task: asyncio.Task | None = None
+RAG_BATCH_MAX_ITEMS = int(os.getenv('RAG_BATCH_MAX_ITEMS', '1000'))
+
+def build_rag():
+    # тяжёлые модули (langchain, torch, chromadb) импортируются здесь, а не при импорте main:
+    # сервис отвечает на /livez сразу после запуска процесса
+    started = time.perf_counter()
+    from rag import RAG
+    startup["phases"]["imports"] = round(time.perf_counter() - started, 3)
+    instance = RAG(knowledge_base="knowledge_base", startup_phases=startup["phases"])
+    instance.warm_up()
+    return instance
+
+async def start_rag():
+    global rag
+    started = time.perf_counter()
+    try:
+        rag = await asyncio.to_thread(build_rag)
+    except Exception as e:
+        logger.error(f"Ошибка запуска RAG: {e}")
+        startup.update(status="failed", error=str(e))
+        return
+    startup.update(status="ready", seconds=round(time.perf_counter() - started, 3))
+    logger.info(f"RAG готов к запросам за {startup['seconds']:.3f} c: {startup['phases']}")
+    if rag.background_sync:
+        await start_reindex()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # RAG создаётся при старте приложения, а не при импорте модуля: индексация использует пул процессов
+    # с методом spawn, а дочерние процессы повторно импортируют главный модуль.
+    # Загрузка идёт в фоне, до её окончания /readyz и /query отвечают 503
+    global startup_task
+    startup_task = asyncio.create_task(start_rag())
+    yield
+    startup_task.cancel()
+
+app = FastAPI(title= "RAG", lifespan=lifespan)
+setup_metrics(app, 'rag')
 
 class Query(BaseModel):
     query : str
+    return_embedding: bool = False
+    # текст для поиска контекста, если он отличается от вопроса (например, вместе с предыдущим вопросом)
+    search_query: str | None = None
+    # токены истории диалога, которую шлюз передаст в LLM: на столько же сокращается бюджет контекста
+    history_tokens: int = Field(default=0, ge=0)
+
+class BatchItem(BaseModel):
+    query: str
+    search_query: str | None = None
+    history_tokens: int = Field(default=0, ge=0)
+
+class BatchQuery(BaseModel):
+    items: list[BatchItem]
 
 @app.exception_handler(RequestValidationError)
 async def validation_exception_handler(request: Request, exc: RequestValidationError):
@@ -19,18 +81,70 @@ async def validation_exception_handler(request: Request, exc: RequestValidationE
         content=jsonable_encoder({"detail": exc.errors(), "body": exc.body}),
     )
 
-logger = logging.getLogger(__name__)
+def ready_rag():
+    if rag is None:
+        raise HTTPException(status_code=503, detail="Сервис запускается", headers={"Retry-After": "5"})
+    return rag
 
-rag = RAG(knowledge_base="knowledge_base")
+@app.get("/livez")
+async def livez():
+    return {"status": "alive"}
+
+@app.get("/readyz")
+async def readyz():
+    # шлюз направляет запросы только на реплики, которые загрузили модель и индекс и прогрели их
+    return JSONResponse(status_code=200 if rag is not None else 503, content=startup)
+
+reindex_task: asyncio.Task | None = None
+
+async def run_reindex():
+    try:
+        await asyncio.to_thread(rag.sync_index)
+    except Exception as e:
+        logger.error(f"Ошибка переиндексации: {e}")
+
+async def start_reindex() -> bool:
+    global reindex_task
+    if reindex_task is not None and not reindex_task.done():
+        return False
+    reindex_task = asyncio.create_task(run_reindex())
+    return True
+
+@app.post("/reindex", status_code=status.HTTP_202_ACCEPTED)
+async def reindex():
+    ready_rag()
+    if not await start_reindex():
+        return {"status": "running"}
+    return {"status": "started"}
+
+@app.get("/reindex")
+async def reindex_status():
+    rag = ready_rag()
+    running = reindex_task is not None and not reindex_task.done()
+    return {"status": "running" if running else "idle", "last_report": rag.last_sync_report, "index_version": rag.index_version}
 
 @app.post("/query")
 async def process_query_with_context(request:Query):
     if not  request.query.strip():
         logger.warning(f"Пользователь отправил пустой запрос")
         raise HTTPException(status_code = 400,detail= "Некорректный запрос. Пользователь отправил пустой запрос")
+    rag = ready_rag()
     try:
-        query_with_context = await rag.get_query_with_context(request.query)
-        return {"query_with_context":query_with_context}
+        # без запроса эмбеддинга он вычисляется только если понадобится векторный поиск
+        embedding = await rag.embed_query(request.query) if request.return_embedding else None
+        search_text = rag.search_text(request.query, request.search_query)
+        context, scores = await rag.retrieve_context(search_text, embedding=embedding if search_text == request.query else None,
+                                                     history_tokens=request.history_tokens)
+        query_with_context = rag.build_query_with_context(request.query, context, request.history_tokens)
+        response = {
+            "query_with_context": query_with_context,
+            "context": context,
+            "index_version": rag.index_version,
+            **rag.relevance(scores),
+        }
+        if request.return_embedding:
+            response["query_embedding"] = embedding
+        return response
     except ValueError as e:
         logger.error(f"Ошибка значения: {e}")
         raise HTTPException(status_code=400, detail=str(e))
@@ -41,7 +155,22 @@ async def process_query_with_context(request:Query):
         logger.warning(f"Ошибка: {e}")
         raise HTTPException(status_code = 500, detail=str(e))
 
+@app.post("/query/batch")
+async def process_query_batch(request: BatchQuery):
+    # результаты идут построчно в формате NDJSON по мере готовности; поле index — номер вопроса в запросе.
+    # Ошибка отдельного вопроса возвращается в его строке с полем error и не прерывает пакет
+    if len(request.items) > RAG_BATCH_MAX_ITEMS:
+        raise HTTPException(status_code=413, detail=f"В пакете больше {RAG_BATCH_MAX_ITEMS} вопросов")
+    rag = ready_rag()
+    logger.info(f"Пакетный запрос: {len(request.items)} вопросов")
+
+    async def results():
+        async for result in rag.query_batch([(item.query, item.search_query, item.history_tokens) for item in request.items]):
+            yield json.dumps(result, ensure_ascii=False) + "\n"
+
+    return StreamingResponse(results(), media_type="application/x-ndjson")
+
 
 if __name__=='__main__':
-    uvicorn.run("main:app", host="0.0.0.0", port=8000)
+    uvicorn.run("main:app", host="0.0.0.0", port=8000, log_config=None)
 
@@ -0,0 +1,96 @@
+import logging
+import time
+import uuid
+from contextlib import contextmanager
+from contextvars import ContextVar
+from fastapi import FastAPI, Response
+from prometheus_client import CONTENT_TYPE_LATEST, Gauge, Histogram, generate_latest
+
+logger = logging.getLogger(__name__)
+
+REQUEST_ID_HEADER = "X-Request-ID"
+# служебные запросы Prometheus и проверок живости не замеряются и не пишутся в лог
+UNTRACKED_PATHS = {"/metrics", "/livez", "/readyz"}
+# длительности до минут: ответ LLM может генерироваться дольше 30 секунд
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+STAGE_SECONDS = Histogram("chatbot_stage_seconds", "Длительность этапов обработки запроса",
+                          ["service", "stage"], buckets=BUCKETS)
+REQUEST_SECONDS = Histogram("chatbot_http_request_seconds", "Длительность HTTP-запросов",
+                            ["service", "path", "status"], buckets=BUCKETS)
+IN_FLIGHT = Gauge("chatbot_in_flight_requests", "Запросы в обработке", ["service"])
+STAGE_IN_FLIGHT = Gauge("chatbot_stage_in_flight", "Запросы, находящиеся на этапе обработки", ["service", "stage"])
+
+request_id: ContextVar[str] = ContextVar("request_id", default="-")
+_stages: ContextVar[dict | None] = ContextVar("stages", default=None)
+_service = "unknown"
+
+
+@contextmanager
+def stage(name: str):
+    # длительность попадает в гистограмму и в разбивку текущего запроса, которая пишется в лог по его завершении
+    STAGE_IN_FLIGHT.labels(_service, name).inc()
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        STAGE_IN_FLIGHT.labels(_service, name).dec()
+        observe(name, time.perf_counter() - started)
+
+
+def observe(name: str, seconds: float):
+    # для этапов из нескольких отрезков времени, например ожидания фрагментов потокового ответа
+    STAGE_SECONDS.labels(_service, name).observe(seconds)
+    stages = _stages.get()
+    if stages is not None:
+        stages[name] = stages.get(name, 0.0) + seconds
+
+
+class MetricsMiddleware():
+    # ASGI-мидлварь, а не @app.middleware: так время потоковых ответов учитывается целиком, до последнего фрагмента
+    def __init__(self, app, service: str):
+        self.app = app
+        self.service = service
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"] in UNTRACKED_PATHS:
+            await self.app(scope, receive, send)
+            return
+        headers = dict(scope["headers"])
+        rid = headers.get(REQUEST_ID_HEADER.lower().encode(), b"").decode() or uuid.uuid4().hex
+        rid_token = request_id.set(rid)
+        stages = {}
+        stages_token = _stages.set(stages)
+        status = 500
+
+        async def send_with_request_id(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                message["headers"] = list(message.get("headers", [])) + [(REQUEST_ID_HEADER.lower().encode(), rid.encode())]
+            await send(message)
+
+        path = scope["path"]
+        IN_FLIGHT.labels(self.service).inc()
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_request_id)
+        finally:
+            elapsed = time.perf_counter() - started
+            IN_FLIGHT.labels(self.service).dec()
+            # неизвестные пути не попадают в метки, чтобы сканеры не раздували число временных рядов
+            REQUEST_SECONDS.labels(self.service, path if status != 404 else "other", str(status)).observe(elapsed)
+            breakdown = ", ".join(f"{name} {seconds:.3f}" for name, seconds in stages.items())
+            logger.info(f"{scope['method']} {path} {status} за {elapsed:.3f} c" + (f" ({breakdown})" if breakdown else ""))
+            request_id.reset(rid_token)
+            _stages.reset(stages_token)
+
+
+def setup_metrics(app: FastAPI, service: str):
+    global _service
+    _service = service
+    app.add_middleware(MetricsMiddleware, service=service)
+
+    @app.get('/metrics', include_in_schema=False)
+    async def metrics():
+        return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
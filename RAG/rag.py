@@ -1,156 +1,270 @@
+import asyncio
 import logging
 import os
 import json
-from glob import glob
-from typing import List
+import shutil
+import threading
+import time
+from contextlib import contextmanager
+from functools import partial
+from typing import AsyncIterator, List
 from pathlib import Path
-from langchain_chroma import Chroma
-from langchain_huggingface import HuggingFaceEmbeddings
 from langchain_core.documents import Document
-from langchain.text_splitter import CharacterTextSplitter
-import torch
-import tiktoken
-import sys
 from prompts import SYSTEM_PROMPT
+from embedding_batcher import EmbeddingBatcher
+from embeddings import EMBEDDING_PROBE_TEXT, create_embeddings
+from vector_index import create_vector_index
+from context import NO_CONTEXT, QUERY_TEMPLATE, ContextAssembler, count_tokens
+from lexical import LexicalIndex, document_key, reciprocal_rank_fusion
+from index_manifest import IndexManifest, ManifestEntry
+from metrics import request_id, stage
+from logging_setup import PAYLOAD, setup_logging
+from ingestion import (CHUNK_OVERLAP, CHUNK_SEPARATOR, CHUNK_SIZE, CHUNKING, SPLIT_THRESHOLD, IngestionProgress, bounded_map,
+                       create_executor, extract_text_from_json, iter_creatures, prepare_creature)
 
 os.environ['HF_HOME'] = os.getenv('HF_HOME', os.path.join(os.path.dirname(__file__), '.cache'))
 os.environ['TOKENIZERS_PARALLELISM'] = os.getenv('TOKENIZERS_PARALLELISM', 'false')
 
 log_dir = os.path.join(os.path.dirname(__file__), 'logs')
-os.makedirs(log_dir, exist_ok=True)
-
-console_handler = logging.StreamHandler(sys.stdout)
-file_handler = logging.FileHandler(os.path.join(log_dir, 'rag.log'))
-logging.basicConfig(
-    level = logging.INFO,
-    handlers=[console_handler, file_handler],
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
-)
+# ничего не меняет, если логирование уже настроил сервис (RAG/main.py или встроенный режим шлюза)
+setup_logging('rag', os.path.join(log_dir, 'rag.log'), request_id)
 
 logger = logging.getLogger(__name__)
 
+EMBED_BATCH_MAX_SIZE = int(os.getenv('EMBED_BATCH_MAX_SIZE', '32'))
+EMBED_BATCH_WINDOW_MS = float(os.getenv('EMBED_BATCH_WINDOW_MS', '10'))
+# наибольшее время ожидания эмбеддинга запроса в очереди батчера и в модели, 0 — без ограничения
+EMBED_DEADLINE_MS = float(os.getenv('EMBED_DEADLINE_MS', '2000'))
+INGEST_WORKERS = int(os.getenv('INGEST_WORKERS', str(min(4, os.cpu_count() or 1))))
+INGEST_BATCH_SIZE = int(os.getenv('INGEST_BATCH_SIZE', '64'))
+INGEST_MAX_IN_FLIGHT = int(os.getenv('INGEST_MAX_IN_FLIGHT', '32'))
+EMBEDDING_COMPAT_THRESHOLD = float(os.getenv('EMBEDDING_COMPAT_THRESHOLD', '0.99'))
+RETRIEVAL_CANDIDATES = int(os.getenv('RETRIEVAL_CANDIDATES', '8'))
+CONTEXT_MAX_TOKENS = int(os.getenv('CONTEXT_MAX_TOKENS', '3500'))
+CONTEXT_MAX_CHUNKS = int(os.getenv('CONTEXT_MAX_CHUNKS', '4'))
+# сколько вопросов пакетного запроса обрабатывается за один батч эмбеддингов и векторного поиска
+RAG_BATCH_CHUNK_SIZE = int(os.getenv('RAG_BATCH_CHUNK_SIZE', str(EMBED_BATCH_MAX_SIZE)))
+# true — синхронизация с базой знаний до приёма запросов, background — после запуска, false — только через /reindex
+RAG_SYNC_ON_STARTUP = os.getenv('RAG_SYNC_ON_STARTUP', 'true').lower()
+# готовый индекс, который копируется в пустое хранилище при первом запуске (собирается в образе build_snapshot.py)
+RAG_INDEX_SNAPSHOT = os.getenv('RAG_INDEX_SNAPSHOT')
+# не проверять совместимость эмбеддингов с существующим индексом при запуске
+RAG_TRUST_INDEX = os.getenv('RAG_TRUST_INDEX', 'false').lower() == 'true'
+RAG_WARMUP_QUERIES = int(os.getenv('RAG_WARMUP_QUERIES', '3'))
+WARMUP_QUERIES = [
+    EMBEDDING_PROBE_TEXT,
+    "Какие существа живут в горах?",
+    "Чем опасен дракон для человека?",
+    "Как выглядит самое маленькое существо?",
+]
+
 class RAG():
-    def __init__(self, knowledge_base:str, force_reload: bool = False):
+    def __init__(self, knowledge_base:str, force_reload: bool = False, startup_phases: dict | None = None):
         self.knowledge_base_path = knowledge_base
         self.force_reload = force_reload
-        
-        self.embeddings = HuggingFaceEmbeddings(model_name="intfloat/multilingual-e5-base",
-                                                model_kwargs={"device": "cuda" if torch.cuda.is_available() else "cpu"})
-        
-        self.vector_store = self._initialize_vector_store()
+        # длительность этапов запуска; словарь может передать сервис, чтобы показывать ход запуска в /readyz
+        self.startup_phases = startup_phases if startup_phases is not None else {}
+        self._embedding_probe = None
+
+        with self._phase("embeddings_load"):
+            self.embeddings = create_embeddings()
+        self.embedding_batcher = EmbeddingBatcher(self.embeddings,
+                                                  max_batch_size=EMBED_BATCH_MAX_SIZE,
+                                                  max_wait_ms=EMBED_BATCH_WINDOW_MS,
+                                                  deadline_ms=EMBED_DEADLINE_MS)
+
+        persist_dir = os.getenv('CHROMA_DB_PATH', os.path.join(os.path.dirname(__file__), 'chroma_db'))
+        self._sync_lock = threading.Lock()
+        self.context_assembler = ContextAssembler(SYSTEM_PROMPT, max_tokens=CONTEXT_MAX_TOKENS)
+        self.index_version = None
+        self.lexical: LexicalIndex | None = None
+        self._manifest_mtime = None
+        if RAG_INDEX_SNAPSHOT:
+            with self._phase("snapshot_restore"):
+                self._restore_snapshot(RAG_INDEX_SNAPSHOT, persist_dir)
+        with self._phase("index_open"):
+            self.index = create_vector_index(persist_dir)
+            # манифест лежит рядом с индексом, которому он соответствует
+            self.index_dir = self.index.path
+            manifest = IndexManifest.load(self.index_dir)
+        if self.index.was_reset:
+            self.force_reload = True
+
+        if manifest is not None and not RAG_TRUST_INDEX:
+            with self._phase("embedding_check"):
+                if not manifest.is_compatible(self.embedding_probe, EMBEDDING_COMPAT_THRESHOLD):
+                    logger.warning("Эмбеддинги текущего бэкенда несовместимы с векторным хранилищем, индекс будет перестроен")
+                    self.force_reload = True
+        if manifest is not None and manifest.chunking not in (None, CHUNKING):
+            # хеши существ не зависят от разбиения, поэтому при новых параметрах чанки пересчитываются все
+            logger.warning(f"Параметры разбиения изменились ({manifest.chunking} -> {CHUNKING}), индекс будет перестроен")
+            self.force_reload = True
+        self.last_sync_report = None
+        # синхронизация, отложенная до окончания запуска: её запускает сервис через sync_index
+        self.background_sync = False
+        if self.force_reload or manifest is None or RAG_SYNC_ON_STARTUP == 'true':
+            with self._phase("sync"):
+                self.sync_index()
+        else:
+            logger.info("Загрузка существующего векторного хранилища без синхронизации")
+            self.background_sync = RAG_SYNC_ON_STARTUP == 'background'
+        with self._phase("lexical_index"):
+            self.refresh_if_stale()
+
+    @contextmanager
+    def _phase(self, name: str):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.startup_phases[name] = round(time.perf_counter() - started, 3)
+            logger.info(f"Этап запуска {name}: {self.startup_phases[name]:.3f} c")
+
+    @property
+    def embedding_probe(self) -> List[float]:
+        # эмбеддинг контрольного текста нужен только для проверки совместимости и нового манифеста
+        if self._embedding_probe is None:
+            self._embedding_probe = self.embeddings.embed_query(EMBEDDING_PROBE_TEXT)
+        return self._embedding_probe
+
+    def _restore_snapshot(self, snapshot: str, persist_dir: str):
+        if not os.path.isdir(snapshot):
+            logger.warning(f"Снимок индекса {snapshot} не найден")
+            return
+        if os.path.isdir(persist_dir) and os.listdir(persist_dir):
+            return
+        # хранилище пустое (например, новый том): индекс не строится заново, а копируется из снимка
+        logger.info(f"Копирование снимка индекса из {snapshot} в {persist_dir}")
+        shutil.copytree(snapshot, persist_dir, dirs_exist_ok=True)
+
+    def warm_up(self):
+        # первые вызовы модели, векторного индекса и токенизатора заметно медленнее следующих:
+        # выполняем их до того, как сервис объявит готовность
+        with self._phase("warm_up"):
+            for query in WARMUP_QUERIES[:RAG_WARMUP_QUERIES]:
+                embedding = self.embeddings.embed_query(query)
+                self.index.search(embedding, RETRIEVAL_CANDIDATES)
+                if self.lexical is not None:
+                    self.lexical.match_name(query)
+                    self.lexical.search(query, RETRIEVAL_CANDIDATES)
+                count_tokens(query)
 
     def _extract_text_from_json(self, creature: dict) -> str:
-        
-        text_parts = []
-
-        for key in ["scientific_name", "common_name", "mythology", "science", "threats"]:
-            if key in creature and creature[key]:
-                text_parts.append(f"{key}: {creature[key]}")
-        if "habitat" in creature:
-            habitat = creature["habitat"]
-            if "location" in habitat and habitat["location"]:
-                text_parts.append(f"habitat location: {habitat['location']}")
-            if "description" in habitat and habitat["description"]:
-                text_parts.append(f"habitat description: {habitat['description']}")
-
-        if "appearance" in creature:
-            appearance = creature["appearance"]
-            for key, value in appearance.items():
-                if value:
-                    text_parts.append(f"appearance {key}: {value}")
-
-        if "behavior" in creature:
-            behavior = creature["behavior"]
-            for key, value in behavior.items():
-                if value:
-                    text_parts.append(f"behavior {key}: {value}")
-
-        return "\n".join(text_parts)
-    
-    def _load_knowledge_base(self) -> List[Document]:
-        logger.info(f"Загрузка базы знаний из {self.knowledge_base_path}...")
-
-        documents = []
-        text_splitter = CharacterTextSplitter(chunk_size=200, chunk_overlap=50)
-
-        json_files = glob(os.path.join(self.knowledge_base_path, "*.json"))
-        if not json_files:
-            logger.error(f"Не найдено JSON-файлов в папке {self.knowledge_base_path}")
-            raise FileNotFoundError(f"Не найдено JSON-файлов в папке {self.knowledge_base_path}")
-        
-        for json_file in json_files:
-            logger.info(f"Обработка файла: {json_file}")
-            try:
-                with open(json_file, 'r', encoding='utf-8') as file :
-                    data = json.load(file)
-            except json.JSONDecodeError as e:
-                logger.error(f"Ошибка при разборе JSON в файле {json_file}: {e}")
-                continue
+        return extract_text_from_json(creature)
 
-            if "creatures" not in data:
-                logger.warning(f"Файл {json_file} не содержит ключ 'creatures'. Пропускаем.")
-                continue
-            for creature in data["creatures"]:
-                if not creature.get("scientific_name") or not creature.get("common_name"):
-                    logger.warning(f"Пропущен элемент без scientific_name или common_name в файле {json_file}: {creature}")
+    def sync_index(self) -> dict:
+        # блокировка индекса общая для всех воркеров: синхронизация, начатая при запуске несколькими воркерами,
+        # выполняется по очереди, и следующие уже не находят изменений
+        with self._sync_lock, self.index.lock():
+            self.last_sync_report = self._sync_index()
+            return self.last_sync_report
+
+    def _sync_index(self) -> dict:
+        logger.info(f"Синхронизация векторного хранилища с базой знаний {self.knowledge_base_path}...")
+        manifest = None if self.force_reload else IndexManifest.load(self.index_dir)
+        if manifest is None:
+            # без манифеста неизвестно, каким существам принадлежат векторы, поэтому строим индекс заново
+            logger.info("Манифест индекса не найден или устарел, индекс строится заново")
+            manifest = IndexManifest(self.index_dir, embedding_probe=self.embedding_probe)
+            self.index.reset()
+            rebuilt = True
+        else:
+            rebuilt = False
+        self.force_reload = False
+        rebuilt = rebuilt or manifest.chunking != CHUNKING
+        manifest.chunking = CHUNKING
+
+        report = {"added": 0, "updated": 0, "removed": 0, "reused_vectors": 0, "recomputed_vectors": 0, "deleted_vectors": 0}
+        seen = set()
+        batch_documents, batch_ids = [], []
+        progress = IngestionProgress()
+        prepare = partial(prepare_creature, chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP,
+                          split_threshold=SPLIT_THRESHOLD, chunk_separator=CHUNK_SEPARATOR)
+
+        def write_batch():
+            # эмбеддинги считаются и записываются порциями фиксированного размера
+            vectors = self.embeddings.embed_documents([doc.page_content for doc in batch_documents])
+            self.index.add(batch_ids, batch_documents, vectors)
+            progress.vectors += len(batch_ids)
+            progress.log("Индексация")
+            batch_documents.clear()
+            batch_ids.clear()
+
+        executor = create_executor(INGEST_WORKERS)
+        try:
+            prepared = bounded_map(executor, prepare, iter_creatures(self.knowledge_base_path), INGEST_MAX_IN_FLIGHT)
+            for key, chunks, metadata, creature_hash, token_counts in prepared:
+                progress.creatures += 1
+                if key in seen:
+                    logger.warning(f"Повторное существо {key} в файле {metadata['source']}. Пропускаем.")
                     continue
+                seen.add(key)
 
-                content = self._extract_text_from_json(creature)
-                metadata = {
-                    "scientific_name": creature.get("scientific_name", ""),
-                    "common_name":creature.get("common_name", ""),
-                    "habitat_location": creature.get("habitat", {}).get("location", ""),
-                    "source": json_file
-                }
-                
-                if len(content) > 500: 
-                    chunks = text_splitter.split_text(content)
-                    for chunk in chunks:
-                        documents.append(Document(page_content=chunk, metadata=metadata))
+                entry = manifest.entries.get(key)
+                if entry is not None and entry.content_hash == creature_hash:
+                    report["reused_vectors"] += len(entry.ids)
+                    continue
+
+                if entry is not None:
+                    self.index.delete(entry.ids)
+                    report["deleted_vectors"] += len(entry.ids)
+                    report["updated"] += 1
                 else:
-                    documents.append(Document(page_content=content, metadata=metadata))
-                    
-        if not documents:
+                    report["added"] += 1
+                ids = [f"{key}#{i}" for i in range(len(chunks))]
+                batch_documents.extend(Document(page_content=chunk, metadata={**metadata, "token_count": token_count})
+                                       for chunk, token_count in zip(chunks, token_counts))
+                batch_ids.extend(ids)
+                manifest.entries[key] = ManifestEntry(creature_hash, ids)
+                report["recomputed_vectors"] += len(ids)
+                if len(batch_ids) >= INGEST_BATCH_SIZE:
+                    write_batch()
+            if batch_ids:
+                write_batch()
+        finally:
+            if executor is not None:
+                executor.shutdown(cancel_futures=True)
+        progress.log("Индексация завершена")
+
+        if not seen:
             logger.error("Не удалось загрузить ни одного документа из базы знаний.")
             raise ValueError("Не удалось загрузить ни одного документа из базы знаний.")
-        
-        logger.info(f"Загружено {len(documents)} документов из базы знаний.")
-        return documents
-
-    def _initialize_vector_store(self) -> Chroma:
 
-        persist_dir = os.getenv('CHROMA_DB_PATH', os.path.join(os.path.dirname(__file__), 'chroma_db'))
-        os.makedirs(persist_dir, exist_ok=True)
+        for key in set(manifest.entries) - seen:
+            entry = manifest.entries.pop(key)
+            self.index.delete(entry.ids)
+            report["deleted_vectors"] += len(entry.ids)
+            report["removed"] += 1
 
-        db_file = os.path.join(persist_dir, "chroma.sqlite3")
-        if os.path.exists(db_file) and not self.force_reload:
-            logger.info("Загрузка существующего векторного хранилища...")
-            try:
-                return Chroma(
-                    persist_directory=persist_dir,
-                    embedding_function=self.embeddings,
-                )
-            except Exception as e:
-                logger.error(f"Ошибка загрузки ChromaDB: {e}, пересоздаем хранилище")
-                return self._create_new_vector_store(persist_dir)
+        if rebuilt or report["added"] or report["updated"] or report["removed"]:
+            self.index.commit()
+            manifest.save()
         else:
-            return self._create_new_vector_store(persist_dir)
-
-    def _create_new_vector_store(self, persist_dir):
-        logger.info("Создание нового векторного хранилища")
-        documents = self._load_knowledge_base()
-        return Chroma.from_documents(
-            documents=documents,
-            embedding=self.embeddings,
-            persist_directory=persist_dir
-        )
-    def _get_token_count(self, text:str):
+            # без изменений индекс и манифест не переписываются, версия индекса у воркеров остаётся прежней
+            logger.info("Изменений в базе знаний нет, индекс не перезаписывается")
+        self.refresh_if_stale()
+        report["index_version"] = self.index_version
+        logger.info(f"Синхронизация завершена: {report}")
+        return report
+
+    def refresh_if_stale(self):
+        # индекс мог быть обновлён другим воркером: версия и лексический индекс следуют за манифестом
         try:
-            encoding = tiktoken.get_encoding("cl100k_base")
-            return len(encoding.encode(text))
-        except Exception as e:
-           logger.error(f"Ошибка при подсчете токенов с tiktoken: {e}")
-           return len(text) // 4
+            mtime = os.stat(os.path.join(self.index_dir, IndexManifest.FILE_NAME)).st_mtime_ns
+        except FileNotFoundError:
+            return
+        if mtime == self._manifest_mtime:
+            return
+        manifest = IndexManifest.load(self.index_dir)
+        if manifest is None:
+            return
+        self._manifest_mtime = mtime
+        self.index_version = manifest.version()
+        self.lexical = LexicalIndex(self.index.documents())
+        logger.info(f"Лексический индекс построен по {len(self.lexical.documents)} чанкам, версия индекса {self.index_version}")
+
+    def _get_token_count(self, text:str):
+        return count_tokens(text)
         
     def truncate_prompt(self, prompt: str, system_prompt:str, max_tokens: int = 3500) -> str:
         estimated_tokens = self._get_token_count(prompt)
@@ -168,22 +282,145 @@ class RAG():
         # если текст начинается не с пробела, чтобы текст начинался с полного слова
         if first_space > 0:
             truncated = truncated[first_space+1:]
-        logger.info(f"обрезанный текст: {truncated}")
+        logger.info("обрезанный текст: %s", truncated, extra=PAYLOAD)
         return truncated
         
 
-    async def get_query_with_context(self, query:str) -> str:
+    async def embed_query(self, query: str) -> List[float]:
+        with stage("embedding"):
+            return await self.embedding_batcher.embed(query)
+
+    async def search(self, embedding: List[float], k: int) -> List[tuple[Document, float]]:
+        with stage("vector_search"):
+            if self.index.blocking:
+                return await asyncio.to_thread(self.index.search, embedding, k)
+            return self.index.search(embedding, k)
+
+    async def retrieve(self, query: str, k: int, embedding: List[float] = None) -> List[tuple[Document, float]]:
+        self.refresh_if_stale()
+        lexical = self.lexical
+        with stage("lexical_search"):
+            scientific_name = lexical.match_name(query) if lexical is not None else None
+            if scientific_name:
+                # вопрос называет существо напрямую: эмбеддинг и векторный поиск не нужны
+                logger.info(f"Найдено имя существа в запросе: {scientific_name}")
+                return [(doc, 1.0) for doc in lexical.creature_documents(scientific_name, query, k)]
+
+        if embedding is None:
+            embedding = await self.embed_query(query)
+        vector_hits = await self.search(embedding, max(k, RETRIEVAL_CANDIDATES))
+        return self._fuse(query, vector_hits, lexical, k)
+
+    def _fuse(self, query: str, vector_hits: List[tuple[Document, float]], lexical: LexicalIndex | None,
+              k: int) -> List[tuple[Document, float]]:
+        if lexical is None:
+            return vector_hits[:k]
+        # оценкой остаётся косинусная близость из векторного поиска, порядок — по reciprocal rank fusion
+        vector_scores = {document_key(doc): score for doc, score in vector_hits}
+        with stage("lexical_search"):
+            fused = reciprocal_rank_fusion([
+                [doc for doc, _ in vector_hits],
+                lexical.search(query, max(k, RETRIEVAL_CANDIDATES)),
+            ])
+        return [(doc, vector_scores.get(document_key(doc), 0.0)) for doc in fused[:k]]
+
+    async def retrieve_batch(self, queries: List[str], k: int) -> List[List[tuple[Document, float]]]:
+        # то же, что retrieve для каждого запроса, но эмбеддинги считаются одним батчем,
+        # а векторный поиск выполняется одной матричной операцией
+        self.refresh_if_stale()
+        lexical = self.lexical
+        results = [None] * len(queries)
+        pending = []
+        with stage("lexical_search"):
+            for i, query in enumerate(queries):
+                scientific_name = lexical.match_name(query) if lexical is not None else None
+                if scientific_name:
+                    results[i] = [(doc, 1.0) for doc in lexical.creature_documents(scientific_name, query, k)]
+                else:
+                    pending.append(i)
+        if not pending:
+            return results
+        with stage("embedding"):
+            # одновременные запросы к батчеру уходят в модель общими батчами по EMBED_BATCH_MAX_SIZE
+            embeddings = await asyncio.gather(*(self.embedding_batcher.embed(queries[i]) for i in pending))
+        with stage("vector_search"):
+            batch_hits = await asyncio.to_thread(self.index.search_batch, list(embeddings), max(k, RETRIEVAL_CANDIDATES))
+        for i, vector_hits in zip(pending, batch_hits):
+            results[i] = self._fuse(queries[i], vector_hits, lexical, k)
+        return results
+
+    def search_text(self, query: str, search_query: str = None) -> str:
+        # уточняющий вопрос ищется вместе с предыдущим вопросом пользователя, если сам не называет существо
+        if not search_query or search_query == query:
+            return query
+        lexical = self.lexical
+        if lexical is not None and lexical.match_name(query):
+            return query
+        return search_query
+
+    async def retrieve_context(self, query: str, embedding: List[float] = None,
+                               history_tokens: int = 0) -> tuple[str, List[float]]:
+        # вместе с контекстом возвращаются оценки релевантности найденных чанков: по ним шлюз решает,
+        # передавать ли вопрос оператору без обращения к LLM
         logger.info(f"Поиск релевантного контекста для запроса: {query}")
-        relevant_docs = await self.vector_store.asimilarity_search(query, k=2)
+        hits = await self.retrieve(query, k=CONTEXT_MAX_CHUNKS, embedding=embedding)
+        return self._assemble_context(query, hits, history_tokens), [score for _, score in hits]
 
-        if not relevant_docs:
+    def _assemble_context(self, query: str, hits: List[tuple[Document, float]], history_tokens: int = 0) -> str:
+        if not hits:
             logger.warning("Контекст не найден для запроса")
-            context = "Контекст отсутствует."
-        else:
-            context = "\n".join([f"{doc.metadata['common_name']} ({doc.metadata['scientific_name']}): {doc.page_content}" for doc in relevant_docs])
-            logger.info(f"Найденный контекст: {context}")
+            return NO_CONTEXT
+        with stage("token_counting"):
+            context = self.context_assembler.assemble(query, hits, history_tokens)
+        # полный текст контекста пишется только для доли запросов LOG_PAYLOAD_SAMPLE_RATE
+        logger.info("Найденный контекст: %s", context, extra=PAYLOAD)
+        return context
+
+    @staticmethod
+    def relevance(scores: List[float]) -> dict:
+        # косинусная близость чанков из векторного поиска; 1.0 — существо названо в вопросе,
+        # 0.0 — чанк найден только по BM25 или контекст не найден
+        return {"scores": [round(score, 4) for score in scores], "max_score": round(max(scores, default=0.0), 4)}
+
+    def build_query_with_context(self, query: str, context: str, history_tokens: int = 0) -> str:
+        query_with_context = QUERY_TEMPLATE.format(context=context, query=query)
+        logger.info("Расширенный запрос: %s", query_with_context, extra=PAYLOAD)
+        with stage("token_counting"):
+            return self.truncate_prompt(query_with_context, SYSTEM_PROMPT, max_tokens=CONTEXT_MAX_TOKENS - history_tokens)
 
-        query_with_context = f"Контекст: {context}\n\nВопрос: {query}"
-        logger.info(f"Расширенный запрос: {query_with_context}")
-        logger.info(f"Используем функцию уменьшения промпта, если необходимо")
-        return self.truncate_prompt(query_with_context, SYSTEM_PROMPT)
+    async def get_query_with_context(self, query:str) -> str:
+        context, _ = await self.retrieve_context(query)
+        return self.build_query_with_context(query, context)
+
+    async def query_batch(self, items: List[tuple[str, str | None, int]]) -> AsyncIterator[dict]:
+        # items — (вопрос, текст для поиска, токены истории диалога). Результаты отдаются порциями по RAG_BATCH_CHUNK_SIZE,
+        # ошибка в порции отмечается у её элементов и не прерывает остальные
+        for start in range(0, len(items), RAG_BATCH_CHUNK_SIZE):
+            chunk = []
+            for index, (query, search_query, history_tokens) in enumerate(items[start:start + RAG_BATCH_CHUNK_SIZE], start):
+                if not query.strip():
+                    yield {"index": index, "error": "Некорректный запрос. Пользователь отправил пустой запрос"}
+                else:
+                    chunk.append((index, query, self.search_text(query, search_query), history_tokens))
+            if not chunk:
+                continue
+            try:
+                batch_hits = await self.retrieve_batch([search_text for _, _, search_text, _ in chunk], CONTEXT_MAX_CHUNKS)
+            except Exception as e:
+                logger.error(f"Ошибка поиска контекста для элементов {chunk[0][0]}-{chunk[-1][0]}: {e}")
+                for index, _, _, _ in chunk:
+                    yield {"index": index, "error": str(e)}
+                continue
+            for (index, query, search_text, history_tokens), hits in zip(chunk, batch_hits):
+                try:
+                    context = self._assemble_context(search_text, hits, history_tokens)
+                    yield {
+                        "index": index,
+                        "query_with_context": self.build_query_with_context(query, context, history_tokens),
+                        "context": context,
+                        "index_version": self.index_version,
+                        **self.relevance([score for _, score in hits]),
+                    }
+                except Exception as e:
+                    logger.error(f"Ошибка сборки контекста для элемента {index}: {e}")
+                    yield {"index": index, "error": str(e)}
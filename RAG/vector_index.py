@@ -0,0 +1,464 @@
+import fcntl
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+from abc import ABC, abstractmethod
+from typing import List
+import numpy as np
+from langchain_core.documents import Document
+
+logger = logging.getLogger(__name__)
+
+METADATA_KEYS = ["scientific_name", "common_name", "habitat_location", "source", "token_count"]
+LOCK_FILE = "index.lock"
+
+
+class FileLock():
+    # Межпроцессная блокировка через flock. Повторный захват в том же процессе не блокирует:
+    # синхронизация держит блокировку целиком, а commit() внутри неё захватывает её снова
+    def __init__(self, path: str):
+        self.path = path
+        self._thread_lock = threading.RLock()
+        self._depth = 0
+        self._file = None
+
+    def acquire(self, blocking: bool = True) -> bool:
+        if not self._thread_lock.acquire(blocking=blocking):
+            return False
+        if self._depth == 0:
+            file = open(self.path, 'a')
+            try:
+                fcntl.flock(file, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                file.close()
+                self._thread_lock.release()
+                return False
+            self._file = file
+        self._depth += 1
+        return True
+
+    def release(self):
+        self._depth -= 1
+        if self._depth == 0:
+            fcntl.flock(self._file, fcntl.LOCK_UN)
+            self._file.close()
+            self._file = None
+        self._thread_lock.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+
+class VectorIndex(ABC):
+    # Хранилище векторов чанков базы знаний. Оценка в результатах поиска — косинусная близость,
+    # чем больше, тем релевантнее
+    path: str
+    # поиск блокирует поток и должен выполняться вне цикла событий
+    blocking = True
+
+    @abstractmethod
+    def add(self, ids: List[str], documents: List[Document], embeddings: List[List[float]]):
+        ...
+
+    @abstractmethod
+    def delete(self, ids: List[str]):
+        ...
+
+    @abstractmethod
+    def reset(self):
+        ...
+
+    def commit(self):
+        pass
+
+    def lock(self) -> FileLock:
+        # общая для всех воркеров блокировка индекса: синхронизацию и запись выполняет один процесс за раз
+        if getattr(self, "_lock", None) is None:
+            self._lock = FileLock(os.path.join(self.path, LOCK_FILE))
+        return self._lock
+
+    @abstractmethod
+    def search(self, embedding: List[float], k: int) -> List[tuple[Document, float]]:
+        ...
+
+    def search_batch(self, embeddings: List[List[float]], k: int) -> List[List[tuple[Document, float]]]:
+        return [self.search(embedding, k) for embedding in embeddings]
+
+    @abstractmethod
+    def count(self) -> int:
+        ...
+
+    @abstractmethod
+    def documents(self) -> List[Document]:
+        ...
+
+
+class ChromaIndex(VectorIndex):
+    COLLECTION_NAME = "langchain"
+
+    def __init__(self, persist_dir: str):
+        import chromadb
+
+        self.path = persist_dir
+        # индекс был пересоздан и должен быть заполнен заново
+        self.was_reset = False
+        os.makedirs(persist_dir, exist_ok=True)
+        try:
+            self.client = chromadb.PersistentClient(path=persist_dir)
+            self.collection = self._get_collection()
+        except Exception as e:
+            logger.error(f"Ошибка загрузки ChromaDB: {e}, пересоздаем хранилище")
+            for name in os.listdir(persist_dir):
+                path = os.path.join(persist_dir, name)
+                shutil.rmtree(path) if os.path.isdir(path) else os.remove(path)
+            self.client = chromadb.PersistentClient(path=persist_dir)
+            self.collection = self._get_collection()
+            self.was_reset = True
+
+    def _get_collection(self):
+        collection = self.client.get_or_create_collection(self.COLLECTION_NAME, metadata={"hnsw:space": "cosine"})
+        if (collection.metadata or {}).get("hnsw:space") != "cosine":
+            # хранилища, созданные раньше, используют L2; для сопоставимых оценок нужна косинусная метрика
+            logger.warning("Коллекция Chroma использует метрику L2, пересоздаем её с косинусной метрикой")
+            self.client.delete_collection(self.COLLECTION_NAME)
+            collection = self.client.create_collection(self.COLLECTION_NAME, metadata={"hnsw:space": "cosine"})
+            self.was_reset = True
+        return collection
+
+    def add(self, ids: List[str], documents: List[Document], embeddings: List[List[float]]):
+        self.collection.upsert(
+            ids=ids,
+            embeddings=embeddings,
+            documents=[doc.page_content for doc in documents],
+            metadatas=[doc.metadata for doc in documents],
+        )
+
+    def delete(self, ids: List[str]):
+        if ids:
+            self.collection.delete(ids=ids)
+
+    def reset(self):
+        ids = self.collection.get(include=[])["ids"]
+        if ids:
+            logger.info(f"Удаляем {len(ids)} векторов из Chroma")
+            self.collection.delete(ids=ids)
+
+    def search(self, embedding: List[float], k: int) -> List[tuple[Document, float]]:
+        result = self.collection.query(query_embeddings=[embedding], n_results=k,
+                                       include=["documents", "metadatas", "distances"])
+        return [
+            (Document(page_content=text, metadata=metadata), 1.0 - distance)
+            for text, metadata, distance in zip(result["documents"][0], result["metadatas"][0], result["distances"][0])
+        ]
+
+    def search_batch(self, embeddings: List[List[float]], k: int) -> List[List[tuple[Document, float]]]:
+        if not embeddings:
+            return []
+        result = self.collection.query(query_embeddings=embeddings, n_results=k,
+                                       include=["documents", "metadatas", "distances"])
+        return [
+            [(Document(page_content=text, metadata=metadata), 1.0 - distance)
+             for text, metadata, distance in zip(texts, metadatas, distances)]
+            for texts, metadatas, distances in zip(result["documents"], result["metadatas"], result["distances"])
+        ]
+
+    def count(self) -> int:
+        return self.collection.count()
+
+    def documents(self) -> List[Document]:
+        result = self.collection.get(include=["documents", "metadatas"])
+        return [Document(page_content=text, metadata=metadata) for text, metadata in zip(result["documents"], result["metadatas"])]
+
+
+class NumpyState():
+    # Загруженная версия индекса. Заменяется целиком одним присваиванием, поэтому поиск,
+    # идущий одновременно с перечитыванием, видит согласованные ids, тексты и векторы
+    def __init__(self, ids: List[str] | None = None, texts: List[str] | None = None,
+                 metadata: dict[str, List[str]] | None = None, vectors: np.ndarray | None = None, hnsw=None,
+                 files: tuple[str, ...] = ()):
+        self.ids = ids or []
+        self.texts = texts or []
+        self.metadata = metadata or {key: [] for key in METADATA_KEYS}
+        self.vectors = vectors
+        self.hnsw = hnsw
+        # файлы векторов и графа HNSW этой версии
+        self.files = files
+
+    def document(self, row: int) -> Document:
+        return Document(page_content=self.texts[row], metadata={key: self.metadata[key][row] for key in METADATA_KEYS})
+
+
+class NumpyIndex(VectorIndex):
+    # Нормализованные векторы хранятся в .npy и открываются через memory map, поэтому несколько
+    # воркеров uvicorn используют одни и те же страницы файла без копирования. Тексты и метаданные
+    # лежат рядом в колоночном JSON. Изменения копятся во временном файле процесса и применяются в commit()
+    # под межпроцессной блокировкой. Векторы и граф HNSW каждой версии пишутся в новые файлы, а файл метаданных
+    # ссылается на них и заменяется атомарно последним: процесс, перечитывающий индекс без блокировки,
+    # видит либо старую версию целиком, либо новую. Остальные процессы перечитывают индекс при смене версии
+    VECTORS_FILE = "vectors.npy"
+    METADATA_FILE = "metadata.json"
+    HNSW_FILE = "hnsw.bin"
+    VECTORS_PREFIX = "vectors."
+    HNSW_PREFIX = "hnsw."
+    STAGING_PREFIX = "staging."
+    COPY_CHUNK = 65536
+    RELOAD_ATTEMPTS = 3
+
+    blocking = False
+
+    def __init__(self, path: str, dtype: str = "float32", use_hnsw: bool = False):
+        self.path = path
+        self.dtype = np.dtype(dtype)
+        self.use_hnsw = use_hnsw
+        self.was_reset = False
+        os.makedirs(path, exist_ok=True)
+        self._loaded_version = None
+        self._state = NumpyState()
+        self._deleted: set[str] = set()
+        self._reset_pending = False
+        # у каждого процесса свой файл накопления: воркеры не удаляют и не дописывают чужие
+        self._staging_file = self._file(f"{self.STAGING_PREFIX}{os.getpid()}.f32")
+        self._staged_ids: List[str] = []
+        self._staged_texts: List[str] = []
+        self._staged_metadata: dict[str, List[str]] = {key: [] for key in METADATA_KEYS}
+        self._remove_stale_files()
+        self._reload()
+
+    def _file(self, name: str) -> str:
+        return os.path.join(self.path, name)
+
+    def _remove_stale_files(self):
+        # незавершённые записи от прерванных синхронизаций удаляются, только если никто не держит блокировку:
+        # иначе это файлы синхронизации, которая идёт в другом процессе
+        if not self.lock().acquire(blocking=False):
+            return
+        try:
+            for name in os.listdir(self.path):
+                if name.startswith(self.STAGING_PREFIX) or name.endswith(".tmp"):
+                    os.remove(self._file(name))
+        finally:
+            self.lock().release()
+
+    @property
+    def ids(self) -> List[str]:
+        return self._state.ids
+
+    @property
+    def vectors(self) -> np.ndarray | None:
+        return self._state.vectors
+
+    def _version(self):
+        try:
+            return os.stat(self._file(self.METADATA_FILE)).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    def _reload(self) -> NumpyState:
+        version = self._version()
+        if version == self._loaded_version or version is None:
+            return self._state
+        for attempt in range(self.RELOAD_ATTEMPTS):
+            try:
+                state = self._load()
+                break
+            except (FileNotFoundError, ValueError) as e:
+                # пока читали метаданные, другой процесс записал ещё две версии и удалил файлы прочитанной
+                if attempt == self.RELOAD_ATTEMPTS - 1:
+                    raise
+                logger.warning(f"Индекс NumPy изменился во время чтения ({e}), перечитываем")
+                version = self._version()
+        self._state = state
+        self._loaded_version = version
+        logger.info(f"Загружен индекс NumPy: {len(state.ids)} векторов из {self.path}")
+        return self._state
+
+    def _load(self) -> NumpyState:
+        with open(self._file(self.METADATA_FILE), 'r', encoding='utf-8') as file:
+            data = json.load(file)
+        ids = data["ids"]
+        # индексы, записанные до версионных файлов, хранят векторы и граф под постоянными именами
+        vectors_file = data.get("vectors_file", self.VECTORS_FILE)
+        hnsw_file = data.get("hnsw_file", self.HNSW_FILE)
+        vectors = np.load(self._file(vectors_file), mmap_mode='r') if ids else None
+        if vectors is not None and vectors.shape[0] != len(ids):
+            raise ValueError(f"векторов {vectors.shape[0]}, идентификаторов {len(ids)}")
+        hnsw = None
+        if self.use_hnsw and vectors is not None:
+            import hnswlib
+
+            hnsw = hnswlib.Index(space='ip', dim=vectors.shape[1])
+            hnsw.load_index(self._file(hnsw_file), max_elements=len(ids))
+        metadata = {key: data["metadata"].get(key, [""] * len(ids)) for key in METADATA_KEYS}
+        return NumpyState(ids, data["texts"], metadata, vectors, hnsw, files=(vectors_file, hnsw_file))
+
+    def add(self, ids: List[str], documents: List[Document], embeddings: List[List[float]]):
+        vectors = np.asarray(embeddings, dtype=np.float32)
+        vectors /= np.clip(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12, None)
+        with open(self._staging_file, 'ab') as file:
+            file.write(vectors.tobytes())
+        self._staged_ids.extend(ids)
+        self._staged_texts.extend(doc.page_content for doc in documents)
+        for key in METADATA_KEYS:
+            self._staged_metadata[key].extend(doc.metadata.get(key, "") for doc in documents)
+
+    def delete(self, ids: List[str]):
+        self._deleted.update(ids)
+
+    def reset(self):
+        self._reset_pending = True
+
+    def commit(self):
+        if not (self._staged_ids or self._deleted or self._reset_pending):
+            # без изменений файлы не переписываются: версия индекса у остальных процессов не меняется
+            return
+        with self.lock():
+            self._commit()
+
+    def _commit(self):
+        state = self._reload()
+        keep = [] if self._reset_pending else [i for i, id_ in enumerate(state.ids) if id_ not in self._deleted]
+        staged = None
+        if self._staged_ids:
+            staged = np.memmap(self._staging_file, dtype=np.float32, mode='r').reshape(len(self._staged_ids), -1)
+        dim = staged.shape[1] if staged is not None else (state.vectors.shape[1] if state.vectors is not None else 0)
+
+        total = len(keep) + len(self._staged_ids)
+        # новая версия пишется в новые файлы: процессы, читающие текущую, их не видят до замены метаданных
+        generation = time.time_ns()
+        vectors_file = f"{self.VECTORS_PREFIX}{generation}.npy"
+        hnsw_file = f"{self.HNSW_PREFIX}{generation}.bin"
+        if total:
+            # копируем порциями, чтобы не держать весь индекс в памяти
+            out = np.lib.format.open_memmap(self._file(vectors_file), mode='w+', dtype=self.dtype, shape=(total, dim))
+            for start in range(0, len(keep), self.COPY_CHUNK):
+                rows = keep[start:start + self.COPY_CHUNK]
+                out[start:start + len(rows)] = state.vectors[rows]
+            for start in range(0, len(self._staged_ids), self.COPY_CHUNK):
+                chunk = staged[start:start + self.COPY_CHUNK]
+                out[len(keep) + start:len(keep) + start + len(chunk)] = chunk
+            out.flush()
+            if self.use_hnsw:
+                self._build_hnsw(out, hnsw_file)
+            del out
+        else:
+            with open(self._file(vectors_file), 'wb') as file:
+                np.save(file, np.zeros((0, dim), dtype=self.dtype))
+
+        data = {
+            "ids": [state.ids[i] for i in keep] + self._staged_ids,
+            "texts": [state.texts[i] for i in keep] + self._staged_texts,
+            "metadata": {key: [state.metadata[key][i] for i in keep] + self._staged_metadata[key] for key in METADATA_KEYS},
+            "vectors_file": vectors_file,
+            "hnsw_file": hnsw_file,
+        }
+        tmp_metadata = self._file(self.METADATA_FILE + f".{os.getpid()}.tmp")
+        with open(tmp_metadata, 'w', encoding='utf-8') as file:
+            json.dump(data, file, ensure_ascii=False)
+        # замена файла метаданных публикует версию целиком: его mtime служит версией индекса
+        os.replace(tmp_metadata, self._file(self.METADATA_FILE))
+        # файлы предыдущей версии остаются для процессов, которые как раз её читают; более старые удаляются.
+        # Уже открытые через memory map файлы после удаления остаются доступны читающему процессу
+        self._remove_old_files({vectors_file, hnsw_file, *state.files})
+
+        del staged
+        if os.path.exists(self._staging_file):
+            os.remove(self._staging_file)
+        self._deleted.clear()
+        self._reset_pending = False
+        self._staged_ids, self._staged_texts = [], []
+        self._staged_metadata = {key: [] for key in METADATA_KEYS}
+        self._loaded_version = None
+        self._reload()
+
+    def _remove_old_files(self, keep: set[str]):
+        for name in os.listdir(self.path):
+            versioned = ((name.startswith(self.VECTORS_PREFIX) and name.endswith(".npy"))
+                         or (name.startswith(self.HNSW_PREFIX) and name.endswith(".bin")))
+            if versioned and name not in keep:
+                try:
+                    os.remove(self._file(name))
+                except FileNotFoundError:
+                    pass
+
+    def _build_hnsw(self, vectors: np.ndarray, hnsw_file: str):
+        import hnswlib
+
+        index = hnswlib.Index(space='ip', dim=vectors.shape[1])
+        index.init_index(max_elements=len(vectors), ef_construction=200, M=16)
+        for start in range(0, len(vectors), self.COPY_CHUNK):
+            chunk = np.asarray(vectors[start:start + self.COPY_CHUNK], dtype=np.float32)
+            index.add_items(chunk, np.arange(start, start + len(chunk)))
+        index.save_index(self._file(hnsw_file))
+
+    def search(self, embedding: List[float], k: int) -> List[tuple[Document, float]]:
+        state = self._reload()
+        if state.vectors is None or not k:
+            return []
+        query = np.asarray(embedding, dtype=np.float32)
+        query /= max(float(np.linalg.norm(query)), 1e-12)
+        k = min(k, len(state.ids))
+
+        if state.hnsw is not None:
+            state.hnsw.set_ef(max(64, k))
+            labels, distances = state.hnsw.knn_query(query, k=k)
+            # для пространства ip hnswlib возвращает 1 - скалярное произведение
+            return [(state.document(int(row)), 1.0 - float(distance)) for row, distance in zip(labels[0], distances[0])]
+
+        scores = np.empty(len(state.ids), dtype=np.float32)
+        for start in range(0, len(state.ids), self.COPY_CHUNK):
+            scores[start:start + self.COPY_CHUNK] = state.vectors[start:start + self.COPY_CHUNK] @ query
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [(state.document(int(row)), float(scores[row])) for row in top]
+
+    def search_batch(self, embeddings: List[List[float]], k: int) -> List[List[tuple[Document, float]]]:
+        # все запросы сравниваются с каждой порцией индекса одним матричным умножением
+        state = self._reload()
+        if state.vectors is None or not k or not embeddings:
+            return [[] for _ in embeddings]
+        queries = np.asarray(embeddings, dtype=np.float32)
+        queries /= np.clip(np.linalg.norm(queries, axis=1, keepdims=True), 1e-12, None)
+        k = min(k, len(state.ids))
+
+        if state.hnsw is not None:
+            state.hnsw.set_ef(max(64, k))
+            labels, distances = state.hnsw.knn_query(queries, k=k)
+            return [[(state.document(int(row)), 1.0 - float(distance)) for row, distance in zip(rows, row_distances)]
+                    for rows, row_distances in zip(labels, distances)]
+
+        scores = np.empty((len(queries), len(state.ids)), dtype=np.float32)
+        for start in range(0, len(state.ids), self.COPY_CHUNK):
+            scores[:, start:start + self.COPY_CHUNK] = queries @ state.vectors[start:start + self.COPY_CHUNK].T
+        top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        results = []
+        for row_scores, candidates in zip(scores, top):
+            candidates = candidates[np.argsort(-row_scores[candidates])]
+            results.append([(state.document(int(row)), float(row_scores[row])) for row in candidates])
+        return results
+
+    def count(self) -> int:
+        return len(self._reload().ids)
+
+    def documents(self) -> List[Document]:
+        state = self._reload()
+        return [state.document(row) for row in range(len(state.ids))]
+
+
+def create_vector_index(persist_dir: str, kind: str | None = None) -> VectorIndex:
+    kind = kind or os.getenv('VECTOR_INDEX', 'chroma')
+    if kind == "chroma":
+        return ChromaIndex(persist_dir)
+    if kind == "numpy":
+        return NumpyIndex(
+            os.path.join(persist_dir, 'numpy_index'),
+            dtype=os.getenv('VECTOR_INDEX_DTYPE', 'float32'),
+            use_hnsw=os.getenv('VECTOR_INDEX_HNSW', 'false').lower() == 'true',
+        )
+    raise ValueError(f"Неизвестный тип векторного индекса: {kind}")
@@ -0,0 +1,109 @@
+"""Сравнение бэкендов эмбеддингов RAG-сервиса: задержка, память и совпадение результатов поиска.
+
+Запуск из корня репозитория:
+    python benchmarks/embedding_backends.py --backends torch onnx --k 2
+Каждый бэкенд запускается в отдельном процессе, чтобы пиковая память (RSS) не смешивалась.
+"""
+import argparse
+import multiprocessing
+import os
+import resource
+import statistics
+import sys
+import time
+
+RAG_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'RAG')
+sys.path.insert(0, RAG_DIR)
+
+
+def load_corpus(knowledge_base: str) -> tuple[list[str], list[str], list[str]]:
+    from ingestion import iter_creatures, prepare_creature
+
+    texts, labels, queries = [], [], []
+    for item in iter_creatures(knowledge_base):
+        name, chunks, metadata = prepare_creature(item)[:3]
+        texts.extend(chunks)
+        labels.extend([name] * len(chunks))
+        queries.append(f"Где обитает {metadata['common_name']}?")
+        queries.append(f"Как выглядит {metadata['common_name']}?")
+    return texts, labels, queries
+
+
+def run_backend(backend: str, texts: list[str], queries: list[str], result_queue):
+    from embeddings import create_embeddings
+
+    started = time.perf_counter()
+    embeddings = create_embeddings(backend)
+    load_time = time.perf_counter() - started
+
+    started = time.perf_counter()
+    corpus_vectors = embeddings.embed_documents(texts)
+    corpus_time = time.perf_counter() - started
+
+    query_vectors, latencies = [], []
+    for query in queries:
+        started = time.perf_counter()
+        query_vectors.append(embeddings.embed_query(query))
+        latencies.append(time.perf_counter() - started)
+
+    result_queue.put({
+        "backend": backend,
+        "load_time": load_time,
+        "corpus_throughput": len(texts) / corpus_time,
+        "query_p50_ms": statistics.median(latencies) * 1000,
+        "query_p95_ms": statistics.quantiles(latencies, n=20)[-1] * 1000,
+        # ru_maxrss в Linux измеряется в килобайтах
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "corpus_vectors": corpus_vectors,
+        "query_vectors": query_vectors,
+    })
+
+
+def top_k(query_vectors, corpus_vectors, k: int) -> list[list[int]]:
+    import numpy as np
+
+    corpus = np.asarray(corpus_vectors, dtype=np.float32)
+    queries = np.asarray(query_vectors, dtype=np.float32)
+    # оба векторных индекса ранжируют по косинусной близости
+    corpus /= np.linalg.norm(corpus, axis=1, keepdims=True)
+    queries /= np.linalg.norm(queries, axis=1, keepdims=True)
+    return np.argsort(-(queries @ corpus.T), axis=1)[:, :k].tolist()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--backends', nargs='+', default=['torch', 'onnx'])
+    parser.add_argument('--knowledge-base', default=os.path.join(RAG_DIR, 'knowledge_base'))
+    parser.add_argument('--k', type=int, default=2)
+    args = parser.parse_args()
+
+    texts, labels, queries = load_corpus(args.knowledge_base)
+    print(f"Корпус: {len(texts)} чанков, {len(queries)} запросов")
+
+    context = multiprocessing.get_context('spawn')
+    results = []
+    for backend in args.backends:
+        result_queue = context.Queue()
+        process = context.Process(target=run_backend, args=(backend, texts, queries, result_queue))
+        process.start()
+        results.append(result_queue.get())
+        process.join()
+
+    print(f"{'backend':<8} {'load, s':>8} {'docs/s':>8} {'p50, ms':>8} {'p95, ms':>8} {'RSS, MB':>8}")
+    for result in results:
+        print(f"{result['backend']:<8} {result['load_time']:>8.1f} {result['corpus_throughput']:>8.1f} "
+              f"{result['query_p50_ms']:>8.1f} {result['query_p95_ms']:>8.1f} {result['peak_rss_mb']:>8.0f}")
+
+    baseline = results[0]
+    baseline_top = top_k(baseline["query_vectors"], baseline["corpus_vectors"], args.k)
+    for result in results[1:]:
+        candidate_top = top_k(result["query_vectors"], result["corpus_vectors"], args.k)
+        # совпадение top-k с базовым бэкендом: по чанкам и по существам
+        chunk_overlap = statistics.mean(len(set(a) & set(b)) / args.k for a, b in zip(baseline_top, candidate_top))
+        creature_agreement = statistics.mean(labels[a[0]] == labels[b[0]] for a, b in zip(baseline_top, candidate_top))
+        print(f"{result['backend']} против {baseline['backend']}: совпадение top-{args.k} {chunk_overlap:.3f}, "
+              f"совпадение лучшего существа {creature_agreement:.3f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,164 @@
+"""Нагрузочный генератор для шлюза с открытой моделью нагрузки.
+
+Запросы отправляются с фиксированной частотой независимо от того, успели ли ответить на предыдущие,
+а задержка считается от запланированного момента отправки: очередь внутри генератора не скрывает
+деградацию сервиса. Запуск при работающем шлюзе:
+    python benchmarks/loadgen.py --url http://127.0.0.1:8002 --rate 5 --duration 60 --stream
+"""
+import argparse
+import asyncio
+import glob
+import itertools
+import json
+import os
+import random
+import statistics
+import time
+from collections import Counter
+import httpx
+
+RAG_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'RAG')
+QUESTION_TEMPLATES = ("Где обитает {name}?", "Как выглядит {name}?", "Чем питается {name}?", "Опасен ли {name} для человека?")
+
+
+def load_queries(knowledge_base: str) -> list[str]:
+    queries = []
+    for path in sorted(glob.glob(os.path.join(knowledge_base, "*.json"))):
+        with open(path, encoding="utf-8") as file:
+            for creature in json.load(file).get("creatures", []):
+                if creature.get("common_name"):
+                    queries.extend(template.format(name=creature["common_name"]) for template in QUESTION_TEMPLATES)
+    if not queries:
+        raise FileNotFoundError(f"В {knowledge_base} не найдено существ для запросов")
+    return queries
+
+
+def percentile(values: list[float], q: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(q / 100 * (len(ordered) - 1))))]
+
+
+class Result():
+    def __init__(self, latency: float, status: str, first_byte: float | None = None):
+        self.latency = latency
+        self.status = status
+        self.first_byte = first_byte
+
+    @property
+    def ok(self) -> bool:
+        return self.status == "200"
+
+
+async def send_query(client: httpx.AsyncClient, query: str, scheduled: float, stream: bool) -> Result:
+    first_byte = None
+    try:
+        if stream:
+            async with client.stream("POST", "/query/stream", json={"query": query}) as response:
+                if response.status_code != 200:
+                    await response.aread()
+                    return Result(time.perf_counter() - scheduled, str(response.status_code))
+                async for line in response.aiter_lines():
+                    if not line.startswith("data:"):
+                        continue
+                    event = json.loads(line[len("data:"):])
+                    if "error" in event:
+                        return Result(time.perf_counter() - scheduled, "stream_error", first_byte)
+                    if event.get("delta") and first_byte is None:
+                        first_byte = time.perf_counter() - scheduled
+            return Result(time.perf_counter() - scheduled, "200", first_byte)
+        response = await client.post("/query", json={"query": query})
+        return Result(time.perf_counter() - scheduled, str(response.status_code))
+    except httpx.TimeoutException:
+        return Result(time.perf_counter() - scheduled, "timeout")
+    except httpx.HTTPError as e:
+        return Result(time.perf_counter() - scheduled, type(e).__name__)
+
+
+async def run_load(url: str, queries: list[str], rate: float, duration: float, stream: bool = False,
+                   poisson: bool = False, unique: bool = True, timeout: float = 120.0, seed: int = 0) -> dict:
+    rng = random.Random(seed)
+    query_cycle = itertools.cycle(rng.sample(queries, len(queries)))
+    limits = httpx.Limits(max_connections=None, max_keepalive_connections=100)
+    tasks = []
+    async with httpx.AsyncClient(base_url=url, timeout=timeout, limits=limits) as client:
+        started = time.perf_counter()
+        next_at = started
+        for i in itertools.count():
+            if next_at - started >= duration:
+                break
+            delay = next_at - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            query = next(query_cycle)
+            if unique:
+                # уникальный хвост обходит кэш ответов шлюза, иначе замеряется только кэш
+                query = f"{query} (#{i})"
+            tasks.append(asyncio.create_task(send_query(client, query, next_at, stream)))
+            next_at += rng.expovariate(rate) if poisson else 1.0 / rate
+        sent_for = time.perf_counter() - started
+        results = await asyncio.gather(*tasks)
+        elapsed = time.perf_counter() - started
+
+    latencies = [result.latency for result in results if result.ok]
+    first_bytes = [result.first_byte for result in results if result.ok and result.first_byte is not None]
+    statuses = Counter(result.status for result in results)
+    report = {
+        "sent": len(results),
+        "offered_rate": len(results) / sent_for if sent_for else 0.0,
+        "throughput": len(latencies) / elapsed if elapsed else 0.0,
+        "error_rate": 1 - len(latencies) / len(results) if results else 0.0,
+        "statuses": dict(statuses),
+        "p50": percentile(latencies, 50),
+        "p95": percentile(latencies, 95),
+        "p99": percentile(latencies, 99),
+        "mean": statistics.fmean(latencies) if latencies else 0.0,
+    }
+    if stream:
+        report["first_token_p50"] = percentile(first_bytes, 50)
+        report["first_token_p95"] = percentile(first_bytes, 95)
+    return report
+
+
+def print_report(report: dict):
+    print(f"Отправлено: {report['sent']} ({report['offered_rate']:.2f} запр/с), "
+          f"пропускная способность: {report['throughput']:.2f} отв/с, ошибки: {report['error_rate']:.1%}")
+    print(f"Задержка, с: p50 {report['p50']:.3f}, p95 {report['p95']:.3f}, p99 {report['p99']:.3f}, среднее {report['mean']:.3f}")
+    if "first_token_p50" in report:
+        print(f"До первого токена, с: p50 {report['first_token_p50']:.3f}, p95 {report['first_token_p95']:.3f}")
+    print(f"Статусы: {report['statuses']}")
+
+
+def add_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument('--rate', type=float, default=2.0, help="запросов в секунду")
+    parser.add_argument('--duration', type=float, default=30.0, help="длительность подачи нагрузки, с")
+    parser.add_argument('--stream', action='store_true', help="POST /query/stream вместо /query")
+    parser.add_argument('--poisson', action='store_true', help="пуассоновский поток вместо равномерного")
+    parser.add_argument('--repeat-queries', action='store_true', help="не делать запросы уникальными (замер с кэшем ответов)")
+    parser.add_argument('--timeout', type=float, default=120.0)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--knowledge-base', default=os.path.join(RAG_DIR, 'knowledge_base'))
+    parser.add_argument('--json', dest='json_path', help="записать отчёт в JSON-файл")
+
+
+def run_from_args(url: str, args) -> dict:
+    report = asyncio.run(run_load(url, load_queries(args.knowledge_base), args.rate, args.duration, stream=args.stream,
+                                  poisson=args.poisson, unique=not args.repeat_queries, timeout=args.timeout, seed=args.seed))
+    print_report(report)
+    if args.json_path:
+        with open(args.json_path, "w", encoding="utf-8") as file:
+            json.dump(report, file, ensure_ascii=False, indent=2)
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--url', default='http://127.0.0.1:8002')
+    add_arguments(parser)
+    args = parser.parse_args()
+    run_from_args(args.url, args)
+
+
+if __name__ == '__main__':
+    main()
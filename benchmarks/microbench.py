@@ -0,0 +1,124 @@
+"""Микробенчмарки горячих функций RAG: извлечение текста существа, обрезка промпта и векторный поиск.
+
+Запуск из корня репозитория:
+    python benchmarks/microbench.py --repeat 200 --index-size 10000 --dim 768
+Для каждой функции выводятся медиана, p95 и среднее время одного вызова. Векторный поиск замеряется
+на случайных векторах во временной папке для индексов из --indexes.
+"""
+import argparse
+import glob
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+RAG_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'RAG')
+sys.path.insert(0, RAG_DIR)
+
+
+def measure(fn, repeat: int, setup=None) -> dict:
+    fn()  # прогрев: ленивые импорты, токенизатор, memory map
+    timings = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        started = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - started)
+    timings.sort()
+    return {
+        "p50_us": statistics.median(timings) * 1e6,
+        "p95_us": timings[min(len(timings) - 1, int(0.95 * len(timings)))] * 1e6,
+        "mean_us": statistics.fmean(timings) * 1e6,
+    }
+
+
+def load_creatures(knowledge_base: str) -> list[dict]:
+    creatures = []
+    for path in sorted(glob.glob(os.path.join(knowledge_base, "*.json"))):
+        with open(path, encoding="utf-8") as file:
+            creatures.extend(json.load(file).get("creatures", []))
+    return creatures
+
+
+def bench_extract_text(creatures: list[dict], repeat: int) -> dict:
+    from ingestion import extract_text_from_json
+
+    return measure(lambda: [extract_text_from_json(creature) for creature in creatures], repeat)
+
+
+def bench_truncate_prompt(creatures: list[dict], repeat: int) -> dict:
+    from context import count_tokens
+    from ingestion import extract_text_from_json
+    from prompts import SYSTEM_PROMPT
+    from rag import RAG
+
+    # truncate_prompt не использует состояние экземпляра, поэтому индекс и модель не загружаются
+    rag = RAG.__new__(RAG)
+    texts = [extract_text_from_json(creature) for creature in creatures]
+    short_prompt = texts[0]
+    long_prompt = "\n\n".join(texts * (1 + 60000 // max(1, sum(map(len, texts)))))
+    results = {}
+    for name, prompt in (("короткий", short_prompt), ("длинный", long_prompt)):
+        # подсчёт токенов кэшируется, а в рабочем режиме каждый промпт новый: кэш очищается перед вызовом
+        results[f"{name} ({len(prompt)} символов)"] = measure(
+            lambda: rag.truncate_prompt(prompt, SYSTEM_PROMPT, max_tokens=3500), repeat, setup=count_tokens.cache_clear)
+    return results
+
+
+def bench_vector_search(kinds: list[str], size: int, dim: int, k: int, repeat: int) -> dict:
+    import numpy as np
+    from langchain_core.documents import Document
+    from vector_index import create_vector_index
+
+    rng = np.random.default_rng(0)
+    vectors = rng.standard_normal((size, dim), dtype=np.float32)
+    queries = rng.standard_normal((repeat + 1, dim), dtype=np.float32).tolist()
+    documents = [Document(page_content=f"chunk {i}", metadata={"scientific_name": f"creature {i // 4}"}) for i in range(size)]
+    results = {}
+    for kind in kinds:
+        with tempfile.TemporaryDirectory() as path:
+            index = create_vector_index(path, kind)
+            for start in range(0, size, 1000):
+                index.add([str(i) for i in range(start, min(size, start + 1000))],
+                          documents[start:start + 1000], vectors[start:start + 1000].tolist())
+            index.commit()
+            query_cycle = iter(queries * 2)
+            results[kind] = measure(lambda: index.search(next(query_cycle), k), repeat)
+    return results
+
+
+def print_results(title: str, results: dict):
+    print(title)
+    for name, result in results.items():
+        print(f"  {name:<32} p50 {result['p50_us']:>10.1f} мкс  p95 {result['p95_us']:>10.1f} мкс  "
+              f"среднее {result['mean_us']:>10.1f} мкс")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--knowledge-base', default=os.path.join(RAG_DIR, 'knowledge_base'))
+    parser.add_argument('--repeat', type=int, default=200)
+    parser.add_argument('--indexes', nargs='+', default=['numpy', 'chroma'])
+    parser.add_argument('--index-size', type=int, default=10000)
+    parser.add_argument('--dim', type=int, default=768)
+    parser.add_argument('--k', type=int, default=8)
+    parser.add_argument('--only', choices=['extract', 'truncate', 'search'], nargs='+')
+    args = parser.parse_args()
+
+    only = set(args.only or ['extract', 'truncate', 'search'])
+    creatures = load_creatures(args.knowledge_base)
+    if 'extract' in only:
+        print_results(f"extract_text_from_json, все {len(creatures)} существ за вызов",
+                      {"база знаний": bench_extract_text(creatures, args.repeat)})
+    if 'truncate' in only:
+        print_results("truncate_prompt", bench_truncate_prompt(creatures, args.repeat))
+    if 'search' in only:
+        print_results(f"Векторный поиск: {args.index_size} векторов размерности {args.dim}, k={args.k}",
+                      bench_vector_search(args.indexes, args.index_size, args.dim, args.k, args.repeat))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,245 @@
+"""Подбор параметров поиска RAG: качество и скорость поиска на сетке параметров разбиения и числа чанков k.
+
+Для каждого сочетания --separators, --chunk-sizes, --overlaps и --split-thresholds индекс по базе знаний
+строится заново во временной папке, затем по нему прогоняется размеченный набор вопросов.
+Для каждого k из --k выводятся:
+  recall@k       — доля вопросов, для которых среди k чанков есть чанк нужного существа;
+  field_recall@k — доля вопросов, для которых среди k чанков есть чанк с полем, содержащим ответ;
+  MRR            — средняя обратная позиция первого чанка нужного существа (по max(--k) чанкам);
+а также число чанков, размер индекса на диске, время построения и задержка поиска на один вопрос
+(эмбеддинг вопроса замеряется отдельно: он не зависит от параметров разбиения).
+
+Вопросы по умолчанию генерируются из полей существ: вопрос с именем существа ("Чем питается ...?")
+и вопрос по описанию без имени (цитата первого предложения поля). Цитаты проще настоящих вопросов,
+поэтому для выбора параметров лучше разметить сохранённые вопросы пользователей и передать их через
+--questions: JSONL со строками {"question": ..., "scientific_name": ..., "field": "behavior diet"},
+поле field необязательно. --save-questions сохраняет сгенерированный набор в том же формате.
+
+--retrieval hybrid повторяет поиск RAG-сервиса (имя существа в вопросе, BM25 и reciprocal rank fusion),
+vector — только векторный поиск. Запуск из корня репозитория:
+    python benchmarks/retrieval_tuning.py --chunk-sizes 200 400 800 --overlaps 0 50 --k 1 2 4 8
+    python benchmarks/retrieval_tuning.py --embedding-backend onnx --json tuning.json
+"""
+import argparse
+import itertools
+import json
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+RAG_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'RAG')
+sys.path.insert(0, RAG_DIR)
+
+NAME_FIELDS = {"scientific_name", "common_name"}
+# вопросы с именем существа для полей, которые есть у большинства существ
+NAMED_TEMPLATES = {
+    "habitat location": "Где обитает {name}?",
+    "habitat description": "В какой среде живёт {name}?",
+    "appearance body": "Как выглядит {name}?",
+    "appearance size": "Какого размера {name}?",
+    "appearance eyes": "Какие глаза у существа {name}?",
+    "behavior activity": "Когда активен {name}?",
+    "behavior diet": "Чем питается {name}?",
+    "behavior hunting": "Как охотится {name}?",
+    "behavior defense": "Как защищается {name}?",
+    "behavior social_structure": "Как живёт {name}: в одиночку или группой?",
+    "mythology": "Какие легенды связаны с существом {name}?",
+    "science": "Что известно науке о существе {name}?",
+    "threats": "Чем опасен {name}?",
+}
+
+
+def creature_fields(creature: dict) -> list[tuple[str, str]]:
+    from ingestion import extract_text_from_json
+
+    # поля берутся из текста, который индексируется: метка поля в чанке совпадает с меткой в вопросе
+    fields = []
+    for line in extract_text_from_json(creature).split("\n"):
+        field, _, value = line.partition(": ")
+        if value and field not in NAME_FIELDS:
+            fields.append((field, value))
+    return fields
+
+
+def generate_questions(knowledge_base: str) -> list[dict]:
+    from ingestion import iter_creatures
+
+    questions = []
+    for _, creature in iter_creatures(knowledge_base):
+        for field, value in creature_fields(creature):
+            label = {"scientific_name": creature["scientific_name"], "field": field}
+            template = NAMED_TEMPLATES.get(field)
+            if template:
+                questions.append({"question": template.format(name=creature["common_name"]), "kind": "named", **label})
+            first_sentence = value.split(". ")[0].rstrip(".")
+            questions.append({"question": f"О каком существе сказано: «{first_sentence}»?", "kind": "description", **label})
+    return questions
+
+
+def load_questions(path: str) -> list[dict]:
+    with open(path, encoding="utf-8") as file:
+        return [json.loads(line) for line in file if line.strip()]
+
+
+def build_index(creatures: list, embeddings, kind: str, path: str, separator: str, chunk_size: int,
+                chunk_overlap: int, split_threshold: int) -> tuple:
+    from langchain_core.documents import Document
+    from ingestion import prepare_creature
+    from vector_index import create_vector_index
+
+    started = time.perf_counter()
+    ids, documents = [], []
+    for item in creatures:
+        key, chunks, metadata, _, token_counts = prepare_creature(
+            item, chunk_size=chunk_size, chunk_overlap=chunk_overlap, split_threshold=split_threshold,
+            chunk_separator=separator)
+        ids.extend(f"{key}#{i}" for i in range(len(chunks)))
+        documents.extend(Document(page_content=chunk, metadata={**metadata, "token_count": token_count})
+                         for chunk, token_count in zip(chunks, token_counts))
+    index = create_vector_index(path, kind)
+    index.add(ids, documents, embeddings.embed_documents([doc.page_content for doc in documents]))
+    index.commit()
+    return index, documents, time.perf_counter() - started
+
+
+def directory_size(path: str) -> int:
+    return sum(os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(path) for name in names)
+
+
+def retrieve(rag, index, lexical, question: str, embedding: list[float], k: int, mode: str) -> list:
+    from rag import RETRIEVAL_CANDIDATES
+
+    # тот же порядок шагов, что в RAG.retrieve, но без батчера эмбеддингов и метрик сервиса
+    if mode == "hybrid":
+        scientific_name = lexical.match_name(question)
+        if scientific_name:
+            return lexical.creature_documents(scientific_name, question, k)
+    hits = index.search(embedding, max(k, RETRIEVAL_CANDIDATES))
+    return [doc for doc, _ in rag._fuse(question, hits, lexical if mode == "hybrid" else None, k)]
+
+
+def evaluate(rag, index, lexical, questions: list[dict], query_vectors: list, ks: list[int], mode: str) -> dict:
+    max_k = max(ks)
+    hits = {k: 0 for k in ks}
+    field_hits = {k: 0 for k in ks}
+    reciprocal_ranks, latencies = [], []
+    for question, embedding in zip(questions, query_vectors):
+        started = time.perf_counter()
+        documents = retrieve(rag, index, lexical, question["question"], embedding, max_k, mode)
+        latencies.append(time.perf_counter() - started)
+        creature_ranks = [rank for rank, doc in enumerate(documents)
+                          if doc.metadata.get("scientific_name") == question["scientific_name"]]
+        field = question.get("field")
+        field_ranks = [rank for rank in creature_ranks if field and f"{field}: " in documents[rank].page_content]
+        reciprocal_ranks.append(1 / (creature_ranks[0] + 1) if creature_ranks else 0.0)
+        for k in ks:
+            # результат для меньшего k — начало списка для max(k): и векторный поиск, и fusion упорядочены
+            hits[k] += bool(creature_ranks) and creature_ranks[0] < k
+            field_hits[k] += bool(field_ranks) and field_ranks[0] < k
+    total = len(questions)
+    latencies.sort()
+    return {
+        "recall": {k: hits[k] / total for k in ks},
+        "field_recall": {k: field_hits[k] / total for k in ks},
+        "mrr": statistics.fmean(reciprocal_ranks),
+        "search_p50_ms": statistics.median(latencies) * 1000,
+        "search_p95_ms": latencies[min(total - 1, int(0.95 * total))] * 1000,
+    }
+
+
+def print_results(results: list[dict], ks: list[int]):
+    header = (f"{'разд.':>6} {'chunk':>6} {'overlap':>7} {'порог':>6} {'чанков':>7} {'индекс, КБ':>10} {'сборка, с':>9} "
+              f"{'p50, мс':>8} {'p95, мс':>8} {'MRR':>6} "
+              + " ".join(f"{f'R@{k}':>6}" for k in ks) + " " + " ".join(f"{f'F@{k}':>6}" for k in ks))
+    print(header)
+    for result in results:
+        print(f"{result['separator']!r:>6} {result['chunk_size']:>6} {result['chunk_overlap']:>7} {result['split_threshold']:>6} "
+              f"{result['chunks']:>7} {result['index_bytes'] / 1024:>10.1f} {result['build_seconds']:>9.2f} "
+              f"{result['search_p50_ms']:>8.2f} {result['search_p95_ms']:>8.2f} {result['mrr']:>6.3f} "
+              + " ".join(f"{result['recall'][k]:>6.3f}" for k in ks) + " "
+              + " ".join(f"{result['field_recall'][k]:>6.3f}" for k in ks))
+    print("R@k — recall@k по существу, F@k — recall@k по полю с ответом")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--knowledge-base', default=os.path.join(RAG_DIR, 'knowledge_base'))
+    parser.add_argument('--separators', nargs='+', default=['\\n\\n', '\\n'],
+                        help="разделители CharacterTextSplitter с экранированием, как в CHUNK_SEPARATOR")
+    parser.add_argument('--chunk-sizes', type=int, nargs='+', default=[200, 400, 800])
+    parser.add_argument('--overlaps', type=int, nargs='+', default=[0, 50, 100])
+    parser.add_argument('--split-thresholds', type=int, nargs='+', default=[500])
+    parser.add_argument('--k', type=int, nargs='+', default=[1, 2, 4, 8])
+    parser.add_argument('--retrieval', choices=['hybrid', 'vector'], default='hybrid')
+    parser.add_argument('--embedding-backend', default=None, help="torch, onnx или fake, по умолчанию EMBEDDING_BACKEND")
+    parser.add_argument('--vector-index', default=None, help="numpy или chroma, по умолчанию VECTOR_INDEX")
+    parser.add_argument('--questions', help="размеченные вопросы в формате JSONL вместо сгенерированных")
+    parser.add_argument('--save-questions', help="сохранить сгенерированные вопросы в JSONL")
+    parser.add_argument('--max-questions', type=int, default=0, help="случайная выборка вопросов, 0 — все")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', help="сохранить результаты в JSON для сравнения между запусками")
+    args = parser.parse_args()
+
+    from embeddings import create_embeddings
+    from ingestion import iter_creatures
+    from lexical import LexicalIndex
+    from rag import RAG
+
+    questions = load_questions(args.questions) if args.questions else generate_questions(args.knowledge_base)
+    if args.max_questions and len(questions) > args.max_questions:
+        questions = random.Random(args.seed).sample(questions, args.max_questions)
+    if args.save_questions:
+        with open(args.save_questions, "w", encoding="utf-8") as file:
+            file.writelines(json.dumps(question, ensure_ascii=False) + "\n" for question in questions)
+    creatures = list(iter_creatures(args.knowledge_base))
+    print(f"Существ: {len(creatures)}, вопросов: {len(questions)}, поиск: {args.retrieval}")
+
+    embeddings = create_embeddings(args.embedding_backend)
+    embed_latencies = []
+    query_vectors = []
+    for question in questions:
+        started = time.perf_counter()
+        query_vectors.append(embeddings.embed_query(question["question"]))
+        embed_latencies.append(time.perf_counter() - started)
+    print(f"Эмбеддинг вопроса: p50 {statistics.median(embed_latencies) * 1000:.2f} мс")
+
+    # _fuse не использует состояние экземпляра, поэтому модель и индекс сервиса не загружаются
+    rag = RAG.__new__(RAG)
+    kind = args.vector_index or os.getenv('VECTOR_INDEX', 'chroma')
+    results = []
+    separators = [separator.encode().decode('unicode_escape') for separator in args.separators]
+    for separator, chunk_size, chunk_overlap, split_threshold in itertools.product(
+            separators, args.chunk_sizes, args.overlaps, args.split_thresholds):
+        if chunk_overlap >= chunk_size:
+            continue
+        with tempfile.TemporaryDirectory() as path:
+            index, documents, build_seconds = build_index(creatures, embeddings, kind, path, separator, chunk_size,
+                                                          chunk_overlap, split_threshold)
+            lexical = LexicalIndex(documents)
+            result = {
+                "separator": separator,
+                "chunk_size": chunk_size,
+                "chunk_overlap": chunk_overlap,
+                "split_threshold": split_threshold,
+                "chunks": len(documents),
+                "index_bytes": directory_size(path),
+                "build_seconds": build_seconds,
+                **evaluate(rag, index, lexical, questions, query_vectors, args.k, args.retrieval),
+            }
+        results.append(result)
+        print(f"separator={separator!r} chunk_size={chunk_size} overlap={chunk_overlap} порог={split_threshold}: "
+              f"recall@{max(args.k)} {result['recall'][max(args.k)]:.3f}, MRR {result['mrr']:.3f}")
+
+    print_results(results, args.k)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as file:
+            json.dump({"retrieval": args.retrieval, "vector_index": kind, "questions": len(questions),
+                       "embed_p50_ms": statistics.median(embed_latencies) * 1000, "results": results},
+                      file, ensure_ascii=False, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,125 @@
+"""Сквозной нагрузочный замер: заглушка LLM, LLM-сервис, RAG и шлюз запускаются локально, затем шлюз
+нагружается генератором из loadgen.py.
+
+По умолчанию RAG использует детерминированные фиктивные эмбеддинги (EMBEDDING_BACKEND=fake), поэтому
+замер работает без сети и загрузки модели; качество поиска при этом не оценивается. Кэш ответов шлюза отключён.
+Запуск из корня репозитория (нужны зависимости всех сервисов):
+    python benchmarks/run_e2e.py --rate 5 --duration 60 --stream --first-token 0.5 --tokens-per-second 50
+Логи сервисов пишутся в папку --work-dir.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import httpx
+import loadgen
+import stub_llm
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+class Service():
+    def __init__(self, name: str, args: list[str], cwd: str, env: dict, port: int, health_path: str, log_dir: str):
+        self.name = name
+        self.port = port
+        self.url = f"http://127.0.0.1:{port}"
+        self.health_path = health_path
+        self.log_path = os.path.join(log_dir, f"{name}.log")
+        self.log = open(self.log_path, "w")
+        self.process = subprocess.Popen(args, cwd=cwd, env=env, stdout=self.log, stderr=subprocess.STDOUT)
+
+    def wait_ready(self, timeout: float):
+        started = time.monotonic()
+        while time.monotonic() - started < timeout:
+            if self.process.poll() is not None:
+                raise RuntimeError(f"{self.name} завершился с кодом {self.process.returncode}, см. {self.log_path}")
+            try:
+                if httpx.get(self.url + self.health_path, timeout=1.0).status_code == 200:
+                    print(f"{self.name} готов за {time.monotonic() - started:.1f} c")
+                    return
+            except httpx.HTTPError:
+                pass
+            time.sleep(0.5)
+        raise TimeoutError(f"{self.name} не запустился за {timeout} c, см. {self.log_path}")
+
+    def stop(self):
+        if self.process.poll() is None:
+            self.process.terminate()
+            try:
+                self.process.wait(timeout=15)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+        self.log.close()
+
+
+def uvicorn_args(app: str, port: int) -> list[str]:
+    return [sys.executable, "-m", "uvicorn", app, "--host", "127.0.0.1", "--port", str(port), "--log-level", "warning"]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--gateway-mode', choices=['services', 'embedded'], default='services')
+    parser.add_argument('--embedding-backend', default='fake', help="fake, torch или onnx")
+    parser.add_argument('--vector-index', default=os.getenv('VECTOR_INDEX', 'chroma'))
+    parser.add_argument('--answer-cache', action='store_true', help="не отключать кэш ответов шлюза")
+    parser.add_argument('--base-port', type=int, default=18000)
+    parser.add_argument('--startup-timeout', type=float, default=300.0)
+    parser.add_argument('--work-dir', default=None, help="папка для индекса и логов, по умолчанию временная")
+    stub_llm.add_arguments(parser)
+    loadgen.add_arguments(parser)
+    args = parser.parse_args()
+
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix="rag-bench-")
+    os.makedirs(work_dir, exist_ok=True)
+    stub_port, llm_port, rag_port, gateway_port = (args.base_port + i for i in range(4))
+
+    env = dict(os.environ)
+    env.update({
+        "LLM_ROUTES": json.dumps([{"name": "stub", "base_url": f"http://127.0.0.1:{stub_port}/v1", "model": "stub",
+                                   "api_key": "stub", "rpm": 1_000_000, "burst": 10_000}]),
+        "EMBEDDING_BACKEND": args.embedding_backend,
+        "VECTOR_INDEX": args.vector_index,
+        "CHROMA_DB_PATH": os.path.join(work_dir, "index"),
+        "RAG_SERVICE_URL": f"http://127.0.0.1:{rag_port}",
+        "LLM_SERVICE_URL": f"http://127.0.0.1:{llm_port}",
+        "GATEWAY_MODE": args.gateway_mode,
+        "PYTHONUNBUFFERED": "1",
+    })
+    if not args.answer_cache:
+        env["ANSWER_CACHE_SIZE"] = "0"
+
+    stub_args = [sys.executable, os.path.join(BENCHMARKS_DIR, "stub_llm.py"), "--port", str(stub_port),
+                 "--first-token", str(args.first_token), "--jitter", str(args.jitter),
+                 "--tokens-per-second", str(args.tokens_per_second), "--answer-tokens", str(args.answer_tokens),
+                 "--error-rate", str(args.error_rate)]
+    services = []
+    try:
+        services.append(Service("stub_llm", stub_args, BENCHMARKS_DIR, env, stub_port, "/stats", work_dir))
+        if args.gateway_mode == 'services':
+            services.append(Service("llm", uvicorn_args("llm:app", llm_port), os.path.join(ROOT, "LLM"), env,
+                                    llm_port, "/readyz", work_dir))
+            services.append(Service("rag", uvicorn_args("main:app", rag_port), os.path.join(ROOT, "RAG"), env,
+                                    rag_port, "/readyz", work_dir))
+        # /readyz отвечает 200 только после загрузки модели, построения индекса и прогрева
+        for service in services:
+            service.wait_ready(args.startup_timeout)
+        gateway = Service("gateway", uvicorn_args("main:app", gateway_port), os.path.join(ROOT, "APIgateway"), env,
+                          gateway_port, "/readyz", work_dir)
+        services.append(gateway)
+        gateway.wait_ready(args.startup_timeout)
+
+        print(f"Нагрузка: {args.rate} запр/с в течение {args.duration} c, "
+              f"{'/query/stream' if args.stream else '/query'}, шлюз в режиме {args.gateway_mode}")
+        loadgen.run_from_args(gateway.url, args)
+    finally:
+        for service in reversed(services):
+            service.stop()
+        print(f"Логи сервисов: {work_dir}")
+
+
+if __name__ == '__main__':
+    main()
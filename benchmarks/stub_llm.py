@@ -0,0 +1,119 @@
+"""Заглушка OpenAI-совместимого API для нагрузочных замеров без обращения к провайдеру.
+
+Отвечает на POST /v1/chat/completions (обычный и потоковый ответ) с заданной задержкой до первого токена
+и скоростью генерации. Запуск:
+    python benchmarks/stub_llm.py --port 9001 --first-token 0.5 --tokens-per-second 50 --answer-tokens 120
+LLM-сервис направляется на заглушку через LLM_ROUTES:
+    LLM_ROUTES='[{"name": "stub", "base_url": "http://127.0.0.1:9001/v1", "model": "stub", "api_key": "stub", "rpm": 100000, "burst": 1000}]'
+"""
+import argparse
+import asyncio
+import json
+import random
+import time
+import uuid
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+WORDS = ("Эфирный", "Скакун", "обитает", "в", "горных", "лесах", "и", "питается", "росой", "на", "рассвете,",
+         "избегая", "людей", "и", "шумных", "дорог.")
+
+
+class StubSettings():
+    def __init__(self, first_token: float, jitter: float, tokens_per_second: float, answer_tokens: int, error_rate: float):
+        self.first_token = first_token
+        self.jitter = jitter
+        self.tokens_per_second = tokens_per_second
+        self.answer_tokens = answer_tokens
+        self.error_rate = error_rate
+
+    def first_token_delay(self) -> float:
+        return max(0.0, self.first_token + random.uniform(-self.jitter, self.jitter))
+
+    def token_delay(self) -> float:
+        return 1.0 / self.tokens_per_second if self.tokens_per_second > 0 else 0.0
+
+
+def tokens(count: int) -> list[str]:
+    # одно слово считается одним токеном
+    return [WORDS[i % len(WORDS)] + " " for i in range(count)]
+
+
+def create_app(settings: StubSettings) -> FastAPI:
+    app = FastAPI(title="Stub LLM")
+    app.state.requests = 0
+
+    def chunk(completion_id: str, model: str, delta: dict, finish_reason: str | None = None) -> str:
+        return "data: " + json.dumps({
+            "id": completion_id,
+            "object": "chat.completion.chunk",
+            "created": int(time.time()),
+            "model": model,
+            "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+        }, ensure_ascii=False) + "\n\n"
+
+    @app.post("/v1/chat/completions")
+    async def chat_completions(request: Request):
+        body = await request.json()
+        app.state.requests += 1
+        model = body.get("model", "stub")
+        completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+        if random.random() < settings.error_rate:
+            await asyncio.sleep(settings.first_token_delay())
+            return JSONResponse(status_code=500, content={"error": {"message": "stub error", "type": "server_error"}})
+
+        answer = tokens(settings.answer_tokens)
+        if body.get("stream"):
+            async def events():
+                await asyncio.sleep(settings.first_token_delay())
+                yield chunk(completion_id, model, {"role": "assistant", "content": ""})
+                for token in answer:
+                    yield chunk(completion_id, model, {"content": token})
+                    await asyncio.sleep(settings.token_delay())
+                yield chunk(completion_id, model, {}, finish_reason="stop")
+                yield "data: [DONE]\n\n"
+
+            return StreamingResponse(events(), media_type="text/event-stream")
+
+        # без стриминга ответ приходит целиком после генерации всех токенов
+        await asyncio.sleep(settings.first_token_delay() + settings.token_delay() * len(answer))
+        return {
+            "id": completion_id,
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": model,
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": "".join(answer).strip()}, "finish_reason": "stop"}],
+            "usage": {"prompt_tokens": 0, "completion_tokens": len(answer), "total_tokens": len(answer)},
+        }
+
+    @app.get("/stats")
+    async def stats():
+        return {"requests": app.state.requests}
+
+    return app
+
+
+def add_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument('--first-token', type=float, default=0.5, help="задержка до первого токена, с")
+    parser.add_argument('--jitter', type=float, default=0.1, help="разброс задержки до первого токена, с")
+    parser.add_argument('--tokens-per-second', type=float, default=50.0)
+    parser.add_argument('--answer-tokens', type=int, default=120)
+    parser.add_argument('--error-rate', type=float, default=0.0, help="доля ответов с ошибкой 500")
+
+
+def settings_from_args(args) -> StubSettings:
+    return StubSettings(args.first_token, args.jitter, args.tokens_per_second, args.answer_tokens, args.error_rate)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=9001)
+    add_arguments(parser)
+    args = parser.parse_args()
+    uvicorn.run(create_app(settings_from_args(args)), host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == '__main__':
+    main()
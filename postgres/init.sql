@@ -41,3 +41,63 @@ CREATE TABLE IF NOT EXISTS "Message" (
 );
 
 DO $$ BEGIN RAISE NOTICE 'Table "Message" created'; END $$;
+
+
+-- У пользователя один чат: уникальный индекс нужен для INSERT ... ON CONFLICT и поиска чата по user_id
+CREATE UNIQUE INDEX IF NOT EXISTS "Chat_user_id_key" ON "Chat" (user_id);
+-- история чата читается по (chat_id, send_at) с конца, индекс заодно покрывает поиск сообщений по chat_id
+CREATE INDEX IF NOT EXISTS "Message_chat_id_send_at_idx" ON "Message" (chat_id, send_at DESC, message_id DESC);
+
+DO $$ BEGIN RAISE NOTICE 'Indexes created'; END $$;
+
+-- Определяет пользователя и его чат по telegram_id и сохраняет сообщение за один запрос к базе.
+-- Новый пользователь регистрируется, is_new = TRUE, чат и сообщение для него не создаются
+CREATE OR REPLACE FUNCTION resolve_chat(
+    p_telegram_id BIGINT,
+    p_username VARCHAR,
+    p_first_name VARCHAR,
+    p_last_name VARCHAR,
+    p_text TEXT
+)
+RETURNS TABLE (user_id INTEGER, chat_id INTEGER, is_new BOOLEAN, message_id INTEGER)
+LANGUAGE plpgsql AS $$
+#variable_conflict use_column
+DECLARE
+    v_user_id INTEGER;
+    v_chat_id INTEGER;
+    v_is_new BOOLEAN := FALSE;
+    v_message_id INTEGER;
+BEGIN
+    SELECT u.user_id INTO v_user_id FROM "User" u WHERE u.telegram_id = p_telegram_id;
+    IF v_user_id IS NULL THEN
+        -- при одновременной регистрации DO UPDATE позволяет получить user_id уже вставленной строки
+        INSERT INTO "User" (telegram_id, username, first_name, last_name)
+        VALUES (p_telegram_id, p_username, p_first_name, p_last_name)
+        ON CONFLICT (telegram_id) DO UPDATE SET username = EXCLUDED.username
+        RETURNING "User".user_id, (xmax = 0) INTO v_user_id, v_is_new;
+    END IF;
+    IF v_is_new THEN
+        RETURN QUERY SELECT v_user_id, NULL::INTEGER, TRUE, NULL::INTEGER;
+        RETURN;
+    END IF;
+
+    SELECT c.chat_id INTO v_chat_id FROM "Chat" c WHERE c.user_id = v_user_id;
+    IF v_chat_id IS NULL THEN
+        INSERT INTO "Chat" (user_id) VALUES (v_user_id)
+        ON CONFLICT (user_id) DO NOTHING
+        RETURNING "Chat".chat_id INTO v_chat_id;
+        IF v_chat_id IS NULL THEN
+            SELECT c.chat_id INTO v_chat_id FROM "Chat" c WHERE c.user_id = v_user_id;
+        END IF;
+    END IF;
+
+    IF p_text IS NOT NULL THEN
+        INSERT INTO "Message" (chat_id, sender_type, text) VALUES (v_chat_id, 'USER', p_text)
+        RETURNING "Message".message_id INTO v_message_id;
+    END IF;
+
+    RETURN QUERY SELECT v_user_id, v_chat_id, FALSE, v_message_id;
+END;
+$$;
+
+DO $$ BEGIN RAISE NOTICE 'Function resolve_chat created'; END $$;
@@ -0,0 +1,62 @@
+-- Необязательное секционирование таблицы "Message" по месяцам для больших установок.
+-- Запускается вручную после init.sql: psql -f postgres/partitioning.sql
+-- Существующие сообщения переносятся в новую таблицу. Секции на будущие месяцы нужно создавать заранее,
+-- например раз в месяц по расписанию: SELECT create_message_partition(DATE '2026-01-01');
+-- Сообщения за месяцы без своей секции попадают в секцию по умолчанию "Message_default".
+
+DO $$ BEGIN RAISE NOTICE 'Starting "Message" partitioning'; END $$;
+
+BEGIN;
+
+ALTER TABLE "Message" RENAME TO "Message_unpartitioned";
+ALTER INDEX IF EXISTS "Message_chat_id_send_at_idx" RENAME TO "Message_unpartitioned_chat_id_send_at_idx";
+
+-- ключ секционирования должен входить в первичный ключ
+CREATE TABLE "Message" (
+    message_id INTEGER NOT NULL DEFAULT nextval('"Message_message_id_seq"'),
+    chat_id INTEGER,
+    sender_type VARCHAR(10) CHECK (sender_type IN ('USER', 'BOT', 'OPERATOR')),
+    responder_id INTEGER,
+    text TEXT,
+    send_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (message_id, send_at),
+    FOREIGN KEY (chat_id) REFERENCES "Chat"(chat_id),
+    FOREIGN KEY (responder_id) REFERENCES "Operator"(operator_id)
+) PARTITION BY RANGE (send_at);
+
+-- последовательность переходит к новой таблице, иначе она удалится вместе со старой
+ALTER SEQUENCE "Message_message_id_seq" OWNED BY "Message".message_id;
+
+CREATE TABLE IF NOT EXISTS "Message_default" PARTITION OF "Message" DEFAULT;
+
+CREATE OR REPLACE FUNCTION create_message_partition(p_month DATE)
+RETURNS VOID
+LANGUAGE plpgsql AS $$
+DECLARE
+    v_start DATE := date_trunc('month', p_month)::DATE;
+BEGIN
+    EXECUTE format(
+        'CREATE TABLE IF NOT EXISTS %I PARTITION OF "Message" FOR VALUES FROM (%L) TO (%L)',
+        'Message_' || to_char(v_start, 'YYYY_MM'),
+        v_start,
+        (v_start + INTERVAL '1 month')::DATE
+    );
+END;
+$$;
+
+-- прошлый, текущий и два следующих месяца; более старые сообщения остаются в секции по умолчанию
+SELECT create_message_partition((date_trunc('month', CURRENT_DATE) + make_interval(months => m))::DATE)
+FROM generate_series(-1, 2) AS m;
+
+INSERT INTO "Message" (message_id, chat_id, sender_type, responder_id, text, send_at)
+SELECT message_id, chat_id, sender_type, responder_id, text, COALESCE(send_at, CURRENT_TIMESTAMP)
+FROM "Message_unpartitioned";
+
+DROP TABLE "Message_unpartitioned";
+
+-- индекс на секционированной таблице создаётся в каждой секции автоматически
+CREATE INDEX IF NOT EXISTS "Message_chat_id_send_at_idx" ON "Message" (chat_id, send_at DESC, message_id DESC);
+
+COMMIT;
+
+DO $$ BEGIN RAISE NOTICE '"Message" partitioned by month'; END $$;
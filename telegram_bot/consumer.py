@@ -4,46 +4,162 @@ from dotenv import load_dotenv
 import os
 import logging
 import json
-from db_operations import update_chat_status, init_db
+from db_operations import add_message, update_chat_status, init_db
+from history import TOO_MANY_MESSAGES, ChatHistory
 import asyncio
+import time
+import uuid
 from aiogram import Bot
+from aiogram.exceptions import TelegramBadRequest
+from worker_pool import ChatWorkerPool
+from logging_setup import PAYLOAD
+from metrics import ACTIVE_WORKERS, REQUEST_ID_HEADER, SERVICE, observe, request_id, stage
 
 load_dotenv()
 
 RABBITMQ_URL = os.getenv('RABBITMQ_URL')
 API_GATEWAY_URL = os.getenv('API_GATEWAY_URL')
+STREAM_ANSWERS = os.getenv('STREAM_ANSWERS', 'true').lower() == 'true'
+# Telegram ограничивает частоту редактирования сообщений, поэтому обновляем ответ не чаще этого интервала
+STREAM_EDIT_INTERVAL = float(os.getenv('STREAM_EDIT_INTERVAL', '1.5'))
+TELEGRAM_MESSAGE_LIMIT = 4096
+OPERATOR_MESSAGE = "Ваш запрос передан оператору."
+CONSUMER_WORKERS = int(os.getenv('CONSUMER_WORKERS', '8'))
+# сколько неподтверждённых сообщений RabbitMQ передаёт боту; запас сверх числа воркеров нужен,
+# чтобы сообщения других чатов не ждали за очередью одного чата
+CONSUMER_PREFETCH = int(os.getenv('CONSUMER_PREFETCH', str(CONSUMER_WORKERS * 4)))
+CONSUMER_MAX_PENDING_PER_CHAT = int(os.getenv('CONSUMER_MAX_PENDING_PER_CHAT', '5'))
+CONSUMER_SHUTDOWN_TIMEOUT = float(os.getenv('CONSUMER_SHUTDOWN_TIMEOUT', '60'))
+# сколько последних пар вопрос-ответ передаётся в LLM, 0 отключает историю
+HISTORY_TURNS = int(os.getenv('HISTORY_TURNS', '3'))
+HISTORY_CACHE_CHATS = int(os.getenv('HISTORY_CACHE_CHATS', '1000'))
+# без этих полей сообщение нельзя ни обработать, ни ответить на него
+REQUIRED_FIELDS = ('user_query', 'chat_id', 'chat_id_in_telegram')
 
-logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+class StreamError(Exception):
+    pass
+
+class AnswerStreamer():
+    # Показывает ответ по мере генерации: первое сообщение отправляется с первым фрагментом,
+    # дальше оно редактируется не чаще STREAM_EDIT_INTERVAL секунд
+    def __init__(self, bot: Bot, chat_id_in_telegram: int):
+        self.bot = bot
+        self.chat_id_in_telegram = chat_id_in_telegram
+        self.message = None
+        self.shown = ""
+        self.last_update = 0.0
+
+    async def show(self, text: str, force: bool = False):
+        text = text[:TELEGRAM_MESSAGE_LIMIT]
+        if not text.strip() or text == self.shown:
+            return
+        if not force and time.monotonic() - self.last_update < STREAM_EDIT_INTERVAL:
+            return
+        if self.message is None:
+            self.message = await self.bot.send_message(self.chat_id_in_telegram, text)
+        else:
+            try:
+                await self.bot.edit_message_text(text, chat_id=self.chat_id_in_telegram, message_id=self.message.message_id)
+            except TelegramBadRequest as e:
+                logger.warning(f"Не удалось обновить сообщение: {e}")
+        self.shown = text
+        self.last_update = time.monotonic()
+
+async def stream_answer(session: aiohttp.ClientSession, payload: dict, streamer: AnswerStreamer, headers: dict = None) -> tuple[str, bool]:
+    answer = ""
+    requires_operator = False
+    async with session.post(
+        f"{API_GATEWAY_URL}/query/stream",
+        json=payload,
+        headers=headers,
+        timeout=aiohttp.ClientTimeout(total=None, sock_read=60.0)
+    ) as response:
+        response.raise_for_status()
+        async for line in response.content:
+            line = line.decode().strip()
+            if not line.startswith("data:"):
+                continue
+            event = json.loads(line[len("data:"):])
+            if "error" in event:
+                raise StreamError(event["error"])
+            if event.get("delta"):
+                answer += event["delta"]
+                await streamer.show(answer)
+            if event.get("done"):
+                requires_operator = event.get("requires_operator", False)
+    return answer, requires_operator
+
 async def process_message(message_data, bot: Bot, **kwargs):
     pool = kwargs.get("pool")
+    chat_history = kwargs.get("history")
     user_query = message_data['user_query']
     chat_id = message_data['chat_id']
     chat_id_in_telegram = message_data['chat_id_in_telegram']
+    # идентификатор запроса создаётся при получении сообщения и передаётся шлюзу, RAG и LLM,
+    # чтобы строки логов всех сервисов по одному вопросу можно было найти по нему
+    rid = message_data.get('request_id') or uuid.uuid4().hex
+    headers = {REQUEST_ID_HEADER: rid}
+    stages = {}
+    started = time.perf_counter()
+    if 'published_at' in message_data:
+        observe("queue_wait", time.time() - message_data['published_at'], stages)
     logger.info(f"chat_id_in_telegram: {chat_id_in_telegram}")
+    streamer = AnswerStreamer(bot, chat_id_in_telegram)
+
+    history = []
+    if chat_history is not None:
+        try:
+            with stage("history_load", stages):
+                history = await chat_history.get(chat_id, user_query)
+        except Exception as e:
+            # без истории вопрос всё равно можно обработать
+            logger.error(f"Не удалось загрузить историю чата {chat_id}: {e}")
+    payload = {"query": user_query, "history": history}
 
     try:
-        logger.info(f"Отправка запроса к {API_GATEWAY_URL}/query с данными: {user_query}")
         async with aiohttp.ClientSession() as session:
-            async with session.post(
-                f"{API_GATEWAY_URL}/query",
-                json={"query": user_query},
-                timeout=30.0
-            ) as response:
-                response.raise_for_status()
-                result = await response.json()
-                answer = result.get("response")
-                logger.info(f"Ответ для {chat_id}: {answer}")
-
-        requires_operator = result.get("requires_operator", False)
+            # при потоковом ответе в этап шлюза входят и промежуточные правки сообщения в Telegram
+            with stage("gateway", stages):
+                if STREAM_ANSWERS:
+                    logger.info(f"Потоковый запрос к {API_GATEWAY_URL}/query/stream с данными: {user_query}")
+                    answer, requires_operator = await stream_answer(session, payload, streamer, headers)
+                else:
+                    logger.info(f"Отправка запроса к {API_GATEWAY_URL}/query с данными: {user_query}")
+                    async with session.post(
+                        f"{API_GATEWAY_URL}/query",
+                        json=payload,
+                        headers=headers,
+                        timeout=aiohttp.ClientTimeout(total=30.0)
+                    ) as response:
+                        response.raise_for_status()
+                        result = await response.json()
+                        answer = result.get("response")
+                    requires_operator = result.get("requires_operator", False)
+            logger.info(f"Ответ для {chat_id}: {len(answer or '')} символов")
+            logger.info("Ответ для %s: %s", chat_id, answer, extra=PAYLOAD)
+
         logger.info(f"requires_operator: {requires_operator}")
         if requires_operator:
-            await update_chat_status(pool, chat_id, 'OPERATOR_NEEDED')
+            # передача оператору записывается сразу, минуя буфер записи
+            with stage("db_write", stages):
+                await update_chat_status(pool, chat_id, 'OPERATOR_NEEDED', critical=True)
             logger.info(f"Чат {chat_id} помечен как OPERATOR_NEEDED")
-            await bot.send_message(chat_id_in_telegram, "Ваш запрос передан оператору.")
-        else:
-            await bot.send_message(chat_id_in_telegram, answer)
+            answer = OPERATOR_MESSAGE
+        with stage("telegram_send", stages):
+            # частично показанный ответ заменяется сообщением о передаче оператору
+            await streamer.show(answer, force=True)
+        # ответ бота сохраняется, чтобы следующие вопросы чата получили историю диалога
+        try:
+            with stage("db_write", stages):
+                await add_message(pool, chat_id, 'BOT', answer)
+        except Exception as e:
+            logger.error(f"Ошибка: {e}. Ответ бота не был сохранён")
+        if chat_history is not None:
+            chat_history.add_turn(chat_id, user_query, answer)
+        breakdown = ", ".join(f"{name} {seconds:.3f}" for name, seconds in stages.items())
+        logger.info(f"Сообщение обработано за {time.perf_counter() - started:.3f} c ({breakdown})")
 
     except aiohttp.ClientResponseError as e:
         logger.error(f"Ошибка HTTP статуса: {e.status} - {e.message}")
@@ -51,23 +167,80 @@ async def process_message(message_data, bot: Bot, **kwargs):
     except aiohttp.ClientError as e:
         logger.error(f"Ошибка запроса: {e}")
         await bot.send_message(chat_id_in_telegram,"Ошибка подключения. Попробуйте еще раз.")
+    except StreamError as e:
+        logger.error(f"Ошибка при генерации ответа: {e}")
+        await bot.send_message(chat_id_in_telegram,"Ошибка при обработке запроса. Попробуйте еще раз.")
     except Exception as e:
         logger.error(f"Неизвестная ошибка: {e}")
         await bot.send_message(chat_id_in_telegram,"Что-то пошло не так. Попробуйте еще раз.")
 
 async def consume_messages(pool, bot:Bot):
+    async def handle(item):
+        message, message_data = item
+        # воркер обрабатывает сообщения разных чатов по очереди: идентификатор сбрасывается после каждого
+        message_data['request_id'] = message_data.get('request_id') or uuid.uuid4().hex
+        rid_token = request_id.set(message_data['request_id'])
+        try:
+            with ACTIVE_WORKERS.labels(SERVICE).track_inprogress():
+                await process_message(message_data, bot=bot, pool=pool, history=chat_history)
+        except asyncio.CancelledError:
+            # обработка прервана при остановке: сообщение вернётся в очередь и будет обработано после перезапуска
+            await message.nack(requeue=True)
+            raise
+        except Exception:
+            await message.reject()
+            raise
+        finally:
+            request_id.reset(rid_token)
+        # подтверждаем только после того, как ответ доставлен пользователю
+        await message.ack()
+
+    chat_history = ChatHistory(pool, turns=HISTORY_TURNS, max_chats=HISTORY_CACHE_CHATS)
+    workers = ChatWorkerPool(handle, workers=CONSUMER_WORKERS, max_pending_per_chat=CONSUMER_MAX_PENDING_PER_CHAT)
+
+    async def on_message(message: aio_pika.abc.AbstractIncomingMessage):
+        try:
+            message_data = json.loads(message.body.decode())
+        except (UnicodeDecodeError, json.JSONDecodeError) as e:
+            logger.error(f"Некорректное сообщение в очереди: {e}")
+            await message.reject()
+            return
+        missing = [field for field in REQUIRED_FIELDS if not isinstance(message_data, dict) or field not in message_data]
+        if missing:
+            # без повторной постановки в очередь: сообщение уйдёт в dead letter exchange, если он настроен
+            logger.error(f"Некорректное сообщение в очереди: нет полей {', '.join(missing)}")
+            await message.reject()
+            return
+        chat_id = message_data['chat_id']
+        if not workers.submit(chat_id, (message, message_data)):
+            # один чат не может занять все сообщения, выданные боту по prefetch. Вопрос уже сохранён в базе,
+            # поэтому отказ записывается как ответ бота: иначе в истории чата останется вопрос без ответа
+            logger.warning(f"В чате {chat_id} слишком много необработанных сообщений")
+            try:
+                await add_message(pool, chat_id, 'BOT', TOO_MANY_MESSAGES)
+            except Exception as e:
+                logger.error(f"Ошибка: {e}. Отказ в обработке вопроса чата {chat_id} не был сохранён")
+            await bot.send_message(message_data['chat_id_in_telegram'], TOO_MANY_MESSAGES)
+            await message.ack()
+
     connection = await aio_pika.connect_robust(RABBITMQ_URL)
     async with connection:
         channel = await connection.channel()
+        await channel.set_qos(prefetch_count=CONSUMER_PREFETCH)
         exchange = await channel.declare_exchange('telegram_bot', aio_pika.ExchangeType.DIRECT)
         queue = await channel.declare_queue('request_queue', durable=True)
         await queue.bind(exchange, 'request')
 
-        async with queue.iterator() as queue_iter:
-            async for message in queue_iter:
-                async with message.process():
-                    message_data = json.loads(message.body.decode())
-                    await process_message(message_data,bot=bot, pool=pool)
+        workers.start()
+        consumer_tag = await queue.consume(on_message)
+        logger.info(f"Обработка очереди: {CONSUMER_WORKERS} воркеров, prefetch {CONSUMER_PREFETCH}")
+        try:
+            await asyncio.Future()
+        finally:
+            # при остановке перестаём получать новые сообщения и дожидаемся ответов на уже принятые
+            await queue.cancel(consumer_tag)
+            logger.info(f"Остановка обработки очереди, в работе: {workers.stats()}")
+            await workers.drain(CONSUMER_SHUTDOWN_TIMEOUT)
 
 async def main():
     pool = await init_db()
@@ -2,6 +2,11 @@ import asyncpg
 import asyncio
 from dotenv import load_dotenv
 import os
+import time
+import logging
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from metrics import stage
 
 load_dotenv()
 DB_USER=os.getenv('DB_USER')
@@ -9,6 +14,199 @@ DB_NAME=os.getenv('DB_NAME')
 DB_PASSWORD=os.getenv('DB_PASSWORD')
 DB_HOST=os.getenv('DB_HOST')
 DB_PORT=os.getenv('DB_PORT')
+IDENTITY_CACHE_SIZE = int(os.getenv('IDENTITY_CACHE_SIZE', '10000'))
+IDENTITY_CACHE_TTL = float(os.getenv('IDENTITY_CACHE_TTL', '600'))
+# buffered — сообщения и статусы чатов записываются пачками в фоне, sync — каждая запись сразу
+DB_WRITE_MODE = os.getenv('DB_WRITE_MODE', 'buffered').lower()
+WRITE_BUFFER_MAX_BATCH = int(os.getenv('WRITE_BUFFER_MAX_BATCH', '500'))
+WRITE_BUFFER_FLUSH_INTERVAL = float(os.getenv('WRITE_BUFFER_FLUSH_INTERVAL', '0.5'))
+WRITE_BUFFER_MAX_PENDING = int(os.getenv('WRITE_BUFFER_MAX_PENDING', '10000'))
+MESSAGE_COLUMNS = ['chat_id', 'sender_type', 'responder_id', 'text', 'send_at']
+# история старше этого не читается: при секционировании по месяцам запрос затрагивает только свежие секции
+HISTORY_MAX_AGE_DAYS = int(os.getenv('HISTORY_MAX_AGE_DAYS', '30'))
+
+logger = logging.getLogger(__name__)
+
+class IdentityCache():
+    # telegram_id -> (user_id, chat_id) для вернувшихся пользователей; вытесняются давно не использованные записи
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries: OrderedDict[int, tuple[float, tuple[int, int]]] = OrderedDict()
+
+    def get(self, telegram_id: int) -> tuple[int, int] | None:
+        entry = self._entries.get(telegram_id)
+        if entry is None:
+            return None
+        expires_at, identity = entry
+        if expires_at < time.monotonic():
+            del self._entries[telegram_id]
+            return None
+        self._entries.move_to_end(telegram_id)
+        return identity
+
+    def put(self, telegram_id: int, identity: tuple[int, int]):
+        if self.max_size <= 0:
+            return
+        self._entries[telegram_id] = (time.monotonic() + self.ttl, identity)
+        self._entries.move_to_end(telegram_id)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, telegram_id: int):
+        self._entries.pop(telegram_id, None)
+
+identity_cache = IdentityCache(IDENTITY_CACHE_SIZE, IDENTITY_CACHE_TTL)
+
+class WriteBehindBuffer():
+    # Копит новые сообщения и изменения статусов чатов и записывает их пачкой: сообщения через COPY,
+    # статусы через executemany. Запись происходит раз в flush_interval секунд или сразу по набору max_batch
+    # записей. Если база не успевает и в буфере max_pending записей, добавление ждёт записи пачки
+    def __init__(self, max_batch: int, flush_interval: float, max_pending: int):
+        self.max_batch = max_batch
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.pool = None
+        self._messages: list[tuple] = []
+        self._statuses: dict[int, str] = {}
+        self._lock = asyncio.Lock()
+        self._wakeup = asyncio.Event()
+        self._task = None
+        # время базы и time.monotonic() в момент последней сверки: send_at считается по часам базы
+        self._clock: tuple[datetime, float] | None = None
+
+    @property
+    def enabled(self) -> bool:
+        return self.pool is not None
+
+    def start(self, pool):
+        self.pool = pool
+        self._task = asyncio.create_task(self._run())
+
+    def pending(self) -> int:
+        return len(self._messages) + len(self._statuses)
+
+    async def _sync_clock(self, conn):
+        # LOCALTIMESTAMP — то же время в часовом поясе сессии, что и CURRENT_TIMESTAMP по умолчанию для send_at
+        # при записи без буфера, поэтому сообщения обоих путей упорядочены и отсекаются по возрасту одинаково
+        db_now = await conn.fetchval('SELECT LOCALTIMESTAMP')
+        self._clock = (db_now, time.monotonic())
+
+    async def _now(self) -> datetime:
+        if self._clock is None:
+            async with self.pool.acquire() as conn:
+                await self._sync_clock(conn)
+        db_now, synced_at = self._clock
+        return db_now + timedelta(seconds=time.monotonic() - synced_at)
+
+    async def add_message(self, chat_id: int, sender_type: str, text: str, responder_id: int = None):
+        # время отправки фиксируется сейчас, а не при записи пачки
+        send_at = await self._now()
+        self._messages.append((chat_id, sender_type, responder_id, text, send_at))
+        await self._added()
+
+    async def update_chat_status(self, chat_id: int, status: str):
+        # из нескольких изменений статуса одного чата записывается последнее
+        self._statuses[chat_id] = status
+        await self._added()
+
+    async def _added(self):
+        if self.pending() >= self.max_pending:
+            await self.flush()
+        elif self.pending() >= self.max_batch:
+            self._wakeup.set()
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"Ошибка фоновой записи в базу: {e}")
+
+    async def flush(self):
+        async with self._lock:
+            messages, self._messages = self._messages, []
+            statuses, self._statuses = self._statuses, {}
+            if not messages and not statuses:
+                return
+            try:
+                with stage("db_flush"):
+                    async with self.pool.acquire() as conn:
+                        if messages:
+                            await self._write_messages(conn, messages)
+                            messages = []
+                        if statuses:
+                            await self._write_statuses(conn, statuses)
+                        await self._sync_clock(conn)
+            except (OSError, asyncpg.InterfaceError, asyncpg.PostgresConnectionError) as e:
+                # база недоступна: возвращаем записи в буфер, чтобы повторить при следующей записи
+                logger.error(f"Не удалось записать пачку в базу: {e}")
+                self._messages[:0] = messages
+                for chat_id, status in statuses.items():
+                    self._statuses.setdefault(chat_id, status)
+                overflow = self.pending() - self.max_pending
+                if overflow > 0:
+                    logger.error(f"Буфер записи переполнен, потеряно сообщений: {overflow}")
+                    del self._messages[:overflow]
+                raise
+
+    async def _write_messages(self, conn, messages: list[tuple]):
+        try:
+            await conn.copy_records_to_table('Message', records=messages, columns=MESSAGE_COLUMNS)
+        except (asyncpg.InterfaceError, asyncpg.PostgresConnectionError):
+            raise
+        except asyncpg.PostgresError as e:
+            # COPY выполняется целиком или не выполняется: записываем по одному, чтобы не потерять остальные.
+            # Записанные удаляются из списка, чтобы при потере соединения в буфер вернулись только оставшиеся
+            logger.error(f"Пакетная запись {len(messages)} сообщений не удалась: {e}, записываем по одному")
+            while messages:
+                record = messages[0]
+                try:
+                    await conn.execute(
+                        'INSERT INTO "Message" (chat_id, sender_type, responder_id, text, send_at) VALUES ($1, $2, $3, $4, $5)',
+                        *record
+                    )
+                except (asyncpg.InterfaceError, asyncpg.PostgresConnectionError):
+                    raise
+                except asyncpg.PostgresError as e:
+                    logger.error(f"Сообщение чата {record[0]} не записано: {e}")
+                del messages[0]
+
+    async def _write_statuses(self, conn, statuses: dict[int, str]):
+        try:
+            await conn.executemany('UPDATE "Chat" SET status = $2 WHERE chat_id = $1', list(statuses.items()))
+        except (asyncpg.InterfaceError, asyncpg.PostgresConnectionError):
+            raise
+        except asyncpg.PostgresError as e:
+            # executemany откатывается целиком: записываем по одному, чтобы ошибка одного чата не отменила остальные
+            logger.error(f"Пакетная запись {len(statuses)} статусов не удалась: {e}, записываем по одному")
+            for chat_id, status in statuses.items():
+                try:
+                    await conn.execute('UPDATE "Chat" SET status = $2 WHERE chat_id = $1', chat_id, status)
+                except (asyncpg.InterfaceError, asyncpg.PostgresConnectionError):
+                    raise
+                except asyncpg.PostgresError as e:
+                    logger.error(f"Статус {status} чата {chat_id} не записан: {e}")
+
+    async def close(self):
+        # при остановке бота записываем всё, что осталось в буфере
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+        if self.enabled:
+            await self.flush()
+        self.pool = None
+
+write_buffer = WriteBehindBuffer(WRITE_BUFFER_MAX_BATCH, WRITE_BUFFER_FLUSH_INTERVAL, WRITE_BUFFER_MAX_PENDING)
+
+def start_write_buffer(pool):
+    if DB_WRITE_MODE == 'buffered':
+        write_buffer.start(pool)
 
 async def init_db():
     return await asyncpg.create_pool(
@@ -40,19 +238,59 @@ async def add_chat(pool, user_id: int) -> int:
             chat = await conn.fetchrow('SELECT chat_id FROM "Chat" WHERE user_id = $1', user_id)
         return chat['chat_id']
 
-async def add_message(pool, chat_id: int, sender_type: str, text: str, responder_id: int = None):
+async def add_message(pool, chat_id: int, sender_type: str, text: str, responder_id: int = None, critical: bool = False):
+    # critical=True записывает сразу, минуя буфер
+    if write_buffer.enabled and not critical:
+        await write_buffer.add_message(chat_id, sender_type, text, responder_id)
+        return
     async with pool.acquire() as conn:
         await conn.execute(
             'INSERT INTO "Message" (chat_id, sender_type, responder_id, text) VALUES ($1, $2, $3, $4)',
             chat_id, sender_type, responder_id, text
         )
 
-async def update_chat_status(pool, chat_id: int, status:str):
+async def update_chat_status(pool, chat_id: int, status:str, critical: bool = False):
+    if write_buffer.enabled and not critical:
+        await write_buffer.update_chat_status(chat_id, status)
+        return
     async with pool.acquire() as conn:
         await conn.execute(
             'UPDATE "Chat" SET status = $2 WHERE chat_id = $1',
             chat_id, status
         )
-        
-    
 
+async def get_recent_messages(pool, chat_id: int, limit: int) -> list[asyncpg.Record]:
+    # последние сообщения чата в хронологическом порядке. Запрос читает limit строк с конца индекса
+    # (chat_id, send_at, message_id), поэтому его стоимость не растёт с длиной истории
+    async with pool.acquire() as conn:
+        rows = await conn.fetch(
+            '''SELECT message_id, sender_type, text, send_at FROM "Message"
+               WHERE chat_id = $1 AND send_at > LOCALTIMESTAMP - make_interval(days => $2)
+               ORDER BY send_at DESC, message_id DESC LIMIT $3''',
+            chat_id, HISTORY_MAX_AGE_DAYS, limit
+        )
+    return list(reversed(rows))
+
+async def resolve_chat(pool, telegram_id: int, username: str, first_name: str, last_name: str,
+                       text: str) -> tuple[int, int | None, bool]:
+    # возвращает (user_id, chat_id, is_new) и сохраняет сообщение пользователя. Для известного пользователя
+    # из кэша это одна вставка сообщения, иначе — один вызов функции resolve_chat в базе
+    cached = identity_cache.get(telegram_id)
+    if cached is not None:
+        user_id, chat_id = cached
+        try:
+            await add_message(pool, chat_id, 'USER', text)
+            return user_id, chat_id, False
+        except asyncpg.ForeignKeyViolationError:
+            # чат удалён в базе (заметно только при записи без буфера): сбрасываем кэш и определяем чат заново
+            logger.warning(f"Чат {chat_id} из кэша не найден в базе")
+            identity_cache.invalidate(telegram_id)
+
+    async with pool.acquire() as conn:
+        row = await conn.fetchrow(
+            'SELECT user_id, chat_id, is_new FROM resolve_chat($1, $2, $3, $4, $5)',
+            telegram_id, username, first_name, last_name, text
+        )
+    if not row['is_new']:
+        identity_cache.put(telegram_id, (row['user_id'], row['chat_id']))
+    return row['user_id'], row['chat_id'], row['is_new']
@@ -0,0 +1,58 @@
+import logging
+from collections import OrderedDict, deque
+from db_operations import get_recent_messages
+
+logger = logging.getLogger(__name__)
+
+ROLES = {'USER': 'user', 'BOT': 'assistant', 'OPERATOR': 'assistant'}
+# ответ бота на вопрос, отклонённый из-за переполнения очереди чата: такая пара в историю не входит
+TOO_MANY_MESSAGES = "Слишком много вопросов подряд. Дождитесь ответа на предыдущие и повторите вопрос."
+
+
+class ChatHistory():
+    # Последние реплики недавно активных чатов. История читается из базы только при первом вопросе
+    # после запуска бота или вытеснения чата из кэша, дальше дополняется по мере ответов
+    def __init__(self, pool, turns: int, max_chats: int):
+        self.pool = pool
+        self.max_messages = turns * 2
+        self.max_chats = max_chats
+        self._chats: OrderedDict[int, deque] = OrderedDict()
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_messages > 0
+
+    async def get(self, chat_id: int, current_query: str) -> list[dict]:
+        if not self.enabled:
+            return []
+        messages = self._chats.get(chat_id)
+        if messages is not None:
+            self._chats.move_to_end(chat_id)
+            return list(messages)
+
+        rows = await get_recent_messages(self.pool, chat_id, limit=self.max_messages + 1)
+        loaded = []
+        for row in rows:
+            if row['sender_type'] not in ROLES or not row['text']:
+                continue
+            if row['sender_type'] == 'BOT' and row['text'] == TOO_MANY_MESSAGES:
+                # отклонённый вопрос остался без ответа по существу
+                if loaded and loaded[-1]["role"] == "user":
+                    loaded.pop()
+                continue
+            loaded.append({"role": ROLES[row['sender_type']], "content": row['text']})
+        # текущий вопрос уже может быть записан в базу: в историю он не входит
+        if loaded and loaded[-1] == {"role": "user", "content": current_query}:
+            loaded.pop()
+        messages = deque(loaded[-self.max_messages:], maxlen=self.max_messages)
+        self._chats[chat_id] = messages
+        while len(self._chats) > self.max_chats:
+            self._chats.popitem(last=False)
+        return list(messages)
+
+    def add_turn(self, chat_id: int, question: str, answer: str):
+        messages = self._chats.get(chat_id)
+        if messages is None:
+            return
+        messages.append({"role": "user", "content": question})
+        messages.append({"role": "assistant", "content": answer})
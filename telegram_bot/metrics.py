@@ -0,0 +1,51 @@
+import logging
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from prometheus_client import Gauge, Histogram, start_http_server
+
+logger = logging.getLogger(__name__)
+
+REQUEST_ID_HEADER = "X-Request-ID"
+# те же корзины, что и в HTTP-сервисах, чтобы этапы бота и сервисов можно было сравнивать на одном графике
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+STAGE_SECONDS = Histogram("chatbot_stage_seconds", "Длительность этапов обработки запроса",
+                          ["service", "stage"], buckets=BUCKETS)
+STAGE_IN_FLIGHT = Gauge("chatbot_stage_in_flight", "Запросы, находящиеся на этапе обработки", ["service", "stage"])
+ACTIVE_WORKERS = Gauge("chatbot_active_workers", "Воркеры, обрабатывающие сообщение из очереди", ["service"])
+
+SERVICE = "telegram_bot"
+
+# идентификатор вопроса, который обрабатывается в текущей задаче: попадает в поле request_id записей лога
+request_id: ContextVar[str] = ContextVar("request_id", default="-")
+
+
+@contextmanager
+def stage(name: str, stages: dict | None = None):
+    STAGE_IN_FLIGHT.labels(SERVICE, name).inc()
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        STAGE_IN_FLIGHT.labels(SERVICE, name).dec()
+        STAGE_SECONDS.labels(SERVICE, name).observe(elapsed)
+        if stages is not None:
+            stages[name] = stages.get(name, 0.0) + elapsed
+
+
+def observe(name: str, seconds: float, stages: dict | None = None):
+    # для этапов, начало которых известно только по метке времени, например ожидание в очереди RabbitMQ
+    seconds = max(seconds, 0.0)
+    STAGE_SECONDS.labels(SERVICE, name).observe(seconds)
+    if stages is not None:
+        stages[name] = stages.get(name, 0.0) + seconds
+
+
+def start_metrics_server(port: int):
+    if port <= 0:
+        logger.info("Метрики отключены")
+        return
+    start_http_server(port)
+    logger.info(f"Метрики доступны на порту {port}: /metrics")
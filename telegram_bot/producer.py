@@ -3,31 +3,113 @@ from dotenv import load_dotenv
 import os
 import logging
 import json
+import asyncio
 
 load_dotenv()
 
 RABBITMQ_URL = os.getenv('RABBITMQ_URL')
+PUBLISHER_CHANNELS = int(os.getenv('PUBLISHER_CHANNELS', '4'))
+PUBLISHER_BATCH_SIZE = int(os.getenv('PUBLISHER_BATCH_SIZE', '50'))
+# больше стольких неотправленных сообщений не держим в памяти: обработчик получает ошибку и отвечает пользователю
+PUBLISHER_MAX_PENDING = int(os.getenv('PUBLISHER_MAX_PENDING', '1000'))
+PUBLISHER_ENQUEUE_TIMEOUT = float(os.getenv('PUBLISHER_ENQUEUE_TIMEOUT', '2'))
+PUBLISHER_CONFIRM_TIMEOUT = float(os.getenv('PUBLISHER_CONFIRM_TIMEOUT', '10'))
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-async def send_to_queue(message):
-    try:
-        connection = await aio_pika.connect_robust(RABBITMQ_URL)
-        routing_key = 'request'
-        async with connection:
-            channel = await connection.channel()
+class PublishError(Exception):
+    pass
+
+class Publisher():
+    # Одно соединение с RabbitMQ на всё время работы бота и несколько каналов с подтверждениями публикации.
+    # Каждый канал забирает из общей очереди пачку сообщений, публикует их все сразу и ждёт подтверждений
+    # брокера одновременно, а не по одному
+    def __init__(self, url: str, channels: int = 4, batch_size: int = 50, max_pending: int = 1000,
+                 enqueue_timeout: float = 2.0, confirm_timeout: float = 10.0):
+        self.url = url
+        self.channels = max(1, channels)
+        self.batch_size = max(1, batch_size)
+        self.enqueue_timeout = enqueue_timeout
+        self.confirm_timeout = confirm_timeout
+        self._queue: asyncio.Queue = asyncio.Queue(maxsize=max_pending)
+        self._connection = None
+        self._tasks: list[asyncio.Task] = []
+
+    async def connect(self):
+        self._connection = await aio_pika.connect_robust(self.url)
+        for _ in range(self.channels):
+            channel = await self._connection.channel(publisher_confirms=True)
             exchange = await channel.declare_exchange('telegram_bot', aio_pika.ExchangeType.DIRECT)
-            await exchange.publish(aio_pika.Message(body=json.dumps(message).encode()), routing_key=routing_key)
-            logger.info(f"Сообщение отправлено в очередь: {message}")
-    except Exception as e:
-        logger.error(f"Ошибка при отправке сообщения: {e}")
-
-""" if __name__ == '__main__':
-    # Пример использования
-    example_message = {
-        'message': 'Example message',
-        'user_query': 'Example query',
-        'chat_id': 12345
-    }
-    asyncio.run(send_to_queue(example_message))    """ 
\ No newline at end of file
+            self._tasks.append(asyncio.create_task(self._worker(exchange)))
+        # очередь объявляется и здесь, чтобы сообщения не терялись, если обработчик очереди ещё не запущен
+        queue = await channel.declare_queue('request_queue', durable=True)
+        await queue.bind(exchange, 'request')
+        logger.info(f"Соединение с RabbitMQ установлено, каналов публикации: {self.channels}")
+
+    async def publish(self, message: dict):
+        future = asyncio.get_running_loop().create_future()
+        try:
+            await asyncio.wait_for(self._queue.put((json.dumps(message).encode(), future)), self.enqueue_timeout)
+        except asyncio.TimeoutError:
+            raise PublishError("Очередь публикации переполнена")
+        try:
+            await asyncio.wait_for(asyncio.shield(future), self.confirm_timeout)
+        except asyncio.TimeoutError:
+            # сообщение уже передано каналу и, скорее всего, будет опубликовано: сообщать пользователю об ошибке
+            # нельзя, иначе повторный вопрос получит второй ответ. Подтверждение дожидается в фоне
+            request_id = message.get('request_id')
+            logger.warning(f"Брокер не подтвердил сообщение {request_id} за {self.confirm_timeout} c, ждём в фоне")
+            future.add_done_callback(lambda done: self._confirmed_late(done, request_id))
+            return
+        logger.info(f"Сообщение отправлено в очередь: {message}")
+
+    @staticmethod
+    def _confirmed_late(future: asyncio.Future, request_id: str | None):
+        if future.cancelled():
+            logger.error(f"Сообщение {request_id} не отправлено: публикация отменена")
+        elif future.exception() is not None:
+            logger.error(f"Сообщение {request_id} не отправлено: {future.exception()}")
+        else:
+            logger.info(f"Сообщение {request_id} подтверждено брокером с опозданием")
+
+    async def _worker(self, exchange: aio_pika.abc.AbstractExchange):
+        while True:
+            batch = [await self._queue.get()]
+            while len(batch) < self.batch_size and not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+            results = await asyncio.gather(*(
+                exchange.publish(aio_pika.Message(body=body, delivery_mode=aio_pika.DeliveryMode.PERSISTENT),
+                                 routing_key='request')
+                for body, _ in batch
+            ), return_exceptions=True)
+            for (_, future), result in zip(batch, results):
+                if not future.done():
+                    if isinstance(result, BaseException):
+                        logger.error(f"Ошибка при отправке сообщения: {result}")
+                        future.set_exception(PublishError(str(result)))
+                    else:
+                        future.set_result(None)
+                self._queue.task_done()
+
+    async def close(self, timeout: float = 10.0):
+        # дожидаемся публикации принятых сообщений, затем закрываем соединение
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"Не отправлено сообщений при остановке: {self._queue.qsize()}")
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        if self._connection is not None:
+            await self._connection.close()
+
+def create_publisher() -> Publisher:
+    return Publisher(
+        RABBITMQ_URL,
+        channels=PUBLISHER_CHANNELS,
+        batch_size=PUBLISHER_BATCH_SIZE,
+        max_pending=PUBLISHER_MAX_PENDING,
+        enqueue_timeout=PUBLISHER_ENQUEUE_TIMEOUT,
+        confirm_timeout=PUBLISHER_CONFIRM_TIMEOUT,
+    )
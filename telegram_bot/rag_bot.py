@@ -1,30 +1,27 @@
 from dotenv import load_dotenv
 import os
-import sys
 import asyncio
 import logging
+import time
+import uuid
 from aiogram import Bot, Dispatcher, types
-from db_operations import authorize_user, init_db, add_user, add_chat, add_message, update_chat_status
-from producer import send_to_queue
+from db_operations import init_db, resolve_chat, start_write_buffer, write_buffer
+from producer import PublishError, create_publisher
 from consumer import consume_messages
+from metrics import request_id, start_metrics_server, stage
+from logging_setup import setup_logging
 
 log_dir = os.path.join(os.path.dirname(__file__), 'logs')
-os.makedirs(log_dir, exist_ok=True)
-
-console_handler = logging.StreamHandler(sys.stdout)
-file_handler = logging.FileHandler(os.path.join(log_dir, 'telegram_bot.log'))
-
-logging.basicConfig(
-    level = logging.INFO,
-    handlers=[console_handler, file_handler],
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
-)
+# запись в stdout и файл выполняется в отдельном потоке, а не в цикле событий
+setup_logging('telegram_bot', os.path.join(log_dir, 'telegram_bot.log'), request_id)
 
 logger = logging.getLogger(__name__)
 load_dotenv()
 
 API_TOKEN = os.getenv('API_KEY')
 API_GATEWAY_URL = os.getenv('API_GATEWAY_URL')
+# порт HTTP-сервера с метриками Prometheus, 0 отключает сервер
+METRICS_PORT = int(os.getenv('METRICS_PORT', '9100'))
 
 if not API_TOKEN:
     logger.error("API_TOKEN не найден в переменных окружения. Проверьте файл .env")
@@ -39,59 +36,68 @@ dp = Dispatcher()
 @dp.message()
 async def rag_message(message: types.Message, **kwargs):
     pool = kwargs.get("pool")
+    publisher = kwargs.get("publisher")
     telegram_id = message.from_user.id
     first_name = message.from_user.first_name
     last_name = message.from_user.last_name
     username = message.from_user.username
 
-    is_authorized, user_id = await authorize_user(telegram_id, pool)
-
-    if is_authorized:
-        logger.info(f"Пользователь: {user_id} есть в системе")   
-    else:
-        await message.reply("Вы не авторизованы. Сначала зарегистрируйтесь в системе.")
-        logger.info(f"Пользователя: {telegram_id} {username} {first_name} {last_name} нет в системе")
-        try:
-            await add_user(pool, telegram_id, username, first_name, last_name)
-            logger.info("Пользователь добавлен в бд")
-        except Exception as e:
-            logger.error(f"Ошибка: {e}. Пользователь не был добавлен в БД")
-    try:
-        chat_id = await add_chat(pool, user_id)  
-        logger.info(f"Чат {chat_id} пользователя: {user_id}")
-    except Exception as e:
-        logger.error(f"Ошибка: {e}. Не найден чат и не был создан")
-        await message.reply("Не удалось создать чат. Попробуйте позже.")
-        return
     user_query = message.text.strip()
+    rid = uuid.uuid4().hex
+    # каждое обновление aiogram обрабатывается в своей задаче, поэтому значение не переходит к другим сообщениям
+    request_id.set(rid)
     logger.info(f"Сообщение пользователя {user_query}")
     try:
-        await add_message(pool, chat_id, 'USER', user_query)
-        logger.info(f"Сообщение добавлено в таблицу")
+        # пользователь, чат и сообщение определяются и сохраняются за один запрос к базе
+        with stage("db_resolve_chat"):
+            user_id, chat_id, is_new = await resolve_chat(pool, telegram_id, username, first_name, last_name, user_query)
     except Exception as e:
         logger.error(f"Ошибка: {e}. Сообщение не было добавлено")
         await message.reply("Не удалось сохранить сообщение. Попробуйте позже.")
         return
+
+    if is_new:
+        await message.reply("Вы не авторизованы. Сначала зарегистрируйтесь в системе.")
+        logger.info(f"Пользователя: {telegram_id} {username} {first_name} {last_name} нет в системе, добавлен в бд")
+        return
+    logger.info(f"Сообщение добавлено в чат {chat_id} пользователя: {user_id}")
     message_data = {
         'message': message.model_dump_json(),
         'user_query': user_query,
         'chat_id': chat_id,
-        'chat_id_in_telegram': message.chat.id 
+        'chat_id_in_telegram': message.chat.id,
+        'request_id': rid,
+        # по метке обработчик очереди считает, сколько сообщение ждало в RabbitMQ
+        'published_at': time.time(),
     }
-    await send_to_queue(message_data)
+    try:
+        with stage("publish"):
+            await publisher.publish(message_data)
+    except PublishError as e:
+        logger.error(f"Ошибка: {e}. Сообщение не было отправлено в очередь")
+        await message.reply("Сервис сейчас перегружен. Попробуйте повторить вопрос через минуту.")
     
 async def main() -> None:
     bot = Bot(token=API_TOKEN)
+    start_metrics_server(METRICS_PORT)
     pool = await init_db()
+    start_write_buffer(pool)
+    # одно соединение с RabbitMQ для публикации на всё время работы бота
+    publisher = create_publisher()
+    await publisher.connect()
     consumer_task = asyncio.create_task(consume_messages(pool, bot))
     try:
         logger.info("Запуск бота")
-        await dp.start_polling(bot, pool=pool)
+        await dp.start_polling(bot, pool=pool, publisher=publisher)
     except Exception as e:
         logger.error(f"Ошибка polling: {e}")
     finally:
         logger.info("Остановка бота")
+        await publisher.close()
         consumer_task.cancel()
+        # обработчик очереди успевает ответить на уже принятые сообщения до закрытия сессии бота и пула
+        await asyncio.gather(consumer_task, return_exceptions=True)
+        await write_buffer.close()
         await bot.session.close()
         await pool.close()
          
@@ -0,0 +1,69 @@
+import asyncio
+import logging
+from collections import deque
+from typing import Any, Awaitable, Callable, Hashable
+
+logger = logging.getLogger(__name__)
+
+
+class ChatWorkerPool():
+    # Сообщения одного чата обрабатываются строго по порядку, разные чаты — параллельно несколькими воркерами.
+    # Чаты с ожидающими сообщениями обслуживаются по кругу: после одного сообщения чат встаёт в конец очереди,
+    # поэтому пользователь, отправивший много вопросов подряд, не занимает все воркеры
+    def __init__(self, handler: Callable[[Any], Awaitable[None]], workers: int, max_pending_per_chat: int):
+        self.handler = handler
+        self.workers = max(1, workers)
+        self.max_pending_per_chat = max_pending_per_chat
+        self._chats: dict[Hashable, deque] = {}
+        self._ready: asyncio.Queue = asyncio.Queue()
+        self._tasks: list[asyncio.Task] = []
+        self.active = 0
+
+    def start(self):
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    def submit(self, key: Hashable, item: Any) -> bool:
+        pending = self._chats.get(key)
+        if pending is None:
+            pending = self._chats[key] = deque()
+            self._ready.put_nowait(key)
+        elif len(pending) >= self.max_pending_per_chat:
+            return False
+        pending.append(item)
+        return True
+
+    async def _worker(self):
+        while True:
+            key = await self._ready.get()
+            pending = self._chats[key]
+            item = pending.popleft()
+            self.active += 1
+            try:
+                await self.handler(item)
+            except Exception as e:
+                logger.error(f"Ошибка обработки сообщения чата {key}: {e}")
+            finally:
+                self.active -= 1
+                if pending:
+                    self._ready.put_nowait(key)
+                else:
+                    del self._chats[key]
+                self._ready.task_done()
+
+    async def drain(self, timeout: float):
+        # новые сообщения уже не поступают: дожидаемся обработки принятых, затем останавливаем воркеры
+        try:
+            await asyncio.wait_for(self._ready.join(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"За {timeout} c обработаны не все сообщения, осталось чатов: {len(self._chats)}")
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    def stats(self) -> dict:
+        return {
+            "workers": self.workers,
+            "active": self.active,
+            "chats": len(self._chats),
+            "pending": sum(len(pending) for pending in self._chats.values()),
+        }